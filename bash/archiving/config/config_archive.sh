@@ -91,3 +91,13 @@ export MEANS_OUTPUT=$SCRATCH/mars-pull/carra2
 
 #the binary for grib_mean
 export gmean=/perm/nhd/CARRA2/harp-data-pipeline/bin/grib_mean.x
+#daily means of the analysis with gmean (default) or with ecf_submitters/bin/daily_mean.py
+#The python version does all the parameters of a day in one process
+#With fused the monthly means are also updated in the same pass and the daily
+#files are not merged or read again (see monthly_means_an_insta_level.sh)
+#export MEANS_ENGINE=python
+#export MEANS_ENGINE=fused
+
+#run the daily means and sums as parallel (date, param) units with unit_scheduler.py
+#The number of units at the same time depends on the cores and memory of the SLURM job
+#export USE_UNIT_SCHEDULER=1
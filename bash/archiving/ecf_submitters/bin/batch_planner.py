@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Split the accumulated parameters of the daily sums in batches of about the same runtime
+#
+# Each daily_sum_fc_sfc_batchN task of a stream family runs the parameters
+# of its batch one after the other, and monthly_means_of_daily_sums waits for
+# all of them, so the family takes as long as its slowest batch. The batch
+# tasks record how long each parameter took (PARAM_RUNTIMES file, lines of
+# "period origin param seconds days", days the range like 01-10), and here the batches of the next suites
+# are made with the longest parameters first, each one to the batch with the
+# shortest total so far. With NBATCH=auto the number of batches is the
+# smallest one that keeps every batch below a target wall time.
+# Parameters never recorded get the median runtime of the others.
+# With DAYS_PER_TASK each day range records its own line, so the lines of
+# the same period are added up to the runtime of the whole month. Only the
+# last line of each range is used, since a rerun of a failed task records
+# its params again.
+# Only uses the standard library (it is imported by create_suite.py).
+#
+# Examples:
+#   batch_planner.py -p 47/146/169/175 -o no-ar-pa
+#   batch_planner.py -p $CARRA_PAR_FC_ACC -o no-ar-ce -n 4 -r ~/ecflow_suites/daily_sum_runtimes.txt
+
+import os
+import argparse
+from collections import defaultdict
+
+RUNTIMES_FILE = os.path.join(os.path.expanduser("~"), "ecflow_suites", "daily_sum_runtimes.txt")
+RUNTIME_SAMPLES = 6  # last months used for the runtime of each parameter
+DEFAULT_RUNTIME = 1800  # seconds for a parameter when nothing was recorded yet
+TARGET_WALL = 6 * 3600  # seconds for each batch with NBATCH=auto
+MAX_BATCHES = 10  # batches with NBATCH=auto
+
+
+def read_runtimes(runtimes_file, origin):
+    """Mean of the last RUNTIME_SAMPLES monthly runtimes of each parameter of origin"""
+    samples = defaultdict(lambda: defaultdict(dict))
+    if not os.path.isfile(runtimes_file):
+        return {}
+    with open(runtimes_file, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) not in (4, 5) or fields[1] != origin:
+                continue
+            # lines without the days are from the whole month
+            days = fields[4] if len(fields) == 5 else "01-31"
+            try:
+                samples[fields[2]][fields[0]][days] = float(fields[3])
+            except ValueError:
+                continue
+    runtimes = {}
+    for param, values in samples.items():
+        last = [sum(values[period].values()) for period in sorted(values)[-RUNTIME_SAMPLES:]]
+        runtimes[param] = sum(last) / len(last)
+    return runtimes
+
+
+def estimate_runtimes(params, runtimes):
+    """Runtime of each of params, the median of the known ones for the others"""
+    known = sorted(runtimes[p] for p in params if p in runtimes)
+    default = known[len(known) // 2] if known else DEFAULT_RUNTIME
+    return {param: runtimes.get(param, default) for param in params}
+
+
+def lpt_batches(seconds, nbatch):
+    """
+    Split the parameters in nbatch batches: the longest first, each one to the
+    batch with the shortest total so far. Return the list of (total seconds, params)
+    """
+    batches = [[0, []] for _ in range(nbatch)]
+    for param in sorted(seconds, key=lambda p: (-seconds[p], p)):
+        batch = min(batches, key=lambda batch: batch[0])
+        batch[0] += seconds[param]
+        batch[1].append(param)
+    return [(total, params) for total, params in batches if params]
+
+
+def number_of_batches(seconds, target=TARGET_WALL, max_batches=MAX_BATCHES):
+    """Smallest number of batches with all of them below target, at most max_batches"""
+    nbatch = max(1, min(max_batches, len(seconds), -(-int(sum(seconds.values())) // int(target))))
+    while nbatch < min(max_batches, len(seconds)) and max(total for total, _ in lpt_batches(seconds, nbatch)) > target:
+        nbatch += 1
+    return nbatch
+
+
+def plan_batches(params, origin, nbatch="auto", runtimes_file=RUNTIMES_FILE, target=TARGET_WALL, max_batches=MAX_BATCHES):
+    """Batches (total seconds, params) of params for origin. nbatch is a number or auto"""
+    seconds = estimate_runtimes(params, read_runtimes(runtimes_file, origin))
+    if str(nbatch) == "auto":
+        nbatch = number_of_batches(seconds, target, max_batches)
+    return lpt_batches(seconds, min(int(nbatch), len(params)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batches of the daily sum parameters balanced by their runtime")
+    parser.add_argument("--params", "-p", required=True, help="Parameters, ie 47/146/169")
+    parser.add_argument("--origin", "-o", required=True, help="Domain, ie no-ar-pa")
+    parser.add_argument("--nbatch", "-n", default="auto", help="Number of batches or auto (default: auto)")
+    parser.add_argument("--runtimes", "-r", default=os.environ.get("PARAM_RUNTIMES", RUNTIMES_FILE),
+                        help="File with the recorded runtimes")
+    parser.add_argument("--target-hours", type=float, default=TARGET_WALL / 3600, help="Wall time of each batch with auto")
+    args = parser.parse_args()
+
+    params = [p for p in args.params.split("/") if p]
+    batches = plan_batches(params, args.origin, args.nbatch, args.runtimes, args.target_hours * 3600)
+    for n, (total, batch) in enumerate(batches, start=1):
+        print(f"batch{n}: {total / 3600:.1f} h {' '.join(batch)}")
+
+
+if __name__ == "__main__":
+    main()
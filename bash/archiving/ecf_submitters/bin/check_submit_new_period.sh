@@ -10,4 +10,5 @@ export ECF_HOST="ecflow-gen-${USER}-001"
 
 module load python3
 module load ecflow
-python3 run_new_period.py
+#all the periods ready after an outage, at most MAX_ACTIVE_SUITES suites in ecFlow at the same time
+python3 run_new_period.py --catch-up
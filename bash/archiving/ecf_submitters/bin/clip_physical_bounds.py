@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Clip fields to their physical bounds after the daily/monthly processing
+# GRIB packing can give small negative values for accumulations, as described here:
+# https://confluence.ecmwf.int/display/UDOC/Why+are+there+sometimes+small+negative+precipitation+accumulations+-+ecCodes+GRIB+FAQ
+# This is the general version of set_tp_to_zero.py, for all the parameters in
+# the bounds table below (CARRA_PAR_FC_ACC and CARRA_PAR_FC_SFC_MM products).
+#
+# For each file all the affected fields are decoded together and clipped in
+# one vectorised call. Fields that do not change, and all the other
+# parameters, are copied as raw bytes. A whole month directory can be done
+# in one call, spreading the files over a process pool.
+#
+# Examples:
+#   clip_physical_bounds.py monthly_mean_accum_no-ar-pa_fc_sfc_202301_228228.grib2
+#   clip_physical_bounds.py -d $MEANS_OUTPUT/no-ar-pa/2023/01 -j 8
+#   clip_physical_bounds.py -d $MEANS_OUTPUT/no-ar-pa/2023/01 -p $CARRA_PAR_FC_ACC
+
+import os
+import sys
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import eccodes as ecc
+import numpy as np
+from grib_index import get_index, select
+from grib_reader import GribReader
+from grib_manifest import ManifestFile
+
+# (lower, upper) bounds per parameter. None means no bound on that side
+# Only parameters known to be non-negative and written to the files of
+# MONTH_PATTERNS are included. Add more here or give a json file with --bounds
+BOUNDS = {
+    # accumulated fields in CARRA_PAR_FC_ACC that cannot be negative
+    47: (0., None),      # direct solar radiation
+    169: (0., None),     # surface solar radiation downwards
+    175: (0., None),     # surface thermal radiation downwards
+    176: (0., None),     # surface net solar radiation
+    178: (0., None),     # top net solar radiation
+    210: (0., None),     # surface net solar radiation, clear sky
+    228228: (0., None),  # total precipitation
+    # min/max fields in CARRA_PAR_FC_SFC_MM
+    228029: (0., None),  # 10 metre wind gust
+}
+
+# Files processed when a month directory is given
+MONTH_PATTERNS = [
+    "SUMS/daily_sum_*.grib2",
+    "SUMS/monthly_mean_accum_*.grib2",
+    "daily_minmax_*.grib2",
+    "monthly_minmax_*.grib2",
+]
+
+
+def load_bounds(bounds_file=None, params=None):
+    """
+    The bounds table, optionally replaced by a json file like {"228228": [0, null]}
+    and restricted to the list of params
+    """
+    bounds = dict(BOUNDS)
+    if bounds_file is not None:
+        with open(bounds_file, "r") as f:
+            bounds = {int(param): tuple(limits) for param, limits in json.load(f).items()}
+    if params is not None:
+        bounds = {param: limits for param, limits in bounds.items() if param in params}
+    return bounds
+
+
+def clip_file(infile, outfile, bounds):
+    """
+    Clip all the fields of infile with an entry in bounds and write them to outfile
+    (infile is replaced if both are the same). Return the number of fields changed
+    """
+    entries = get_index(infile)
+    affected = select(entries, param=list(bounds))
+    if not affected:
+        print(f"Nothing to clip in {infile}")
+        return 0
+
+    tmp_file = outfile + ".clip.tmp"
+    nchanged = 0
+    with GribReader(infile) as reader:
+        # decode the affected fields together and clip them in one call
+        values = []
+        for entry in affected:
+            with reader.message_at(entry).handle() as msg:
+                values.append(ecc.codes_get_values(msg))
+        values = np.stack(values)
+        lower = np.array([bounds[entry["param"]][0] for entry in affected], dtype=float)
+        upper = np.array([bounds[entry["param"]][1] for entry in affected], dtype=float)
+        lower[np.isnan(lower)] = -np.inf
+        upper[np.isnan(upper)] = np.inf
+        clipped = np.clip(values, lower[:, None], upper[:, None])
+        changed = np.any(clipped != values, axis=1)
+        nchanged = int(changed.sum())
+        if nchanged == 0 and outfile == infile:
+            print(f"All values within bounds in {infile}")
+            return 0
+
+        new_values = {entry["offset"]: clipped[i] for i, entry in enumerate(affected) if changed[i]}
+        with ManifestFile(tmp_file, defer=True) as f:
+            for entry in entries:
+                message = reader.message_at(entry)
+                if entry["offset"] not in new_values:
+                    f.write(message.data, entry)
+                    continue
+                print(f"Clipping {entry['param']} for {entry['date']} to {bounds[entry['param']]}")
+                with message.handle() as msg:
+                    ecc.codes_set_values(msg, new_values[entry["offset"]])
+                    f.write_handle(msg)
+    os.replace(tmp_file, outfile)
+    f.save(outfile)
+    return nchanged
+
+
+def clip_one(args):
+    """Wrapper for the process pool"""
+    infile, bounds = args
+    try:
+        return infile, clip_file(infile, infile, bounds), None
+    except Exception as e:
+        return infile, 0, str(e)
+
+
+def clip_month(month_dir, bounds, nproc=None):
+    """Clip in place all the files in month_dir matching MONTH_PATTERNS"""
+    files = []
+    for pattern in MONTH_PATTERNS:
+        files.extend(sorted(glob.glob(os.path.join(month_dir, pattern))))
+    print(f"Clipping {len(files)} files in {month_dir}")
+    failed = []
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        for infile, nchanged, error in pool.map(clip_one, [(f, bounds) for f in files]):
+            if error is not None:
+                print(f"ERROR clipping {infile}: {error}")
+                failed.append(infile)
+            elif nchanged > 0:
+                print(f"{infile}: {nchanged} fields clipped")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clip fields to their physical bounds")
+    parser.add_argument("infile", nargs="?", help="GRIB file to correct")
+    parser.add_argument("outfile", nargs="?", help="Output file (default: replace infile)")
+    parser.add_argument("--month-dir", "-d", help="Do all the sums and min/max files in this month directory")
+    parser.add_argument("--nproc", "-j", type=int, default=None, help="Number of processes for --month-dir")
+    parser.add_argument("--params", "-p", help="Only clip these parameters, ie 228228/169")
+    parser.add_argument("--bounds", "-b", help="json file with the bounds table")
+    args = parser.parse_args()
+
+    params = None
+    if args.params:
+        params = [int(p) for p in args.params.split("/") if p]
+    bounds = load_bounds(args.bounds, params)
+    print(f"Bounds: {bounds}")
+
+    if args.month_dir:
+        failed = clip_month(args.month_dir, bounds, args.nproc)
+        if failed:
+            sys.exit(1)
+    elif args.infile:
+        if os.stat(args.infile).st_size == 0:
+            print(f"{args.infile} is empty!")
+            sys.exit(1)
+        clip_file(args.infile, args.outfile or args.infile, bounds)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,13 +8,14 @@ fi
 
 
 if [ -z $1 ]; then
- echo "This script acts only on monthly means file of type sfc"
- echo "It will only select the parameter total precipitation"
- echo "and set any negative minimum value to zero"
- echo "Minimum argument is the period in format YYYYMM"
- echo "Alternatively include the domain (ie, no-ar-ce or no-ar-cw)"
- echo "Example: ./correct_tp_values.sh 202301 no-ar-cw [1:IHL 1:IPL 1:ISL 1:ISF 1:IML 1:IAC]"
- echo "If domain not provided, it will do both domains!"
+ echo "This script clips to their physical bounds (see clip_physical_bounds.py)"
+ echo "all the fields of the daily and monthly SUMS files and of the daily and"
+ echo "monthly minmax files of the month. The files are rewritten in place"
+ echo "With CLIP_MODE=tp it only sets the negative values of total precipitation"
+ echo "in the monthly mean of the sums to zero (set_tp_to_zero.py), as it did before"
+ echo "Arguments are the period in format YYYYMM and the domain (ie, no-ar-ce or no-ar-cw)"
+ echo "Example: ./correct_tp_values.sh 202301 no-ar-cw"
+ echo "Example: CLIP_MODE=tp ./correct_tp_values.sh 202301 no-ar-cw"
  exit 1
 else
  PERIOD=$1
@@ -66,10 +67,37 @@ else
       ${ECFPROJ_LIB}/bin/set_tp_to_zero.py $F $OUT $DOM $PERIOD
       echo "Checking min value of tp after correction"
       grib_get -F "%.6f" -p minimum -w shortName=tp $OUT
-      #replace original file
-      mv $OUT $F
+      #replace original file, with the manifest written by set_tp_to_zero.py (see grib_manifest.py)
+      python ${ECFPROJ_LIB}/bin/grib_manifest.py --move $F $OUT || exit 1
     done
 fi
 }
 
-set_min_to_zero
+clip_all_bounds()
+{
+# General version of set_min_to_zero: clips all the accumulated (SUMS)
+# and min/max fields of the month to their physical bounds in one call.
+# The files are spread over a process pool.
+# See the table of bounds in clip_physical_bounds.py
+if [ -z $DOM ]; then
+   echo "provide domain (ie, no-ar-pa)"
+   exit 1
+fi
+MDIR=$MEANS_OUTPUT/$DOM/$YYYY/$MM
+if [ ! -d $MDIR ]; then
+  echo "$MDIR missing!"
+  exit 1
+fi
+echo "Clipping all fields to their physical bounds in $MDIR"
+${ECFPROJ_LIB}/bin/clip_physical_bounds.py -d $MDIR -j ${SLURM_CPUS_PER_TASK:-4} || exit 1
+echo "Checking min value of tp after correction"
+grib_get -F "%.6f" -p minimum -w shortName=tp $MDIR/SUMS/monthly_mean_accum_${DOM}_fc_sfc_${PERIOD}_228228.grib2
+}
+
+#CLIP_MODE=all (default) clips all the files of the month, CLIP_MODE=tp does only tp
+#in the monthly mean of the sums, one file at a time
+if [[ ${CLIP_MODE:-all} == tp ]]; then
+  set_min_to_zero
+else
+  clip_all_bounds
+fi
@@ -1,4 +1,5 @@
 import os, sys
+import calendar
 #import time, datetime
 from datetime import datetime, timedelta
 import time
@@ -8,6 +9,7 @@ import getpass
 import argparse
 
 import ecflow as ec
+from batch_planner import plan_batches, RUNTIMES_FILE
 
 # System configuration
 ECFPROJ_LIB = os.environ["ECFPROJ_LIB"]
@@ -28,7 +30,18 @@ FORCE = os.environ["FORCE"]
 CARRA_PERIOD = os.environ["CARRA_PERIOD"]
 MEANS_SCR = os.environ["MEANS_SCR"]
 
+# Several periods in the same suite, one family each (ie for a backlog):
+# "198501-198506" or a list like "198501 198502:no-ar-ce 198503",
+# where :streams limits the streams of that period (default ECFPROJ_STREAMS)
+CARRA_PERIODS = os.getenv("CARRA_PERIODS", CARRA_PERIOD)
+# tasks running at the same time in the whole suite
+SUITE_PAR = int(os.getenv("SUITE_PAR", "10"))
+# days done by each daily mean/sum task (ie 1 for one task per day). 0 for the whole month
+DAYS_PER_TASK = int(os.getenv("DAYS_PER_TASK", "0"))
+
 CARRA_PAR_FC_ACC = os.environ["CARRA_PAR_FC_ACC"]
+# runtimes of each accumulated parameter, written by the daily sum batches (see batch_planner.py)
+PARAM_RUNTIMES = os.getenv("PARAM_RUNTIMES", RUNTIMES_FILE)
 
 # List of streams to process
 get_streams = os.getenv('ECFPROJ_STREAMS')
@@ -82,29 +95,59 @@ suite.add_variable("SUB_H",             "sbatch." + ECFPROJ_CONFIG + ".h")
 suite.add_variable("TASK",           "")
 suite.add_variable("CARRA_PERIOD",CARRA_PERIOD)
 suite.add_variable("MEANS_SCR", MEANS_SCR)
+suite.add_variable("PARAM_RUNTIMES", PARAM_RUNTIMES)
+# days of the daily tasks. Empty for the whole month, set in the day families
+suite.add_variable("DAY_BEG", "")
+suite.add_variable("DAY_END", "")
 
-# Add common "par" limit to jobs
-suite.add_limit("par", 10)
+# Add common "par" limit to jobs, shared by all the periods and streams
+suite.add_limit("par", SUITE_PAR)
+suite.add_inlimit("par")
 
 SPLIT_SUM_VARS = CARRA_PAR_FC_ACC.split("/")
-NBATCH = int(os.environ['NBATCH'])
-
-# Only create batch variables if daily sums are selected
-if SELECTED_DAILY_SUMS:
-    split_size = len(SPLIT_SUM_VARS)//NBATCH
-    rem_split = len(SPLIT_SUM_VARS) % NBATCH
-    start_chunk = 0
-    for i in range(0,NBATCH):
-        end_chunk = start_chunk + split_size + (1 if i < rem_split else 0)
-        chunks_sum = SPLIT_SUM_VARS[start_chunk:end_chunk]
-        start_chunk = end_chunk
-        print(f"Adding {chunks_sum} to CARRA_PAR_FC_ACC_batch{i+1}")
-        suite.add_variable(f"CARRA_PAR_FC_ACC_batch{i+1}"," ".join(chunks_sum))
+# number of batches of the daily sums, or auto to choose it from the recorded runtimes
+NBATCH = os.getenv('NBATCH', 'auto')
+
+def batch_ecf_file(n):
+    """Create the ecf script of batch n from the template if it is not there"""
+    ecf_file = os.path.join(ECFPROJ_LIB, "share", "ecf", f"daily_sum_fc_sfc_batch{n}.ecf")
+    if not os.path.isfile(ecf_file):
+        print(f"Creating missing ecf script {ecf_file}")
+        with open(os.path.join(ECFPROJ_LIB, "share", "ecf", "daily_sum_fc_sfc_batch_template.ecf"), "r") as f:
+            template = f.read()
+        with open(ecf_file, "w") as f:
+            f.write(template.replace("REPLACEBATCHNUMBER", str(n)))
+
+def day_ranges(period):
+    """(day_beg, day_end) of each daily task of the period, ie 01-05, 06-10... with DAYS_PER_TASK=5"""
+    ndays = calendar.monthrange(int(period[:4]), int(period[4:6]))[1]
+    step = DAYS_PER_TASK or ndays
+    return [(f"{day:02d}", f"{min(day + step - 1, ndays):02d}") for day in range(1, ndays + 1, step)]
+
+def add_daily_tasks(run, name, tasks, period):
+    """
+    Add the daily tasks to run. With DAYS_PER_TASK they go in family name,
+    with one family for each range of days (so the days run in parallel and
+    only the failed ones run again). Return the trigger conditions for them
+    """
+    if not DAYS_PER_TASK:
+        for task in tasks:
+            run.add_task(task)
+        return [f"({task} == complete)" for task in tasks]
+    daily = run.add_family(name)
+    for day_beg, day_end in day_ranges(period):
+        days = daily.add_family(f"days_{day_beg}_{day_end}")
+        days.add_variable("DAY_BEG", day_beg)
+        days.add_variable("DAY_END", day_end)
+        for task in tasks:
+            days.add_task(task)
+    # the family is complete when all the days are
+    return [f"({name} == complete)"]
 
 # ecflow does not like dashes, so renaming streams here
 names_dict={"no-ar-cw":"west","no-ar-ce":"east","no-ar-pa":"pan_arctic"}
 
-def create_selective_daily_monthly_means(stream:str):
+def create_selective_daily_monthly_means(stream:str, period:str):
     """
     Create only the selected processing tasks based on user selection
     """
@@ -118,32 +161,33 @@ def create_selective_daily_monthly_means(stream:str):
     
     # Daily means for analysis files (if selected)
     if SELECTED_DAILY_MEANS_AN:
-        for ltype in ["hl","pl","sfc","ml"]:
-            t1 = run.add_task(f"daily_mean_an_insta_{ltype}")
-            created_daily_an_tasks.append(ltype)
+        created_daily_an_tasks = add_daily_tasks(run, "daily_means_an",
+                                                 [f"daily_mean_an_insta_{ltype}" for ltype in ["hl","pl","sfc","ml"]], period)
 
     # Daily means for forecast files (if selected)
     if SELECTED_DAILY_MEANS_FC:
-        t1 = run.add_task(f"daily_mean_fc_sfc")
+        add_daily_tasks(run, "daily_means_fc", ["daily_mean_fc_sfc"], period)
 
     # Daily min/max for forecast files (if selected)
     if SELECTED_DAILY_MINMAX:
         t1 = run.add_task(f"daily_minmax_fc_sfc")
 
-    # Daily sums (if selected)
+    # Daily sums (if selected), in batches of about the same runtime for this stream
     if SELECTED_DAILY_SUMS:
-        for i in range(0,NBATCH):
-            t1 = run.add_task(f"daily_sum_fc_sfc_batch{i+1}")
-            created_daily_sum_tasks.append(i+1)
+        batches = plan_batches(SPLIT_SUM_VARS, stream, NBATCH, PARAM_RUNTIMES)
+        for i, (seconds, chunks_sum) in enumerate(batches, start=1):
+            print(f"Adding {chunks_sum} to CARRA_PAR_FC_ACC_batch{i} of {this_stream} (about {seconds / 3600:.1f} h)")
+            run.add_variable(f"CARRA_PAR_FC_ACC_batch{i}", " ".join(chunks_sum))
+            batch_ecf_file(i)
+        created_daily_sum_tasks = add_daily_tasks(run, "daily_sums",
+                                                  [f"daily_sum_fc_sfc_batch{i}" for i in range(1, len(batches) + 1)], period)
 
     # Monthly means of analysis (if selected and daily means AN were created)
     if SELECTED_MONTHLY_MEANS_AN and created_daily_an_tasks:
         t1 = run.add_task(f"monthly_means_an_insta")
-        # Only add trigger if we have the required daily tasks
+        # Only add trigger if we have the required daily tasks (all the days)
         if len(created_daily_an_tasks) > 0:
-            mm = []
-            for ltype in created_daily_an_tasks:
-                mm.append(f"(daily_mean_an_insta_{ltype} == complete)")
+            mm = created_daily_an_tasks
             if len(mm) > 1:
                 long_rule = "(" + " and ".join(mm) + ")"
             else:
@@ -153,11 +197,9 @@ def create_selective_daily_monthly_means(stream:str):
     # Monthly means of daily sums (if selected and daily sums were created)
     if SELECTED_MONTHLY_SUMS and created_daily_sum_tasks:
         t1 = run.add_task("monthly_means_of_daily_sums")
-        # Only add trigger if we have the required daily sum tasks
+        # Only add trigger if we have the required daily sum tasks (all the days)
         if len(created_daily_sum_tasks) > 0:
-            mm = []
-            for bat in created_daily_sum_tasks:
-                mm.append(f"(daily_sum_fc_sfc_batch{bat} == complete)")
+            mm = created_daily_sum_tasks
             long_rule = "(" + " and ".join(mm) + ")"
             t1.add_trigger(long_rule)
 
@@ -189,11 +231,38 @@ def create_selective_daily_monthly_means(stream:str):
 
     return run
 
-# Create the families in the suite
-fs = suite.add_family(CARRA_PERIOD)
-for ecfproj_stream in ecfproj_streams:
-    print(f"Creating selective family for {ecfproj_stream}")
-    fs.add_family(create_selective_daily_monthly_means(ecfproj_stream))
+def next_period(period):
+    year, month = int(period[:4]), int(period[4:6])
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year}{month:02d}"
+
+def expand_periods(periods_spec):
+    """
+    List of (period, streams) from CARRA_PERIODS, in chronological order.
+    Each item is PERIOD, FIRST-LAST or any of them with :stream,stream
+    """
+    periods = {}
+    for item in periods_spec.split():
+        spec, _, streams = item.partition(":")
+        streams = streams.split(",") if streams else ecfproj_streams
+        first, _, last = spec.partition("-")
+        period = first
+        while True:
+            for stream in streams:
+                if stream not in periods.setdefault(period, []):
+                    periods[period].append(stream)
+            if not last or period >= last:
+                break
+            period = next_period(period)
+    return sorted(periods.items())
+
+# Create the families in the suite, one per period with its streams
+for period, period_streams in expand_periods(CARRA_PERIODS):
+    fs = suite.add_family(period)
+    fs.add_variable("CARRA_PERIOD", period)
+    for ecfproj_stream in period_streams:
+        print(f"Creating selective family for {ecfproj_stream} in {period}")
+        fs.add_family(create_selective_daily_monthly_means(ecfproj_stream, period))
 
 if __name__=="__main__":
     # Define a client object with the target ecFlow server
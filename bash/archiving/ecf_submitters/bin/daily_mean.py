@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Daily means of the 3-hourly analysis fields, as a replacement of
+#   $gmean -k time,step -i $gfile -o $mfile -n 8
+# All the fields of the day are done in one process: the messages are
+# grouped by (date, param, levtype, level) using the index of the input
+# files (see grib_index.py), and each group is averaged with a float64
+# running sum over its 8 analysis times. Only one group is in memory at a time.
+#
+# As with gmean, the output message of each group is a copy of its first
+# field (00 UTC) with the values replaced by the mean, so the headers
+# are the ones expected by grb_head_chng_daily_mean_an_rules before archiving.
+# The output messages are written in the order the groups appear in the input.
+#
+# If the output file name contains {param} one file per parameter is written,
+# as expected for the ML/PL/HL daily means (ie, daily_mean_..._20230101_{param}.grib2)
+#
+# With --monthly-state the daily means are also added to the running monthly
+# means (see monthly_state.py) straight from memory, in the same pass. The
+# monthly mean then does not need the daily files, so they can be written
+# directly merged in one file per day (fused mode, MEANS_ENGINE=fused)
+#
+# Examples:
+#   daily_mean.py -i no-ar-pa_an_sfc_20230101.grib2 -o daily_mean_no-ar-pa_an_sfc_20230101.grib2
+#   daily_mean.py -i no-ar-pa_an_ml_20230101.grib2 -o daily_mean_no-ar-pa_an_ml_20230101_{param}.grib2
+#   daily_mean.py -i no-ar-pa_an_ml_20230101.grib2 -o daily_mean_no-ar-pa_an_ml_20230101.grib2 --monthly-state STATE/an_ml
+
+import sys
+import argparse
+from contextlib import ExitStack
+import eccodes as ecc
+import numpy as np
+from grib_index import get_index
+from grib_reader import GribReader
+from monthly_state import ingest
+from grib_manifest import ManifestFile, handle_entry
+
+# the fields in each group only differ in time and step
+GROUP_KEYS = ["date", "param", "levtype", "level"]
+
+
+def group_entries(infiles):
+    """
+    Group the index entries of all infiles by GROUP_KEYS.
+    Return a dictionary {group key: [(infile, entry), ...]} in order of appearance
+    """
+    groups = {}
+    for infile in infiles:
+        for entry in get_index(infile):
+            key = tuple(entry[k] for k in GROUP_KEYS)
+            groups.setdefault(key, []).append((infile, entry))
+    return groups
+
+
+def mean_of_group(readers, group):
+    """
+    float64 mean of the fields in group and a clone of the first field
+    (earliest time and step) to use as template for the output
+    """
+    group = sorted(group, key=lambda item: (item[1]["time"], item[1]["step"]))
+    total = None
+    template = None
+    for infile, entry in group:
+        with readers[infile].message_at(entry).handle() as msg:
+            values = ecc.codes_get_values(msg)
+            if total is None:
+                total = np.array(values, dtype=np.float64)
+                template = ecc.codes_clone(msg)
+            else:
+                total += values
+    return total / len(group), template
+
+
+def daily_means(infiles, nexpected=8):
+    """
+    Generator with (group key, mean values, template handle) for each group
+    in infiles. The template handle must be released by the caller
+    """
+    groups = group_entries(infiles)
+    with ExitStack() as stack:
+        readers = {infile: stack.enter_context(GribReader(infile)) for infile in infiles}
+        for key, group in groups.items():
+            if nexpected and len(group) != nexpected:
+                raise ValueError(f"Expected {nexpected} fields for {dict(zip(GROUP_KEYS, key))}, found {len(group)}")
+            mean, template = mean_of_group(readers, group)
+            yield key, mean, template
+
+
+def write_mean(template, values, out):
+    """
+    Replace the values in template, write it to out (a ManifestFile) and release it.
+    Return the bytes of the message written
+    """
+    ecc.codes_set_values(template, values)
+    message = ecc.codes_get_message(template)
+    out.write(message, handle_entry(template))
+    ecc.codes_release(template)
+    return message
+
+
+def write_means(infiles, output, nexpected=8):
+    """
+    Write the daily means of infiles to output (one file per parameter if it
+    contains {param}). Generator with the fields written, in the format used
+    by monthly_state.ingest, so the monthly state can be fed in the same pass
+    """
+    per_param = "{param}" in output
+    outputs = {}
+    # the files are closed (and their manifests saved) at the end, if all went well
+    with ExitStack() as stack:
+        for order, (key, mean, template) in enumerate(daily_means(infiles, nexpected)):
+            group = dict(zip(GROUP_KEYS, key))
+            outfile = output.format(param=group["param"]) if per_param else output
+            if outfile not in outputs:
+                outputs[outfile] = stack.enter_context(ManifestFile(outfile))
+            message = write_mean(template, mean, outputs[outfile])
+            state_key = (group["param"], group["levtype"], group["level"])
+            yield state_key, mean, group["date"], message, order
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Daily means of 3-hourly GRIB fields (replaces gmean -k time,step)")
+    parser.add_argument("-i", "--input", action="append", required=True, help="Input GRIB file (can be repeated)")
+    parser.add_argument("-o", "--output", required=True, help="Output GRIB file. Use {param} for one file per parameter")
+    parser.add_argument("-n", "--nfields", type=int, default=8, help="Expected number of fields per mean (0 to skip the check)")
+    parser.add_argument("--monthly-state", help="Also add the daily means to this monthly state directory (see monthly_state.py)")
+    args = parser.parse_args()
+
+    fields = write_means(args.input, args.output, args.nfields)
+    try:
+        if args.monthly_state:
+            # only the sums, the min and max of the daily means are not used
+            nmeans = ingest(args.monthly_state, fields, minmax=False)
+            print(f"Added {nmeans} daily means to {args.monthly_state}")
+        else:
+            nmeans = sum(1 for _ in fields)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Wrote {nmeans} daily means to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,11 @@ else
   origin=$2
   day_beg=$3
   day_end=$4
+  if [[ -n $5 ]]; then
+    #only one parameter (used by unit_scheduler.py)
+    param=$5
+    all_params=($5)
+  fi
   #If I give two extra arguments it will set the initial and final of the month
   #Otherwise it will do the whole month. This is just for testing
   YYYY=$(substring $period 1 4) #substring is parf ot the eclib tools
@@ -75,10 +80,46 @@ alldates="$date_beg/TO/$date_end"
 #param="all"
 echo "Doing mars staging for the period $date_beg to $date_end"
 com="origin=$origin,expver=$expver,class=$class,stream=$stream,type=$type,step=$step,levtype=$levtype,levelist=$levelist,param=$param"
+#SKIP_STAGE=1 when the staging was already done for all the days and
+#STAGE_ONLY=1 to do only the staging (see unit_scheduler.py)
+if [[ -z $SKIP_STAGE ]]; then
  mars << eof
      stage, $com, date=$alldates,time=0000/0300/0600/0900/1200/1500/1800/2100
 eof
-
+fi
+[[ -n $STAGE_ONLY ]] && exit 0
+
+#With MEANS_ENGINE=python the loop over parameters below is replaced by
+#one retrieval and one python process per day for all the parameters (see daily_mean.py)
+#With MEANS_ENGINE=fused the same pass also updates the monthly means, and the
+#daily means are written directly in one file per day (no merging needed later)
+if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+ml conda
+conda activate glat #python with eccodes and numpy
+STATE=$MEANS_OUTPUT/$origin/$YYYY/$MM/STATE/${type}_${levtype} #running monthly means (see monthly_state.py)
+echo "Doing mars retrieval and means calculation with daily_mean.py for the period $date_beg to $date_end"
+for date in $(seq -w $date_beg $date_end); do
+    gfile=$WDIR/${origin}_${type}_${levtype}_${date}${5:+_$5}.grib2
+     com="origin=$origin,expver=$expver,class=$class,stream=$stream,type=$type,step=$step,levtype=$levtype,levelist=$levelist,param=$param"
+     mars << eof
+     retrieve, $com, date=$date,time=0/to/21/by/3,target="$gfile"
+eof
+  if [[ $MEANS_ENGINE == fused ]]; then
+  mfile=$MEANS_OUTPUT/$origin/$YYYY/$MM/daily_mean_${origin}_${type}_${levtype}_${date}.grib2
+  python ${ECFPROJ_LIB}/bin/daily_mean.py -i $gfile -o $mfile -n 8 --monthly-state $STATE || exit 1
+  #a plain chmod makes its manifest and index out of date (see grib_manifest.py)
+  python ${ECFPROJ_LIB}/bin/grib_manifest.py --chmod 755 $mfile || exit 1
+  else
+  #one output file per parameter, as done by the loop below
+  python ${ECFPROJ_LIB}/bin/daily_mean.py -i $gfile -o $WDIR/daily_mean_${origin}_${type}_${levtype}_${date}_{param}.grib2 -n 8 || exit 1
+  python ${ECFPROJ_LIB}/bin/grib_manifest.py --chmod 755 $WDIR/daily_mean_${origin}_${type}_${levtype}_${date}_*.grib2 || exit 1
+  for mfile in $WDIR/daily_mean_${origin}_${type}_${levtype}_${date}_*.grib2; do
+    python ${ECFPROJ_LIB}/bin/monthly_state.py update -s $STATE -i $mfile || exit 1
+  done
+  fi
+  rm -f $gfile ${gfile}.idx
+done #date
+else
 echo "Doing mars retrieval and means calculation for the period $date_beg to $date_end"
 for date in $(seq -w $date_beg $date_end); do
 for param in "${all_params[@]}"; do
@@ -99,8 +140,16 @@ eof
 
 done #param
 done #date
+fi #MEANS_ENGINE
 
-#remove the temporary files
-rm -f $WDIR/${origin}_${type}_${levtype}_*.grib2
+#remove the temporary input files of this run only, other dates
+#or parameters may be running at the same time (see unit_scheduler.py)
+for date in $(seq -w $date_beg $date_end); do
+for param in "${all_params[@]}"; do
+  rm -f $WDIR/${origin}_${type}_${levtype}_${date}_${param}.grib2
+done
+done
 echo "Changing the permissions"
-chmod 755 -R $MEANS_OUTPUT/$origin/$YYYY/$MM
+#the GRIB files with grib_manifest.py, so their manifests and indexes stay valid
+find $MEANS_OUTPUT/$origin/$YYYY/$MM ! -name "*.grib2" -exec chmod 755 {} +
+find $MEANS_OUTPUT/$origin/$YYYY/$MM -name "*.grib2" -exec python ${ECFPROJ_LIB}/bin/grib_manifest.py --chmod 755 {} +
@@ -67,10 +67,22 @@ alldates="$date_beg/TO/$date_end"
 #param="all"
 echo "Doing mars staging for the period $date_beg to $date_end"
 com="origin=$origin,expver=$expver,class=$class,stream=$stream,type=$type,step=$step,levtype=$levtype,levelist=$levelist,param=$param"
+#SKIP_STAGE=1 when the staging was already done for all the days and
+#STAGE_ONLY=1 to do only the staging (see unit_scheduler.py)
+if [[ -z $SKIP_STAGE ]]; then
  mars << eof
      stage, $com, date=$alldates,time=0000/0300/0600/0900/1200/1500/1800/2100
 eof
+fi
+[[ -n $STAGE_ONLY ]] && exit 0
 
+#With MEANS_ENGINE=python the means are calculated with daily_mean.py instead of gmean
+#With MEANS_ENGINE=fused daily_mean.py also updates the monthly means in the same pass
+if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+ml conda
+conda activate glat #python with eccodes and numpy
+STATE=$MEANS_OUTPUT/$origin/$YYYY/$MM/STATE/${type}_${levtype} #running monthly means (see monthly_state.py)
+fi
 echo "Doing mars retrieval and means calculation for the period $date_beg to $date_end"
 for date in $(seq -w $date_beg $date_end); do
     #1. pull the data
@@ -85,14 +97,31 @@ eof
   base=$(basename $gfile)
   mfile=$WDIR/daily_mean_${base}
   #$gmean -k date,time -i $gfile -o $mfile -s date=$date,time=00,step=24 -n 8
-  $gmean -k time,step -i $gfile -o $mfile -n 8
+  if [[ ${MEANS_ENGINE:-gmean} == python ]]; then
+    python ${ECFPROJ_LIB}/bin/daily_mean.py -i $gfile -o $mfile -n 8 || exit 1
+    python ${ECFPROJ_LIB}/bin/monthly_state.py update -s $STATE -i $mfile || exit 1
+  elif [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+    python ${ECFPROJ_LIB}/bin/daily_mean.py -i $gfile -o $mfile -n 8 --monthly-state $STATE || exit 1
+  else
+    $gmean -k time,step -i $gfile -o $mfile -n 8
+    chmod 755 $mfile
+  fi
   #ls -lh $mfile $gfile
-  chmod 755 $mfile
 
 done
-#remove the temporary input files
-rm -f $WDIR/${origin}_${type}_${levtype}_*.grib2
-
-#move the daily means to the main path
-mv $WDIR/daily_mean*grib2 $MEANS_OUTPUT/$origin/$YYYY/$MM/
-rmdir $WDIR
+#remove the temporary input files and move the daily means to the main path.
+#Only the dates of this run, other dates may be running at the same time (see unit_scheduler.py)
+for date in $(seq -w $date_beg $date_end); do
+  rm -f $WDIR/${origin}_${type}_${levtype}_${date}.grib2 $WDIR/${origin}_${type}_${levtype}_${date}.grib2.idx
+  if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+    #with its manifest and index, so they are not left in $WDIR. The chmod is done
+    #here too, a plain chmod makes them out of date (see grib_manifest.py)
+    python ${ECFPROJ_LIB}/bin/grib_manifest.py --chmod 755 --move $MEANS_OUTPUT/$origin/$YYYY/$MM/ $WDIR/daily_mean_${origin}_${type}_${levtype}_${date}.grib2 || exit 1
+  else
+    mv $WDIR/daily_mean_${origin}_${type}_${levtype}_${date}.grib2 $MEANS_OUTPUT/$origin/$YYYY/$MM/
+  fi
+done
+#with an if, so a range of days does not end the script with an error
+if [[ $day_beg == 01 ]] && [[ $day_end == $MAXDAY ]]; then
+  rmdir $WDIR
+fi
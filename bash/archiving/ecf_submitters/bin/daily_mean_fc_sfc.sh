@@ -93,6 +93,9 @@ eof
     $gmean -k date,time -i $gfile -o $mfile -n 8
     chmod 755 $mfile
 done
-#remove the temporary input files
-rm -f $WDIR/${origin}_${type}_${levtype}_*.grib2
+#remove the temporary input files.
+#Only the dates of this run, other days may be running at the same time (DAYS_PER_TASK in create_suite.py)
+for date in $(seq -w $date_beg $date_end); do
+  rm -f $WDIR/${origin}_${type}_${levtype}_${date}.grib2
+done
 
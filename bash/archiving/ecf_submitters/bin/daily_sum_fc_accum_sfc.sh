@@ -67,6 +67,24 @@ fi
 
 WDIR=$MEANS_OUTPUT/$origin/$YYYY/$MM/SUMS ; [[ ! -d $WDIR ]] && mkdir -p $WDIR
 
+#With MEANS_ENGINE=python each daily sum is also added to the running
+#monthly means (see monthly_state.py), used by monthly_means_of_daily_sums.sh
+if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+ml conda
+conda activate glat #python with eccodes and numpy
+STATE=$MEANS_OUTPUT/$origin/$YYYY/$MM/STATE/${type}_${levtype}
+fi
+
+update_state()
+{
+if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+  #use the day of the sum, the date in the headers of the computed field may be the previous day
+  python ${ECFPROJ_LIB}/bin/monthly_state.py update -s $STATE -i $gfile -d $date || exit 1
+  #the sum is written by mars compute, so its manifest is done here (see grib_manifest.py)
+  python ${ECFPROJ_LIB}/bin/grib_manifest.py $gfile
+fi
+}
+
 #get the date of yesterday for the start of the period
 date_end=${period}${day_end}
 date_beg=${period}${day_beg}
@@ -77,9 +95,14 @@ alldates="$date_ydat/TO/$date_end"
 #param="all"
 echo "Doing mars staging for the period $date_beg to $date_end"
 com="origin=$origin,expver=$expver,class=$class,stream=$stream,type=$type,step=$step,levtype=$levtype,param=$params"
+#SKIP_STAGE=1 when the staging was already done for all the days and
+#STAGE_ONLY=1 to do only the staging (see unit_scheduler.py)
+if [[ -z $SKIP_STAGE ]]; then
  mars << eof
      stage, $com, date=$alldates,time=0000/0300/0600/0900/1200/1500/1800/2100
 eof
+fi
+[[ -n $STAGE_ONLY ]] && exit 0
 
 
 
@@ -121,6 +144,7 @@ eof
      fi
 
     chmod 755 $gfile
+    update_state
 done #day
 
 done #parameter
@@ -157,6 +181,7 @@ eof
      fi
 
     chmod 755 $gfile
+    update_state
 done #day
 }
 
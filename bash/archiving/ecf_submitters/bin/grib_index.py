@@ -0,0 +1,118 @@
+# Persistent index of the messages in a GRIB file
+#
+# The byte offset, length and a few header keys of each message are stored
+# in a sidecar file next to the GRIB file (FILE.idx, in json format).
+# The tools in this directory (and archive_to_mars.py) use it to seek
+# straight to the messages they need instead of decoding the whole file.
+# The index is built reading only the headers of the messages, from the
+# memory mapped file (see grib_reader.py). The size, modification and
+# change times and inode of the GRIB file are saved in the sidecar, so an
+# index for a file that has changed since (also rewritten with the same
+# size, or replaced by a copy with cp -p) is detected and built again.
+
+import os
+import json
+import eccodes as ecc
+from grib_reader import GribReader
+
+IDX_SUFFIX = ".idx"
+IDX_VERSION = 2
+# keys saved for each message, together with offset and length
+IDX_KEYS = ["param", "date", "time", "step", "level", "levtype"]
+
+
+def sidecar_path(grib_file):
+    """Path of the index file for grib_file"""
+    return grib_file + IDX_SUFFIX
+
+
+def file_signature(grib_file):
+    """Size, times and inode, used to detect changes in grib_file"""
+    st = os.stat(grib_file)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ctime_ns": st.st_ctime_ns, "ino": st.st_ino}
+
+
+def message_entry(msg, offset, length):
+    """Offset, length and the IDX_KEYS of one eccodes handle"""
+    return {
+        "offset": offset,
+        "length": length,
+        "param": ecc.codes_get_long(msg, "param"),
+        "date": ecc.codes_get_long(msg, "date"),
+        "time": ecc.codes_get_long(msg, "time"),
+        "step": ecc.codes_get_string(msg, "stepRange"),
+        "level": ecc.codes_get_long(msg, "level"),
+        "levtype": ecc.codes_get_string(msg, "levtype"),
+    }
+
+
+def build_index(grib_file):
+    """Scan grib_file reading only the headers and return the list of entries"""
+    entries = []
+    with GribReader(grib_file) as reader:
+        for message in reader:
+            with message.handle(headers_only=True) as msg:
+                entries.append(message_entry(msg, message.offset, message.length))
+    return entries
+
+
+def write_index(grib_file, entries):
+    """Save entries in the sidecar file of grib_file"""
+    idx = {"version": IDX_VERSION, **file_signature(grib_file), "messages": entries}
+    tmp_file = sidecar_path(grib_file) + ".tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(idx, f)
+        os.replace(tmp_file, sidecar_path(grib_file))
+    except OSError as e:
+        # ie, no write permission in the data directory. The index is still usable
+        print(f"WARNING: could not write index for {grib_file}: {e}")
+
+
+def read_index(grib_file):
+    """Return the saved entries, or None if the sidecar is missing or out of date"""
+    try:
+        with open(sidecar_path(grib_file), "r") as f:
+            idx = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if idx.get("version") != IDX_VERSION:
+        return None
+    signature = file_signature(grib_file)
+    if any(idx.get(key) != value for key, value in signature.items()):
+        print(f"Index for {grib_file} is out of date")
+        return None
+    return idx["messages"]
+
+
+def get_index(grib_file, save=True):
+    """Return the index entries of grib_file, building the sidecar if needed"""
+    entries = read_index(grib_file)
+    if entries is None:
+        entries = build_index(grib_file)
+        if save:
+            write_index(grib_file, entries)
+    return entries
+
+
+def select(entries, **keys):
+    """
+    Return the entries matching all the given keys. A key can be
+    a single value or a list/set of accepted values, ie select(idx, param=[201,202])
+    """
+    selected = []
+    for entry in entries:
+        for key, value in keys.items():
+            if isinstance(value, (list, tuple, set)):
+                if entry[key] not in value:
+                    break
+            elif entry[key] != value:
+                break
+        else:
+            selected.append(entry)
+    return selected
+
+
+def sorted_levels(entries):
+    """Sorted list of the unique levels in entries"""
+    return sorted(set(entry["level"] for entry in entries))
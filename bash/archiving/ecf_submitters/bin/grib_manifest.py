@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# Manifest of the contents of a GRIB file, written by the program producing it
+#
+# The manifest is a small json file next to the GRIB file (FILE.manifest.json)
+# with the number of messages, the params, levels, level types and dates in
+# the file and a sha256 checksum of its contents. The producers know all this
+# while writing the file, so archive_to_mars.py does not need to read the
+# data again to get the levelist and expect count of the archive requests.
+# Like the index (see grib_index.py), the signature of the GRIB file (size,
+# modification and change times, inode) is saved, so a manifest for a file
+# that changed is ignored. A chmod also changes the change time, so the
+# permissions of files with a manifest are changed with --chmod (below).
+#
+# In the python tools the output file is written through ManifestFile:
+#
+#   with ManifestFile(outfile) as out:
+#       out.write_handle(msg)                  # eccodes handle
+#       out.write(message.data, entry)         # raw message and its index entry
+#
+# For files produced by other tools (gmean, mars compute, cat...) the
+# manifest can be written afterwards from the command line (this reads the file):
+#
+#   grib_manifest.py daily_sum_no-ar-pa_fc_sfc_20230101_228228.grib2
+#
+# Files with a manifest or index are moved with them, so these still
+# describe the file next to them:
+#
+#   grib_manifest.py --move $MEANS_OUTPUT/no-ar-pa/2023/01/ SFC/daily_mean_no-ar-pa_an_sfc_20230101.grib2
+#
+# and their permissions changed keeping them valid (with or without --move):
+#
+#   grib_manifest.py --chmod 755 daily_mean_no-ar-pa_an_ml_20230101.grib2
+
+import os
+import sys
+import json
+import stat
+import shutil
+import hashlib
+import argparse
+import eccodes as ecc
+from grib_index import build_index, file_signature, read_index, write_index, IDX_SUFFIX
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+
+
+def manifest_path(grib_file):
+    """Path of the manifest of grib_file"""
+    return grib_file + MANIFEST_SUFFIX
+
+
+def summarise(entries, checksum):
+    """Manifest contents from the index entries (or any dicts with the same keys) of a file"""
+    return {
+        "count": len(entries),
+        "params": sorted(set(entry["param"] for entry in entries)),
+        "levels": sorted(set(entry["level"] for entry in entries)),
+        "levtypes": sorted(set(entry["levtype"] for entry in entries)),
+        "dates": sorted(set(entry["date"] for entry in entries)),
+        "checksum": f"sha256:{checksum}",
+    }
+
+
+def save_manifest(grib_file, contents, producer=None):
+    """Write the manifest of grib_file, adding its current signature"""
+    manifest = {"version": MANIFEST_VERSION, **file_signature(grib_file), **contents}
+    if producer is not None:
+        manifest["producer"] = producer
+    tmp_file = manifest_path(grib_file) + ".tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, manifest_path(grib_file))
+    except OSError as e:
+        print(f"WARNING: could not write manifest for {grib_file}: {e}")
+
+
+def read_manifest(grib_file):
+    """Return the manifest of grib_file, or None if it is missing or out of date"""
+    try:
+        with open(manifest_path(grib_file), "r") as f:
+            manifest = json.load(f)
+        signature = file_signature(grib_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    if any(manifest.get(key) != value for key, value in signature.items()):
+        print(f"Manifest for {grib_file} is out of date")
+        return None
+    return manifest
+
+
+def handle_entry(msg):
+    """The keys of the manifest for an eccodes handle"""
+    return {
+        "param": ecc.codes_get_long(msg, "param"),
+        "level": ecc.codes_get_long(msg, "level"),
+        "levtype": ecc.codes_get_string(msg, "levtype"),
+        "date": ecc.codes_get_long(msg, "date"),
+    }
+
+
+class ManifestFile:
+    """
+    GRIB output file that collects its manifest while it is written.
+    The manifest is saved when leaving the with block, unless defer=True
+    (ie, when the file is written to a temporary name and renamed later,
+    in that case call save() with the final name after renaming)
+    """
+
+    def __init__(self, grib_file, producer=None, defer=False):
+        self.grib_file = grib_file
+        self.producer = producer or os.path.basename(sys.argv[0])
+        self.defer = defer
+        self.entries = []
+        self._sha = hashlib.sha256()
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.grib_file, "wb")
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self._file.close()
+        if exc_type is None and not self.defer:
+            self.save()
+        return False
+
+    def write(self, data, entry):
+        """Write the raw bytes of a message. entry has its param, level, levtype and date"""
+        self._file.write(data)
+        self._sha.update(data)
+        self.entries.append(entry)
+
+    def write_handle(self, msg):
+        """Write the message of an eccodes handle"""
+        self.write(ecc.codes_get_message(msg), handle_entry(msg))
+
+    def save(self, grib_file=None):
+        """Save the manifest for grib_file (default, the file written)"""
+        save_manifest(grib_file or self.grib_file, summarise(self.entries, self._sha.hexdigest()), self.producer)
+
+
+def file_checksum(grib_file, chunk_size=64 * 1024**2):
+    """sha256 of the contents of grib_file"""
+    sha = hashlib.sha256()
+    with open(grib_file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def build_manifest(grib_file, producer=None):
+    """Read grib_file and write its manifest"""
+    save_manifest(grib_file, summarise(build_index(grib_file), file_checksum(grib_file)), producer)
+
+
+def update_grib(grib_file, destination, change):
+    """
+    Call change() (a move of grib_file to destination, or a chmod) and save
+    again the manifest and index of grib_file for destination, if they were
+    valid before the change
+    """
+    manifest = read_manifest(grib_file)
+    entries = read_index(grib_file)
+    change()
+    for suffix in (MANIFEST_SUFFIX, IDX_SUFFIX):
+        for path in (grib_file + suffix, destination + suffix):
+            if os.path.exists(path):
+                os.remove(path)
+    # saved again, since the file has another change time (and maybe inode)
+    if manifest is not None:
+        signature = file_signature(destination)
+        contents = {key: value for key, value in manifest.items()
+                    if key not in signature and key not in ("version", "producer")}
+        save_manifest(destination, contents, manifest.get("producer"))
+    if entries is not None:
+        write_index(destination, entries)
+
+
+def move_grib(grib_file, destination):
+    """
+    Move grib_file to destination (a file or a directory) with its manifest
+    and index. Return the new path
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(grib_file))
+    update_grib(grib_file, destination, lambda: shutil.move(grib_file, destination))
+    return destination
+
+
+def chmod_grib(grib_file, mode):
+    """Change the permissions of grib_file (if needed), keeping its manifest and index"""
+    if stat.S_IMODE(os.stat(grib_file).st_mode) != mode:
+        update_grib(grib_file, grib_file, lambda: os.chmod(grib_file, mode))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the manifest of GRIB files, or move them with it")
+    parser.add_argument("grib_files", nargs="+", metavar="GRIB_FILE")
+    parser.add_argument("--move", metavar="DEST",
+                        help="Move the files to DEST (a directory, or the new name of one file) with their manifest and index")
+    parser.add_argument("--chmod", metavar="MODE", type=lambda mode: int(mode, 8),
+                        help="Change the permissions of the files (octal, ie 755) keeping their manifest and index")
+    args = parser.parse_args()
+    for grib_file in args.grib_files:
+        if args.move or args.chmod is not None:
+            if args.move:
+                destination = move_grib(grib_file, args.move)
+                print(f"Moved {grib_file} to {destination}")
+                grib_file = destination
+            if args.chmod is not None:
+                chmod_grib(grib_file, args.chmod)
+        else:
+            build_manifest(grib_file, producer="grib_manifest.py")
+            print(f"Wrote {manifest_path(grib_file)}")
+
+
+if __name__ == "__main__":
+    main()
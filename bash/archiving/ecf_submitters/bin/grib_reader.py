@@ -0,0 +1,117 @@
+# mmap based reader for GRIB files
+#
+# The file is memory mapped once and each message is returned as a view
+# (a memoryview slice of the map, no copy and no read syscall per message).
+# An eccodes handle is only created from the view when a key or the values
+# are needed, and it is released automatically when leaving the with block:
+#
+#   with GribReader(infile) as reader:
+#       for message in reader:
+#           with message.handle() as msg:
+#               values = ecc.codes_get_values(msg)
+#
+# The raw bytes of a message (message.data) can also be written directly
+# to another file, which avoids decoding and re-encoding untouched fields.
+# Note eccodes keeps its own copy of the message while the handle is alive.
+
+import mmap
+from contextlib import contextmanager
+import eccodes as ecc
+
+GRIB_START = b"GRIB"
+GRIB_END = b"7777"
+
+
+class GribMessage:
+    """View of one message in a memory mapped GRIB file"""
+
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+        self.length = len(data)
+
+    @contextmanager
+    def handle(self, headers_only=False):
+        """eccodes handle for this message, released when leaving the with block"""
+        msg = ecc.codes_new_from_message(self.data, partial=headers_only)
+        try:
+            yield msg
+        finally:
+            ecc.codes_release(msg)
+
+    def write(self, f):
+        """Write the raw bytes of the message to the open file f"""
+        f.write(self.data)
+
+
+class GribReader:
+    """Memory mapped GRIB file. Use it as a context manager"""
+
+    def __init__(self, grib_file):
+        self.grib_file = grib_file
+        self._file = None
+        self._map = None
+        self._view = None
+        self._messages = []
+
+    def __enter__(self):
+        self._file = open(self.grib_file, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        except ValueError:
+            # empty file, nothing to map
+            self._map = None
+            self._view = memoryview(b"")
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        # all the views must be released before the map can be closed
+        for message in self._messages:
+            message.data.release()
+        self._messages = []
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _message(self, offset, length):
+        message = GribMessage(self._view[offset:offset + length], offset)
+        self._messages.append(message)
+        return message
+
+    def message_at(self, entry):
+        """View of the message described by an index entry (see grib_index.py)"""
+        return self._message(entry["offset"], entry["length"])
+
+    def __iter__(self):
+        """Scan the map for messages, using the length coded in section 0"""
+        size = len(self._view)
+        pos = 0
+        while True:
+            pos = self._map.find(GRIB_START, pos) if self._map is not None else -1
+            if pos < 0 or pos + 16 > size:
+                return
+            edition = self._view[pos + 7]
+            if edition == 2:
+                length = int.from_bytes(self._view[pos + 8:pos + 16], "big")
+            elif edition == 1:
+                length = int.from_bytes(self._view[pos + 4:pos + 7], "big")
+            else:
+                length = 0
+            end = pos + length
+            if length < 16 or end > size or self._view[end - 4:end] != GRIB_END:
+                # not a complete message, keep looking after this GRIB string
+                pos += len(GRIB_START)
+                continue
+            yield self._message(pos, length)
+            pos = end
@@ -0,0 +1,81 @@
+# Streaming min/max reduction of one or more parameters over all the messages
+# of a GRIB file. Used by calc_daily_minmax.py and calc_monthly_minmax.py
+#
+# Only one grid per parameter is kept in memory (the running accumulator),
+# whatever the number of hours or days in the input file. The template for
+# each output message is cloned during the same pass, so each file is read
+# only once, also when several parameters are reduced together.
+
+import eccodes as ecc
+import numpy as np
+from grib_index import get_index, select
+from grib_reader import GribReader
+from grib_manifest import ManifestFile
+
+#max_params=[201,260646,260647] #the rest are min
+max_params=[201,228029] #the rest are min. Only 201, 202 and 228029 present in CARRA2
+
+
+def parse_param_rules(param_string):
+    """
+    Parse a list of parameters like 201/202/228029 into an ordered
+    dictionary {param: use_max}. The rule for each parameter can be
+    given explicitly (ie, 201:max/202:min), otherwise max_params decides
+    """
+    rules = {}
+    for item in param_string.replace(",", "/").split("/"):
+        item = item.strip()
+        if not item:
+            continue
+        if ":" in item:
+            param, rule = item.split(":", 1)
+            if rule not in ["max", "min"]:
+                raise ValueError(f"Unknown rule {rule} for {param}. Use max or min")
+            rules[int(param)] = rule == "max"
+        else:
+            rules[int(item)] = int(item) in max_params
+    return rules
+
+
+def reduce_minmax_multi(infile, rules, key_label="date"):
+    """
+    Reduce all the parameters in rules ({param: use_max}) in one scan of infile.
+    Return three dictionaries indexed by param: the reduced values,
+    a clone of the first matching message (to be used as output template)
+    and the number of messages found.
+    The messages are located with the index of infile (see grib_index.py),
+    so only the selected parameters are read (from the memory mapped file,
+    see grib_reader.py) and decoded.
+    Each eccodes handle is released as soon as it has been used.
+    """
+    accum = {}
+    templates = {}
+    nfound = {param: 0 for param in rules}
+    entries = select(get_index(infile), param=list(rules))
+    with GribReader(infile) as reader:
+        for entry in entries:
+            param = entry["param"]
+            print(f"Found key {param} and input for {entry[key_label]}")
+            with reader.message_at(entry).handle() as msg:
+                values = ecc.codes_get_values(msg)
+                if param not in accum:
+                    accum[param] = values
+                    templates[param] = ecc.codes_clone(msg)
+                elif rules[param]:
+                    np.maximum(accum[param], values, out=accum[param])
+                else:
+                    np.minimum(accum[param], values, out=accum[param])
+                nfound[param] += 1
+    return accum, templates, nfound
+
+
+def write_reduced_multi(templates, accum, outfile, params):
+    """
+    Write the reduced values of params, in that order, to one output file
+    (and its manifest, see grib_manifest.py)
+    """
+    with ManifestFile(outfile) as out:
+        for param in params:
+            ecc.codes_set_values(templates[param], accum[param])
+            out.write_handle(templates[param])
+            ecc.codes_release(templates[param])
@@ -20,6 +20,10 @@ fi
 
 ml ecmwf-toolbox #eccodes and the like
 ml eclib # includes scripts like newdata to get correct dates, including leap years
+if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+ml conda
+conda activate glat #python with eccodes and numpy, for monthly_state.py
+fi
 
 NF_EXP=715 #expected number of fields in monthly or daily file. Pre calculated for ML ONLY. TODO for the rest?
 
@@ -44,6 +48,37 @@ type=an
 #############################################
 #monthly mean for instantaneous parameters
 #############################################
+
+#With MEANS_ENGINE=python (or fused) the daily scripts keep running monthly means
+#in $WDIR/STATE (see monthly_state.py). If all the days are in, the monthly
+#mean is written from there instead of reading all the daily files with gmean
+export_state()
+{
+[[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]] || return 1
+local STATE=$WDIR/STATE/${type}_${levtype}
+[[ -d $STATE ]] || return 1
+echo "Exporting monthly mean from $STATE"
+python ${ECFPROJ_LIB}/bin/monthly_state.py export -s $STATE -o $OUT -n $MAXDAY ${1:+-p $1}
+}
+
+#With MEANS_ENGINE=fused the daily means are already merged in one file per day
+#and the monthly means are in the state, so the monthly mean of all the
+#parameters is written straight to the merged file. Nothing is read again
+do_monthly_fused()
+{
+for date in $(seq -w $date_beg $date_end); do
+  IN=$WDIR/daily_mean_${origin}_${type}_${levtype}_${date}.grib2
+  if [ ! -f $IN ]; then
+    echo "ERROR: data stream incomplete! Date $date is missing: $IN"
+    exit 1
+  fi
+done
+OUT=$WDIR/monthly_mean_${origin}_${type}_${levtype}_${period}.grib2
+export_state ${PARAMS// //} || exit 1
+#a plain chmod makes its manifest out of date (see grib_manifest.py)
+python ${ECFPROJ_LIB}/bin/grib_manifest.py --chmod 755 $OUT || exit 1
+}
+
 do_monthly_means()
 {
 LEVTYPE=${levtype^^} #capitalize for path
@@ -62,8 +97,12 @@ for param in ${PARAMS[@]}; do
    counts_files+=($(grib_count $IN))
  done
  OUT=$DATADIR/monthly_mean_${origin}_${type}_${param}_${levtype}_$period.grib2
+ if export_state $param; then
+ python ${ECFPROJ_LIB}/bin/grib_manifest.py --chmod 755 $OUT || exit 1
+ else
  $gmean -k date ${input_files[@]} -o $OUT  -n $MAXDAY
  chmod 755 $OUT
+ fi
  #check number of fields:
  final_count=$(grib_count $OUT)
  echo "Final count of parameters in $OUT: $final_count"
@@ -128,7 +167,9 @@ echo "Doing monthly means for analysis instantaneous parameters of type $levtype
    input_files+=("-i $IN") # this creates the whole string for all the input files
  done
  OUT=$WDIR/monthly_mean_${origin}_${type}_${levtype}_$period.grib2
+ if ! export_state; then
  $gmean -k date ${input_files[@]} -o $OUT  -n $MAXDAY
+ fi
  # move the daily means to the main directory?
  # mv $DATADIR/daily_mean_${origin}_${type}_${levtype}_* $WDIR
  # rmdir $DATADIR
@@ -172,6 +213,13 @@ if [ -n "$CARRA_PAR_AN_PL" ]; then
   active_levtypes+=(pl)
 fi
 
+if [[ $MEANS_ENGINE == fused ]]; then
+for levtype in "${active_levtypes[@]}"; do
+echo "Doing monthly means for all parameters of leveltype $levtype from the monthly state"
+PARAMS=${par_dic[$levtype]}
+do_monthly_fused
+done
+else
 #calculate the monthly means on each separate in the correspoding paths under $MEANS_OUTPUT/$origin/$YYYY/$MM/PL,ML and HL
 for levtype in "${active_levtypes[@]}"; do
 echo "Doing monthly means for all parameters of leveltype $levtype"
@@ -185,6 +233,7 @@ echo "Doing merging of monthly means for all parameters of leveltype $levtype"
 PARAMS=${par_dic[$levtype]}
 merge_files
 done
+fi #MEANS_ENGINE
 
 
 # for monthly means of sfc type use the function below
@@ -19,6 +19,10 @@ fi
 
 ml ecmwf-toolbox #eccodes and the like
 ml eclib # includes scripts like newdata to get correct dates, including leap years
+if [[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]]; then
+ml conda
+conda activate glat #python with eccodes and numpy, for monthly_state.py
+fi
 
 
 if [[ -z $1 ]]; then
@@ -75,6 +79,18 @@ echo "Merging the daily sums"
 
 }
 
+#With MEANS_ENGINE=python daily_sum_fc_accum_sfc.sh keeps running monthly means
+#in STATE (see monthly_state.py). If all the days are in, the monthly
+#mean is written from there instead of reading all the daily sums with gmean
+export_state()
+{
+[[ ${MEANS_ENGINE:-gmean} == python ]] || [[ ${MEANS_ENGINE:-gmean} == fused ]] || return 1
+local STATE=$MEANS_OUTPUT/$origin/$YYYY/$MM/STATE/${type}_${levtype}
+[[ -d $STATE ]] || return 1
+echo "Exporting monthly mean from $STATE"
+python ${ECFPROJ_LIB}/bin/monthly_state.py export -s $STATE -o $OUT -n $MAXDAY ${1:+-p $1}
+}
+
 do_monthly_fc_accum()
 {
 for param in ${PARAMS[@]}; do
@@ -89,7 +105,9 @@ echo "Doing monthly means for accumulated $type $param"
    input_files+=("-i $IN") # this creates the whole string for all the input files
  done #date
  OUT=$WDIR/monthly_mean_accum_${origin}_${type}_${levtype}_${period}_${param}.grib2
+ if ! export_state $param; then
  $gmean -k date ${input_files[@]} -o $OUT  -n $MAXDAY
+ fi
 done #param
 }
 
@@ -24,6 +24,7 @@ ml eclib # includes scripts like newdata to get correct dates, including leap ye
 # Maximum temperature at 2 metres since previous post-processing  mx2t        201        
 # Minimum temperature at 2 metres since previous post-processing  mn2t        202        
 # 10 metre wind gust since previous post-processing               10fg        49
+# 10 metre wind gust (CARRA2)                                     10fg        228029
 # 10 metre eastward wind gust since previous post-processing  10efg       260646     
 # 10 metre northward wind gust since previous post-processing  10nfg       260647     
 # --------------------------------------------------------------------------------
@@ -39,9 +40,11 @@ ml eclib # includes scripts like newdata to get correct dates, including leap ye
 
 # These parameters require taking the max. The remaining parameter, 202, uses the min
 # This list is used below to decide if using min or max in the calculation
-max_param=(49 201 260646 260647)
+max_param=(49 201 228029 260646 260647)
 all_permitted=(49 201 202 260646 260647)
-all_permitted=(201 202) #for CARRA2
+#for CARRA2 the params of the daily minmax files (CARRA_PAR_FC_SFC_MM, from the config),
+#all reduced in the same scan of the month
+IFS=/ read -ra all_permitted <<< "${CARRA_PAR_FC_SFC_MM:-228029/201/202}"
 type=fc
 levtype=sfc
 declare -A levtype_int
@@ -148,17 +151,14 @@ else
     echo "$tmpfile already created"
 fi
 
-input_files=()
-for param in ${all_permitted[@]}; do
-  OUT=$WDIR/monthly_${param}_${origin}_${type}_${levtype}_$period.grib2
-  echo "Doing $param"
-  python ${ECFPROJ_LIB}/bin/calc_monthly_minmax.py $tmpfile $OUT $param $origin $period
-  input_files+=("$OUT") # this creates the whole string for all the input files
-done
-rm $tmpfile
+# all the parameters are reduced in one pass over tmpfile and written
+# to the same output, in the order given in all_permitted
+params=$(IFS=/; echo "${all_permitted[*]}")
 OUT=$WDIR/monthly_minmax_${origin}_${type}_${levtype}_$period.grib2
-cat ${input_files[@]} > $OUT
-rm ${input_files[@]}
+echo "Doing $params"
+python ${ECFPROJ_LIB}/bin/calc_monthly_minmax.py $tmpfile $OUT $params $origin $period || exit 1
+#with its index (see grib_index.py)
+rm -f $tmpfile $tmpfile.idx
 }
 
 # run with either, compare later
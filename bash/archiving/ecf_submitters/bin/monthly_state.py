@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# Incremental monthly means, updated as each daily file is produced
+#
+# Instead of waiting for the whole month and reading all the daily files
+# again with gmean -k date, each daily file is added to a running state as
+# soon as it is done. The state is kept in a directory per domain, month and
+# product (ie $MEANS_OUTPUT/no-ar-pa/2023/01/STATE/an_ml), with these files
+# per (param, levtype, level), ie ml_130_1.*:
+#   .sum     float32 running sum of the daily values, updated in place
+#            (np.memmap), so each day reads and writes 4 bytes per point
+#   .min/.max running min and max (float32), only with update, not for the
+#            daily means of daily_mean.py --monthly-state (fused mode)
+#   .grib    raw bytes of the message of the earliest date, used as the
+#            output message (as gmean does with its first input)
+#   .npz     count, dates, crc32 of the values of each date and output order
+#   .lock    lock held while the group is updated, so several days of the
+#            same month can be added at the same time
+#
+# The .npz is replaced atomically (tmp file + os.replace) after the arrays
+# are updated. A date already added with the same values (same crc32) is
+# skipped, so a job that crashed halfway can simply be run again. A date
+# already added with other values (ie a day produced again from new data)
+# is an error, and so is a group whose update was interrupted halfway (the
+# date is saved as pending before changing the arrays): the sum cannot take
+# the old values out, so the groups are reset and all their days added again:
+#   monthly_state.py reset -s STATE/an_ml -p 130
+#   monthly_state.py update -s STATE/an_ml -p 130 -i daily_mean_no-ar-pa_an_ml_202301*.grib2
+# The monthly mean is exported as soon as all the days are in, and partial
+# means can be exported at any time for monitoring (--partial).
+#
+# Examples:
+#   monthly_state.py update -s STATE/an_sfc -i daily_mean_no-ar-pa_an_sfc_20230101.grib2
+#   monthly_state.py update -s STATE/fc_sfc -i daily_sum_no-ar-pa_fc_sfc_20230101_228228.grib2 -d 20230101
+#   monthly_state.py export -s STATE/an_ml -o monthly_mean_no-ar-pa_an_{param}_ml_202301.grib2 -n 31
+#   monthly_state.py status -s STATE/an_ml
+#   monthly_state.py reset -s STATE/an_ml -p 130/131
+
+import os
+import sys
+import glob
+import zlib
+import fcntl
+import argparse
+from contextlib import contextmanager, ExitStack
+import eccodes as ecc
+import numpy as np
+from grib_index import get_index, select
+from grib_reader import GribReader
+from grib_manifest import ManifestFile
+
+STATE_SUFFIX = ".npz"
+LOCK_SUFFIX = ".lock"
+TEMPLATE_SUFFIX = ".grib"
+ARRAYS = ["sum", "min", "max"]  # float32 arrays of a group, in the files .sum, .min and .max
+STATS = ["mean", "min", "max"]
+
+
+def state_file(state_dir, key, suffix=STATE_SUFFIX):
+    """File of the group key=(param, levtype, level), the .npz by default"""
+    param, levtype, level = key
+    return os.path.join(state_dir, f"{levtype}_{param}_{level}{suffix}")
+
+
+@contextmanager
+def locked(lock_file):
+    """Exclusive lock on lock_file while updating a group"""
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_group(path):
+    """Return the state saved in path as a dictionary, or None if it does not exist"""
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def save_group(path, state):
+    """Write the state to path atomically"""
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(f, **state)
+    os.replace(tmp_file, path)
+
+
+def write_file(path, data):
+    """Write the bytes of data to path atomically"""
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def values_crc(values):
+    """crc32 of the daily values, to tell a day added again from a day with new values"""
+    return zlib.crc32(np.ascontiguousarray(values, dtype=np.float64))
+
+
+def check_group(state_dir, key, state):
+    """ValueError if the last update of the group was interrupted"""
+    if "pending" in state:
+        raise ValueError(f"The update of {int(state['pending'])} was interrupted in {state_file(state_dir, key)}. "
+                         f"Reset the group (monthly_state.py reset -s {state_dir} -p {key[0]}) and add all its days again")
+
+
+def update_group(state_dir, key, values, date, template, order=0, minmax=True):
+    """
+    Add the daily values of one group for date. template are the raw bytes
+    of the daily message and order its position in the daily file. The min
+    and max are only kept if the group was created with minmax=True.
+    Return False if date was already in the state with the same values,
+    ValueError if it was there with other values
+    """
+    path = state_file(state_dir, key)
+    state = load_group(path)
+    crc = values_crc(values)
+    if state is None:
+        for name in ARRAYS:
+            array_file = state_file(state_dir, key, f".{name}")
+            if minmax or name == "sum":
+                write_file(array_file, np.asarray(values, dtype=np.float32).tobytes())
+            elif os.path.exists(array_file):
+                # left by a group created before and not saved
+                os.remove(array_file)
+        write_file(state_file(state_dir, key, TEMPLATE_SUFFIX), template)
+        state = {
+            "count": np.array(1),
+            "dates": np.array([date]),
+            "crcs": np.array([crc], dtype=np.uint32),
+            "order": np.array(order),
+        }
+        save_group(path, state)
+        return True
+
+    check_group(state_dir, key, state)
+    if date in state["dates"]:
+        if state["crcs"][np.flatnonzero(state["dates"] == date)[0]] == crc:
+            return False
+        raise ValueError(f"{date} is already in {path} with other values. Reset the group "
+                         f"(monthly_state.py reset -s {state_dir} -p {key[0]}) and add all its days again")
+    arrays = {name: state_file(state_dir, key, f".{name}") for name in ARRAYS}
+    arrays = {name: array_file for name, array_file in arrays.items() if os.path.isfile(array_file)}
+    if os.path.getsize(arrays["sum"]) != values.size * 4:
+        raise ValueError(f"{date} has {values.size} points for {key}, expected {os.path.getsize(arrays['sum']) // 4}")
+    # if this is interrupted the arrays may have only part of the day, and the next update stops
+    save_group(path, dict(state, pending=np.array(date)))
+    for name, array_file in arrays.items():
+        array = np.memmap(array_file, dtype=np.float32, mode="r+")
+        combine = {"sum": np.add, "min": np.minimum, "max": np.maximum}[name]
+        combine(array, values, out=array, casting="unsafe")
+        array.flush()
+        del array
+    if date < state["dates"].min():
+        write_file(state_file(state_dir, key, TEMPLATE_SUFFIX), template)
+        state["order"] = np.array(order)
+    sort = np.argsort(np.append(state["dates"], date))
+    state["dates"] = np.append(state["dates"], date)[sort]
+    state["crcs"] = np.append(state["crcs"], np.uint32(crc))[sort]
+    state["count"] = state["count"] + 1
+    save_group(path, state)
+    return True
+
+
+def ingest(state_dir, fields, minmax=True):
+    """
+    Add fields to the state. fields is an iterable of
+    (key, values, date, template bytes, order). Return the number of groups updated
+    """
+    nupdated = 0
+    for key, values, date, template, order in fields:
+        # the field is read (or averaged, see daily_mean.py) before taking the
+        # lock of its group, so the other days can do the same meanwhile
+        with locked(state_file(state_dir, key, LOCK_SUFFIX)):
+            updated = update_group(state_dir, key, values, date, template, order, minmax)
+        if updated:
+            nupdated += 1
+        else:
+            print(f"{date} already in the state for {key} with the same values. Skipping")
+    return nupdated
+
+
+def daily_fields(infile, date=None, params=None):
+    """
+    Generator with the fields of a daily file in the format used by ingest.
+    date replaces the date of the messages if given
+    """
+    entries = get_index(infile)
+    if params is not None:
+        entries = select(entries, param=params)
+    with GribReader(infile) as reader:
+        for order, entry in enumerate(entries):
+            message = reader.message_at(entry)
+            with message.handle() as msg:
+                values = ecc.codes_get_values(msg)
+            key = (entry["param"], entry["levtype"], entry["level"])
+            yield key, values, date or entry["date"], bytes(message.data), order
+
+
+def group_files(state_dir, params=None):
+    """(key, path) of the groups in state_dir, only of params if given"""
+    groups = []
+    for path in glob.glob(os.path.join(state_dir, "*" + STATE_SUFFIX)):
+        levtype, param, level = os.path.basename(path)[:-len(STATE_SUFFIX)].split("_")
+        key = (int(param), levtype, int(level))
+        if params is None or key[0] in params:
+            groups.append((key, path))
+    return groups
+
+
+def load_states(state_dir, params=None):
+    """All the group states in state_dir as a list of (key, state), in output order"""
+    states = [(key, load_group(path)) for key, path in group_files(state_dir, params)]
+    states.sort(key=lambda item: (item[0][0], int(item[1]["order"]), item[0][2]))
+    return states
+
+
+def group_stat(state_dir, key, state, stat):
+    """mean, min or max of one group"""
+    check_group(state_dir, key, state)
+    array_file = state_file(state_dir, key, ".sum" if stat == "mean" else f".{stat}")
+    if not os.path.isfile(array_file):
+        raise ValueError(f"No {stat} for {key} in {state_dir} (not kept for the daily means of the fused mode)")
+    values = np.fromfile(array_file, dtype=np.float32).astype(np.float64)
+    if stat == "mean":
+        values /= int(state["count"])
+    return values
+
+
+def export(state_dir, output, nexpected=None, stat="mean", params=None):
+    """
+    Write the monthly stat of all the groups. If output contains {param}
+    one file per parameter is written. With nexpected all the groups must
+    have that number of days, otherwise nothing is written.
+    Return the list of files written
+    """
+    states = load_states(state_dir, params)
+    if not states:
+        raise ValueError(f"No state found in {state_dir}")
+    if nexpected:
+        incomplete = [key for key, state in states if int(state["count"]) != nexpected]
+        if incomplete:
+            raise ValueError(f"{len(incomplete)} groups do not have {nexpected} days, ie {incomplete[0]}")
+    per_param = "{param}" in output
+    outputs = {}
+    with ExitStack() as stack:
+        for key, state in states:
+            outfile = output.format(param=key[0]) if per_param else output
+            if outfile not in outputs:
+                outputs[outfile] = stack.enter_context(ManifestFile(outfile + ".tmp", defer=True))
+            with open(state_file(state_dir, key, TEMPLATE_SUFFIX), "rb") as f:
+                msg = ecc.codes_new_from_message(f.read())
+            try:
+                ecc.codes_set_values(msg, group_stat(state_dir, key, state, stat))
+                outputs[outfile].write_handle(msg)
+            finally:
+                ecc.codes_release(msg)
+    for outfile, out in outputs.items():
+        os.replace(outfile + ".tmp", outfile)
+        out.save(outfile)
+    return list(outputs)
+
+
+def status(state_dir, params=None):
+    """Print the number of days in each group"""
+    for key, state in load_states(state_dir, params):
+        dates = state["dates"]
+        interrupted = f", update of {int(state['pending'])} interrupted" if "pending" in state else ""
+        print(f"{key}: {int(state['count'])} days ({dates.min()} to {dates.max()}{interrupted})")
+
+
+def reset(state_dir, params=None):
+    """Remove the groups of params (all if None) from the state. Return the number removed"""
+    groups = group_files(state_dir, params)
+    for key, path in groups:
+        # the lock file is kept, another job may be waiting on it
+        with locked(state_file(state_dir, key, LOCK_SUFFIX)):
+            for suffix in [STATE_SUFFIX, TEMPLATE_SUFFIX] + [f".{name}" for name in ARRAYS]:
+                if os.path.exists(state_file(state_dir, key, suffix)):
+                    os.remove(state_file(state_dir, key, suffix))
+    return len(groups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental monthly means from daily files")
+    parser.add_argument("action", choices=["update", "export", "status", "reset"])
+    parser.add_argument("--state-dir", "-s", required=True, help="State directory for one domain, month and product")
+    parser.add_argument("--input", "-i", action="append", help="Daily file to add to the state (update, can be repeated)")
+    parser.add_argument("--date", "-d", type=int, help="Date of the daily file, if different from the one in the headers")
+    parser.add_argument("--output", "-o", help="Output file (export). Use {param} for one file per parameter")
+    parser.add_argument("--ndays", "-n", type=int, help="Expected number of days (export)")
+    parser.add_argument("--partial", action="store_true", help="Export even if some days are missing")
+    parser.add_argument("--stat", choices=STATS, default="mean", help="Statistic to export")
+    parser.add_argument("--params", "-p", help="Only these parameters, ie 130/131 (reset: all if not given)")
+    args = parser.parse_args()
+
+    params = None
+    if args.params:
+        params = [int(p) for p in args.params.split("/") if p]
+
+    if args.action == "update":
+        if not args.input:
+            parser.error("update needs at least one --input")
+        for infile in args.input:
+            try:
+                nupdated = ingest(args.state_dir, daily_fields(infile, args.date, params))
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                sys.exit(1)
+            print(f"Added {infile} to {args.state_dir}: {nupdated} fields updated")
+    elif args.action == "export":
+        if not args.output:
+            parser.error("export needs --output")
+        try:
+            written = export(args.state_dir, args.output, None if args.partial else args.ndays, args.stat, params)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        print(f"Wrote monthly {args.stat} to {', '.join(written)}")
+    elif args.action == "reset":
+        nremoved = reset(args.state_dir, params)
+        print(f"Removed {nremoved} groups from {args.state_dir}")
+    else:
+        status(args.state_dir, params)
+
+
+if __name__ == "__main__":
+    main()
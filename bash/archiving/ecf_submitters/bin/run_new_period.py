@@ -1,9 +1,19 @@
 import datetime
 import os
-os.environ['NBATCH'] = '4'
+import shutil
+import argparse
+import subprocess
+from collections import defaultdict
+os.environ['NBATCH'] = 'auto'  # batches of the daily sums balanced by runtime (see batch_planner.py)
 os.environ["ECF_PORT"] = "3141"
 os.environ["ECF_HOST"] = "ecflow-gen-nhd-001"
 
+LAST_ARCHIVAL = 'last_archival_done.txt'
+PERIODS_FILE = '../../../../bash/job_submitters/periods.txt'
+SUITE_PREFIX = 'carra2_means_'
+# suites of the means not complete yet in the ecFlow server, new ones are only submitted below this
+MAX_ACTIVE_SUITES = int(os.getenv('MAX_ACTIVE_SUITES', '4'))
+
 
 def parse_timestamp(timestamp_str):
     # Convert timestamp string (YYYYMMDDHH) to datetime
@@ -13,10 +23,15 @@ def get_period_from_timestamp(timestamp):
     # Convert timestamp to YYYYMM format
     return timestamp.strftime('%Y%m')
 
+def next_period(period):
+    # Period (YYYYMM) after period
+    next_month = datetime.datetime.strptime(period, '%Y%m') + datetime.timedelta(days=32)
+    return next_month.strftime('%Y%m')
+
 def read_last_archival():
     # Read and parse last_archival_done.txt
     streams = {}
-    with open('last_archival_done.txt', 'r') as f:
+    with open(LAST_ARCHIVAL, 'r') as f:
         for line in f:
             stream, period = line.strip().split()
             streams[stream] = period
@@ -24,13 +39,13 @@ def read_last_archival():
 
 def backup_last_archival():
     # Create a backup of last_archival_done.txt
-    backup_file = 'last_archival_done.txt.backup'
-    shutil.copy2('last_archival_done.txt', backup_file)
+    backup_file = f'{LAST_ARCHIVAL}.backup'
+    shutil.copy2(LAST_ARCHIVAL, backup_file)
     return backup_file
 
 def update_last_archival(stream, new_period):
     # Read all lines
-    with open('last_archival_done.txt', 'r') as f:
+    with open(LAST_ARCHIVAL, 'r') as f:
         lines = f.readlines()
 
     # Update the specific stream's period
@@ -42,15 +57,19 @@ def update_last_archival(stream, new_period):
         else:
             updated_lines.append(line)
 
-    # Write back to file
-    with open('last_archival_done.txt', 'w') as f:
+    # Write to a temporary file and rename it, so the file is never left half written
+    tmp_file = f'{LAST_ARCHIVAL}.tmp'
+    with open(tmp_file, 'w') as f:
         f.writelines(updated_lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, LAST_ARCHIVAL)
 
 
 def read_periods():
     # Read and parse periods.txt
     current_states = {}
-    with open('../../../../bash/job_submitters/periods.txt', 'r') as f:
+    with open(PERIODS_FILE, 'r') as f:
         for line in f:
             parts = line.strip().split()
             stream = parts[0]
@@ -58,50 +77,106 @@ def read_periods():
             current_states[stream] = timestamp
     return current_states
 
-def check_and_process():
-    # Get the current state of all streams
-    last_archived = read_last_archival()
-    current_states = read_periods()
-    
-    # Check each stream
-    for stream in last_archived.keys():
+def eligible_periods(last_period, current_dt, max_periods=None):
+    # Periods after last_period that can be processed: each one when the
+    # current timestamp is at least 62 days after the start of the previous one
+    periods = []
+    while max_periods is None or len(periods) < max_periods:
+        last_dt = datetime.datetime.strptime(last_period, '%Y%m')
+        if (current_dt - last_dt).days < 62:
+            break
+        last_period = next_period(last_period)
+        periods.append(last_period)
+    return periods
+
+def plan_submissions(last_archived, current_states, catch_up=False):
+    # Chronological list of (period, streams) to submit, the streams used only
+    # for last_archival_done.txt. Without catch_up only the next period of
+    # each stream, as in the periodic checks
+    by_period = defaultdict(list)
+    for stream, last_period in last_archived.items():
         if stream not in current_states:
             continue
-            
-        # Get the last archived period and current timestamp
-        last_period = last_archived[stream]
         current_timestamp = current_states[stream]
-        
-        # Convert current timestamp to datetime
-        current_dt = parse_timestamp(current_timestamp)
-        current_period = get_period_from_timestamp(current_dt)
-        #print(f"current and last periods: {current_period} {last_period}")
-        
-        # Compare periods
-        #if current_period > last_period:
-        last_dt = datetime.datetime.strptime(last_period, '%Y%m')
-        if (current_dt - last_dt).days >= 62:
-            next_month = last_dt.replace(day=1) + datetime.timedelta(days=32)
-            next_period = next_month.strftime('%Y%m')
-            # If current timestamp is in a later period, trigger processing
-            print(f"Processing {stream} for {next_period}, since last processed was {last_period} (currently on {current_timestamp})")
-            # calling the script
-            # Set environment variable
-            os.environ['CARRA_PERIOD'] = f'{next_period}'
-            os.environ['EXP'] = f'carra2_means_{next_period}'
-            import subprocess
-            #result = subprocess.run(['./submit_ecf_suite.sh', next_period])
-            result = subprocess.run(['./ecfproj_start', f'-f -s {next_period} -c means -e carra2_means_{next_period}'])
-            # Only update if the subprocess was successful
-            if result.returncode == 0:
-                update_last_archival(stream, next_period)
-                print(f"Updated last_archival_done.txt for {stream} with period {next_period}")
-            else:
-                # Restore backup if processing failed
-                shutil.copy2(backup_file, 'last_archival_done.txt')
-                print(f"Processing failed, restored from backup")
+        periods = eligible_periods(last_period, parse_timestamp(current_timestamp), None if catch_up else 1)
+        if periods:
+            print(f"{stream}: {len(periods)} periods to process ({periods[0]} to {periods[-1]}), "
+                  f"last processed was {last_period} (currently on {current_timestamp})")
         else:
             print(f"Doing nothing for {stream}. Last processed was {last_period} (currently on {current_timestamp})")
+        for period in periods:
+            by_period[period].append(stream)
+    return sorted(by_period.items())
+
+def means_suites():
+    # {name: state} of the suites of the means in the ecFlow server
+    import ecflow as ec
+    client = ec.Client(os.environ["ECF_HOST"], os.environ["ECF_PORT"])
+    client.sync_local()
+    defs = client.get_defs()
+    if defs is None:
+        return {}
+    return {suite.name(): str(suite.get_state()) for suite in defs.suites if suite.name().startswith(SUITE_PREFIX)}
+
+def submit_period(period):
+    # Create the suite of period, return True if it was loaded. The streams of
+    # periods.txt are production streams, not domains: the domains of the
+    # suite are the ones in ECFPROJ_STREAMS (see ecfproj_start)
+    name = f'{SUITE_PREFIX}{period}'
+    os.environ['CARRA_PERIOD'] = period
+    os.environ['EXP'] = name
+    result = subprocess.run(['./ecfproj_start', '-f', '-p', period, '-c', 'means', '-e', name])
+    return result.returncode == 0
+
+def check_and_process(catch_up=False, max_active=MAX_ACTIVE_SUITES, dry_run=False):
+    # Get the current state of all streams
+    last_archived = read_last_archival()
+    current_states = read_periods()
+    submissions = plan_submissions(last_archived, current_states, catch_up)
+    if not submissions:
+        return
+
+    suites = means_suites()
+    active = [name for name, state in suites.items() if state != 'complete']
+    print(f"{len(active)} suites active in ecFlow (at most {max_active}): {' '.join(sorted(active))}")
+    if not dry_run:
+        backup_last_archival()
+
+    # streams with a period not submitted, their later periods wait for the next run
+    blocked = set()
+    for period, streams in submissions:
+        streams = [stream for stream in streams if stream not in blocked]
+        if not streams:
+            continue
+        name = f'{SUITE_PREFIX}{period}'
+        if name in active:
+            # the suite would be replaced while running
+            print(f"{name} is still running, waiting to submit {' '.join(streams)}")
+            blocked.update(streams)
+            continue
+        if len(active) >= max_active:
+            print(f"Reached {max_active} active suites, {period} and later periods wait for the next run")
+            break
+        print(f"Processing {' '.join(streams)} for {period}")
+        if dry_run:
+            active.append(name)
+            continue
+        if submit_period(period):
+            active.append(name)
+            # one update per stream and submission, so a failure later keeps what was submitted
+            for stream in streams:
+                update_last_archival(stream, period)
+                print(f"Updated {LAST_ARCHIVAL} for {stream} with period {period}")
+        else:
+            print(f"Processing failed for {period}, {LAST_ARCHIVAL} not updated for {' '.join(streams)}")
+            blocked.update(streams)
 
 if __name__ == "__main__":
-    check_and_process()
+    parser = argparse.ArgumentParser(description="Submit the suites of the means of the periods ready for processing")
+    parser.add_argument("--catch-up", action="store_true",
+                        help="Submit all the periods ready, not only the next one of each stream")
+    parser.add_argument("--max-active", type=int, default=MAX_ACTIVE_SUITES,
+                        help=f"Maximum suites of the means not complete in ecFlow (default: $MAX_ACTIVE_SUITES or {MAX_ACTIVE_SUITES})")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the periods that would be submitted")
+    args = parser.parse_args()
+    check_and_process(args.catch_up, args.max_active, args.dry_run)
@@ -2,6 +2,7 @@
 
 if [ -z $1 ]; then
   echo "Please provide period in format YYYYMM"
+  echo "or a range YYYYMM-YYYYMM to process all of them in one suite (ie, a backlog)"
   echo ">>>> TODO: if given a shorter length like YYYY, loop over all months in .sh scripts"
   echo "Additional option: give second argument as hours of the day if"
   echo "./ecfproj_start is calling create_suite_timed.py "
@@ -19,19 +20,22 @@ fi
 #export HHMM="2350"
 
 NAME_OF_SUITE="carra2_means"
-export NBATCH=4
+#number of batches of the sums, or auto to choose it from the runtimes
+#of the previous months (see batch_planner.py)
+export NBATCH=auto
 echo "Default value of NAME_OF_SUITE variable: $NAME_OF_SUITE"
 echo "Splitting sums in $NBATCH pieces"
 echo "Edit this script to change it"
+#the missing batch ecf scripts are created by create_suite.py from the template
+if [[ $PERIOD == *-* ]]; then
+#one suite with a family per period, sharing the par limit (SUITE_PAR)
+NAME=${NAME_OF_SUITE}_${PERIOD/-/_}
+echo "Running one suite for the periods $PERIOD"
+echo "Name of the suite will be $NAME"
+./ecfproj_start -f -p $PERIOD -c means -e $NAME
+exit $? #failing if the suite was not loaded
+fi
 
-#create new batch ecf script if not there
-for i in $(seq 1 $NBATCH); do
-  if [ ! -f ../share/ecf/daily_sum_fc_sfc_batch${i}.ecf ]; then
-    MSCR=../share/ecf/daily_sum_fc_sfc_batch${i}.ecf
-    echo "Creating missing ecf script $MSCR"
-    sed "s/REPLACEBATCHNUMBER/$i/g" ../share/ecf/daily_sum_fc_sfc_batch_template.ecf > $MSCR
-  fi
-done
 if [ -z $HHMM ]; then 
 echo "Running standard suite"
 echo "Name of the suite will be ${NAME_OF_SUITE}_$PERIOD"
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# Run the daily mean/sum scripts as small (date, param) units in parallel
+#
+# The daily scripts loop over all the dates and parameters of the month one
+# at a time, so most of the cores of the SLURM job are idle. Here the month
+# is split in units (one date and one parameter, or one date for the scripts
+# that do all the parameters together) and each unit is run as a separate
+# process calling the same script, ie
+#   daily_mean_an_insta_ml.sh 202301 no-ar-pa 05 05 130
+#
+# The number of units running at the same time is limited by the cores and
+# by a memory budget. The memory of each unit is estimated from the grid size
+# of the domain and the number of levels, so the pan-Arctic domain runs only
+# a few units at a time while the small domains use all the cores.
+# The mars staging is done once for the whole month before starting the units.
+# Only uses the standard library, so it can run with the system python3.
+#
+# Examples:
+#   unit_scheduler.py -t daily_mean_ml 202301 no-ar-pa
+#   unit_scheduler.py -t daily_sum -t daily_mean_sfc 202301 no-ar-ce -j 16 --mem-gb 100
+#   unit_scheduler.py -t daily_mean_pl 202301 no-ar-cw --days 01-10 --dry-run
+
+import os
+import sys
+import time
+import calendar
+import argparse
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# grid points (nx, ny) of each domain
+DOMAIN_GRID = {
+    "no-ar-ce": (789, 989),
+    "no-ar-cw": (1069, 1269),
+    "no-ar-pa": (2869, 2869),
+}
+
+# script, arguments, parameters, levels (env variable with the number of levels and default)
+# and if the script can do one parameter at a time
+TASKS = {
+    "daily_sum": {
+        "script": "daily_sum_fc_accum_sfc.sh",
+        "args": ["{period}", "{origin}", "{param}", "{day_beg}", "{day_end}"],
+        "params": "CARRA_PAR_FC_ACC",
+        "levels": None,
+        "per_param": True,
+    },
+    "daily_mean_sfc": {
+        "script": "daily_mean_an_insta_sfc.sh",
+        "args": ["{period}", "{origin}", "{day_beg}", "{day_end}"],
+        "params": "CARRA_PAR_AN_SFC",
+        "levels": None,
+        "per_param": False,
+    },
+    "daily_mean_ml": {
+        "script": "daily_mean_an_insta_ml.sh",
+        "args": ["{period}", "{origin}", "{day_beg}", "{day_end}", "{param}"],
+        "params": "CARRA_PAR_AN_ML",
+        "levels": ("N_ML", 65),
+        "per_param": True,
+    },
+    "daily_mean_pl": {
+        "script": "daily_mean_an_insta_pl.sh",
+        "args": ["{period}", "{origin}", "{day_beg}", "{day_end}", "{param}"],
+        "params": "CARRA_PAR_AN_PL",
+        "levels": ("N_PL", 23),
+        "per_param": True,
+    },
+    "daily_mean_hl": {
+        "script": "daily_mean_an_insta_hl.sh",
+        "args": ["{period}", "{origin}", "{day_beg}", "{day_end}", "{param}"],
+        "params": "CARRA_PAR_AN_HL",
+        "levels": ("N_HL", 18),
+        "per_param": True,
+    },
+}
+
+BYTES_PER_VALUE = 8  # fields are decoded to double precision
+UNIT_OVERHEAD = 1024**3  # mars client, eccodes, bash...
+MEM_FRACTION = 0.8  # keep some margin below the SLURM limit
+
+
+def python_engine():
+    """True if the daily means are done with daily_mean.py (see config_archive.sh)"""
+    return os.environ.get("MEANS_ENGINE", "gmean") in ["python", "fused"]
+
+
+def unit_memory(task, npoints, nlevels, nparams):
+    """
+    Estimated memory (bytes) of one unit of task.
+    gmean keeps a sum and the current field for all the levels (or all the
+    parameters for sfc), mars compute holds the 6 fields of the daily sum and
+    daily_mean.py only keeps one group of fields at a time
+    """
+    if task == "daily_sum":
+        nfields = 6
+    elif python_engine():
+        nfields = 4
+    elif TASKS[task]["per_param"]:
+        nfields = 2 * nlevels
+    else:
+        nfields = 2 * nparams
+    return npoints * nfields * BYTES_PER_VALUE + UNIT_OVERHEAD
+
+
+def memory_budget(mem_gb=None):
+    """Memory available for all the units, from the SLURM allocation if possible"""
+    if mem_gb is not None:
+        return int(mem_gb * 1024**3)
+    if "SLURM_MEM_PER_NODE" in os.environ:
+        total = int(os.environ["SLURM_MEM_PER_NODE"]) * 1024**2
+    elif "SLURM_MEM_PER_CPU" in os.environ:
+        total = int(os.environ["SLURM_MEM_PER_CPU"]) * 1024**2 * available_cores()
+    else:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return int(total * MEM_FRACTION)
+
+
+def available_cores():
+    """Cores allocated to this job"""
+    if "SLURM_CPUS_PER_TASK" in os.environ:
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    return len(os.sched_getaffinity(0))
+
+
+def month_days(period, days=None):
+    """List of days (01, 02...) of the period, optionally limited to a range like 01-15"""
+    ndays = calendar.monthrange(int(period[:4]), int(period[4:6]))[1]
+    first, last = 1, ndays
+    if days:
+        first, last = [int(d) for d in days.split("-")] if "-" in days else (int(days), int(days))
+    return [f"{day:02d}" for day in range(first, min(last, ndays) + 1)]
+
+
+def task_command(task, period, origin, day_beg, day_end, param=""):
+    """Command line of the script of task"""
+    values = {"period": period, "origin": origin, "day_beg": day_beg, "day_end": day_end, "param": param}
+    return [os.path.join(SCRIPT_DIR, TASKS[task]["script"])] + [arg.format(**values) for arg in TASKS[task]["args"]]
+
+
+class Unit:
+    """One call of a daily script for one date (and one parameter)"""
+
+    def __init__(self, task, period, origin, day, param, memory):
+        self.task = task
+        self.day = day
+        self.param = param
+        self.memory = memory
+        self.command = task_command(task, period, origin, day, day, param)
+        self.name = f"{task}_{period}{day}" + (f"_{param}" if param else "")
+        self.process = None
+        self.log = None
+        self.returncode = None
+
+
+def make_units(tasks, period, origin, days, params=None, npoints=None):
+    """All the units of the given tasks for the days of the period"""
+    if npoints is None:
+        nx, ny = DOMAIN_GRID[origin]
+        npoints = nx * ny
+    units = []
+    for task in tasks:
+        spec = TASKS[task]
+        task_params = params or [p for p in os.environ.get(spec["params"], "").split("/") if p]
+        if spec["levels"] is not None:
+            env_var, default = spec["levels"]
+            nlevels = int(os.environ.get(env_var, default))
+        else:
+            nlevels = 1
+        memory = unit_memory(task, npoints, nlevels, max(len(task_params), 1))
+        # with daily_mean.py all the parameters of a day are done in one process
+        per_param = spec["per_param"] and not (task != "daily_sum" and python_engine())
+        if per_param and not task_params:
+            raise ValueError(f"No parameters for {task}. Set {spec['params']} or use --params")
+        for day in days:
+            for param in (task_params if per_param else [""]):
+                units.append(Unit(task, period, origin, day, param, memory))
+    return units
+
+
+def stage(tasks, period, origin, days):
+    """Run the mars staging of each task once for all the days"""
+    env = dict(os.environ, STAGE_ONLY="1")
+    for task in tasks:
+        command = task_command(task, period, origin, days[0], days[-1])
+        print(f"Staging {task}: {' '.join(command)}")
+        result = subprocess.run(command, env=env)
+        if result.returncode != 0:
+            print(f"WARNING: staging for {task} failed with exit code {result.returncode}")
+
+
+def run_units(units, ncores, budget, log_dir):
+    """
+    Run the units with at most ncores processes at a time and the sum
+    of their estimated memory below budget. Return the list of failed units
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    env = dict(os.environ, SKIP_STAGE="1")
+    # the biggest units first, so the small ones fill the gaps at the end
+    pending = sorted(units, key=lambda unit: -unit.memory)
+    running = []
+    failed = []
+    in_use = 0
+    while pending or running:
+        # start as many units as the cores and the memory allow
+        while pending and len(running) < ncores:
+            unit = pending[0]
+            if running and in_use + unit.memory > budget:
+                break
+            if unit.memory > budget:
+                print(f"WARNING: {unit.name} needs {unit.memory / 1024**3:.1f} GB, more than the budget. Running it alone")
+            pending.pop(0)
+            unit.log = open(os.path.join(log_dir, unit.name + ".log"), "w")
+            unit.process = subprocess.Popen(unit.command, stdout=unit.log, stderr=subprocess.STDOUT, env=env)
+            running.append(unit)
+            in_use += unit.memory
+            print(f"Started {unit.name} ({len(running)} running, {in_use / 1024**3:.1f} GB in use)")
+        time.sleep(1)
+        for unit in running[:]:
+            if unit.process.poll() is None:
+                continue
+            unit.returncode = unit.process.returncode
+            unit.log.close()
+            running.remove(unit)
+            in_use -= unit.memory
+            if unit.returncode != 0:
+                print(f"ERROR: {unit.name} failed with exit code {unit.returncode}. See {unit.log.name}")
+                failed.append(unit)
+            else:
+                print(f"Finished {unit.name}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the daily mean/sum scripts in parallel (date, param) units")
+    parser.add_argument("period", help="Period to process, ie 202301")
+    parser.add_argument("origin", help="Domain, ie no-ar-pa")
+    parser.add_argument("--task", "-t", action="append", required=True, choices=list(TASKS), help="Task to run (can be repeated)")
+    parser.add_argument("--days", "-d", help="Range of days, ie 01-15 (default: whole month)")
+    parser.add_argument("--params", "-p", help="Only these parameters, ie 130/131")
+    parser.add_argument("--nproc", "-j", type=int, help="Maximum number of units at the same time (default: cores of the job)")
+    parser.add_argument("--mem-gb", type=float, help="Memory budget in GB (default: from the SLURM allocation)")
+    parser.add_argument("--npoints", type=int, help="Grid points of the domain, if not in DOMAIN_GRID")
+    parser.add_argument("--log-dir", default=None, help="Directory for the logs of each unit")
+    parser.add_argument("--no-stage", action="store_true", help="Do not run the mars staging first")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the units and the concurrency")
+    args = parser.parse_args()
+
+    if args.origin not in DOMAIN_GRID and args.npoints is None:
+        print(f"Unknown domain {args.origin}. Give the grid size with --npoints")
+        sys.exit(1)
+    days = month_days(args.period, args.days)
+    params = [p for p in args.params.split("/") if p] if args.params else None
+    try:
+        units = make_units(args.task, args.period, args.origin, days, params, args.npoints)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    ncores = args.nproc or available_cores()
+    budget = memory_budget(args.mem_gb)
+    largest = max(unit.memory for unit in units)
+    print(f"{len(units)} units, {ncores} cores, memory budget {budget / 1024**3:.1f} GB")
+    print(f"Largest unit {largest / 1024**3:.1f} GB: up to {max(1, min(ncores, budget // largest))} units at a time")
+    if args.dry_run:
+        for unit in units:
+            print(f"{unit.name}: {' '.join(unit.command)} ({unit.memory / 1024**3:.1f} GB)")
+        return
+
+    if not args.no_stage:
+        stage(args.task, args.period, args.origin, days)
+    log_dir = args.log_dir or os.path.join(os.environ.get("MEANS_OUTPUT", "."), args.origin, "logs", args.period)
+    failed = run_units(units, ncores, budget, log_dir)
+    if failed:
+        print(f"{len(failed)} of {len(units)} units failed:")
+        for unit in failed:
+            print(f"  {unit.name}: {' '.join(unit.command)}")
+        sys.exit(1)
+    print(f"All {len(units)} units finished")
+
+
+if __name__ == "__main__":
+    main()
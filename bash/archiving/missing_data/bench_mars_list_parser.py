@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the mars list parsers on big synthetic listing logs.
+
+Writes a batch log like the ones of mars_batch_analyzer.sh (several list
+requests, each with its "key = value" lines, column header, rows and Grand
+Total) of about --size-mb megabytes, with model level tables, and times:
+  legacy  the previous parse_mars_output: whole output in memory, regex per line
+  stream  mars_list_parser.parse_listing reading the file line by line
+Each parser runs in its own process, so the peak memory of each is reported.
+
+Examples:
+  python3 bench_mars_list_parser.py --size-mb 2048
+  python3 bench_mars_list_parser.py --log /scratch/mars_list_bench.txt --keep
+"""
+import os
+import re
+import sys
+import time
+import calendar
+import argparse
+import resource
+import subprocess
+from collections import defaultdict
+
+from mars_list_parser import parse_listing
+
+PARAMS = ['10', '75', '76', '130', '133', '246', '247', '3031', '260028', '260155', '260257']
+LEVELS = [str(level) for level in range(1, 66)]
+
+
+def write_log(path, size_mb):
+    """Write batch listings of consecutive months until the file has size_mb megabytes"""
+    year, month = 1985, 1
+    with open(path, 'w') as f:
+        while f.tell() < size_mb * 1024**2:
+            ndays = calendar.monthrange(year, month)[1]
+            f.write(f"# Investigation for period {year}-{month:02d}\n")
+            f.write(f"list,\nclass=rr,\ndatabase=marser,\ndate={year}-{month:02d}-01/to/{year}-{month:02d}-{ndays},\n"
+                    f"levtype=ml,\nlevelist={'/'.join(LEVELS)},\nparam={'/'.join(PARAMS)}\n")
+            f.write("mars - INFO   - 20250101.120000 - Processing request 1\n")
+            f.write(f"class     = rr\nexpver    = prod\nlevtype   = ml\nmonth     = {year}{month:02d}\n"
+                    "origin    = no-ar-pa\nstream    = dame\ntype      = an\n")
+            f.write("date       file   length       levelist missing offset       param\n")
+            nrows = 0
+            for day in range(1, ndays + 1):
+                for param in PARAMS:
+                    for level in LEVELS:
+                        f.write(f"{year}-{month:02d}-{day:02d} 0      2262436      {level:<8} .       {nrows * 2262436:<12} {param}\n")
+                        nrows += 1
+            f.write(f"\nGrand Total:\n============\n\nEntries       : {nrows:,}\n\n")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def legacy_parse(mars_output):
+    """Previous parse_mars_output (model level branch) of check_missing_variables.py"""
+    available_params = defaultdict(set)
+    level_counts = defaultdict(lambda: defaultdict(set))
+    in_data_section = False
+    for line in mars_output.split('\n'):
+        line = line.strip()
+        if re.match(r'^(date|file)\s+(file\s+)?length.*param', line):
+            in_data_section = True
+            continue
+        if not in_data_section:
+            continue
+        date_match = re.match(r'^(\d{4}-\d{2}-\d{2}|\d{8})\s+\d+\s+\d+\s+(\d+)\s+\.\s+\d+\s+(\d+)', line)
+        if date_match:
+            date_str = date_match.group(1)
+            if len(date_str) == 8:
+                current_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
+            else:
+                current_date = date_str
+            level = date_match.group(2)
+            param = date_match.group(3)
+            available_params[current_date].add(param)
+            level_counts[param][current_date].add(level)
+    return available_params, level_counts
+
+
+def run_one(name, path):
+    """Parse path with one parser and print the time, peak memory and what was found"""
+    start = time.time()
+    if name == 'legacy':
+        with open(path, 'r') as f:
+            available_by_date, level_counts = legacy_parse(f.read())
+    else:
+        with open(path, 'r') as f:
+            available_by_date, level_counts = parse_listing(f)
+    elapsed = time.time() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    nfields = sum(len(levels) for dates in level_counts.values() for levels in dates.values())
+    print(f"{elapsed:.2f} {peak_mb:.0f} {len(available_by_date)} {nfields}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the mars list parsers')
+    parser.add_argument('--size-mb', type=int, default=1024, help='Size of the synthetic log (default: 1024)')
+    parser.add_argument('--log', default='mars_list_bench.txt', help='Log file to write (or reuse if it exists)')
+    parser.add_argument('--keep', action='store_true', help='Do not delete the log at the end')
+    parser.add_argument('--parsers', default='legacy,stream', help='Parsers to run (default: legacy,stream)')
+    parser.add_argument('--run', nargs=2, metavar=('PARSER', 'LOG'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(*args.run)
+        return
+
+    if not os.path.isfile(args.log):
+        print(f"Writing {args.size_mb} MB of listings to {args.log}")
+        write_log(args.log, args.size_mb)
+    size_mb = os.path.getsize(args.log) / 1024**2
+    print(f"Log {args.log}: {size_mb:.0f} MB")
+    results = {}
+    for name in args.parsers.split(','):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', name, args.log],
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{name}: failed\n{output.stderr}")
+            continue
+        elapsed, peak_mb, ndates, nfields = output.stdout.split()
+        results[name] = (int(ndates), int(nfields))
+        print(f"{name:8s} {float(elapsed):8.2f} s {size_mb / float(elapsed):8.1f} MB/s  peak memory {peak_mb} MB  "
+              f"({ndates} dates, {nfields} fields)")
+    if len(set(results.values())) > 1:
+        print("WARNING: the parsers found different fields")
+    if not args.keep:
+        os.remove(args.log)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,27 @@
 Script to check for missing variables in MARS archive by comparing 
 expected parameters from templates with actual available data.
 Can check for specific month/year and validate level counts for ml/pl/hl types.
+With --sweep the listings of all the templates and months of a period are
+run concurrently and merged into one report.
 """
 import sys
 import os
+import shlex
 import subprocess
-import re
 from collections import defaultdict
 import argparse
 import tempfile
 from datetime import datetime, timedelta
 import json
+import calendar
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from mars_inventory import Inventory, LEVEL_TYPES
+from coverage_cube import CoverageCube
+from mars_list_parser import parse_listing
+
+MARS_TIMEOUT = 300  # seconds for each mars listing
+SWEEP_WORKERS = 4  # mars listings at the same time in a sweep
 
 def parse_template_file(template_path):
     """Parse a MARS template file and extract parameters."""
@@ -85,31 +96,46 @@ def create_custom_template(template_path, year, month, database=None):
         os.unlink(temp_path)
         raise e
 
-def run_mars_listing(template_path, year=None, month=None, database=None):
-    """Run mars with a template file and return the output."""
+def mars_command():
+    """The mars command, as a list for subprocess. Changed with MARS_COMMAND (as in mars_executor.py)"""
+    return shlex.split(os.environ.get('MARS_COMMAND', 'mars'))
+
+def run_mars_listing(template_path, year=None, month=None, database=None, timeout=MARS_TIMEOUT):
+    """Run mars with a template file and parse its output from the pipe while it runs.
+    Return available_by_date and level_counts (see mars_list_parser.py), or None if mars failed."""
     actual_template = template_path
     temp_template = None
+    timed_out = threading.Event()
+    
+    def kill(process):
+        timed_out.set()
+        process.kill()
     
     try:
         # Create custom template if year/month or database specified
         if (year is not None and month is not None) or database is not None:
             temp_template = create_custom_template(template_path, year, month, database)
-            #with open(temp_template, 'r') as file:
-            #    content = file.read()
-            #    print(content)
             actual_template = temp_template
         
-        result = subprocess.run(['mars', actual_template], 
-                              capture_output=True, text=True, timeout=300)
-        if result.returncode == 0:
-            return result.stdout
-        else:
+        # stderr to a file, so a full stderr pipe cannot block mars while stdout is read
+        with tempfile.TemporaryFile('w+') as stderr:
+            process = subprocess.Popen(mars_command() + [actual_template], stdout=subprocess.PIPE, stderr=stderr, text=True)
+            timer = threading.Timer(timeout, kill, [process])
+            timer.start()
+            try:
+                listing = parse_listing(process.stdout)
+                returncode = process.wait()
+            finally:
+                timer.cancel()
+            if timed_out.is_set():
+                print(f"Mars command timed out for {actual_template}")
+                return None
+            if returncode == 0:
+                return listing
             print(f"Error running mars with {actual_template}:")
-            print(result.stderr)
+            stderr.seek(0)
+            print(stderr.read())
             return None
-    except subprocess.TimeoutExpired:
-        print(f"Mars command timed out for {actual_template}")
-        return None
     except Exception as e:
         print(f"Error running mars: {e}")
         return None
@@ -119,66 +145,24 @@ def run_mars_listing(template_path, year=None, month=None, database=None):
             os.unlink(temp_template)
 
 def parse_mars_output(mars_output, levtype=None):
-    """Parse MARS output and extract available parameters by date and level information."""
-    available_params = defaultdict(set)
-    level_counts = defaultdict(lambda: defaultdict(set))  # param -> date -> set of levels
-    current_date = None
-    
-    lines = mars_output.split('\n')
-    in_data_section = False
-    
-    for line in lines:
-        line = line.strip()
-        
-        # Check if we're in the data section (after the header)
-        if re.match(r'^(date|file)\s+(file\s+)?length.*param', line):
-            in_data_section = True
-            continue
-        
-        if not in_data_section:
-            continue
-        
-        # Handle different formats based on level type and stream type
-        if levtype in ['ml', 'pl', 'hl']:
-            # Format with levelist column: date file length levelist missing offset param
-            date_match = re.match(r'^(\d{4}-\d{2}-\d{2}|\d{8})\s+\d+\s+\d+\s+(\d+)\s+\.\s+\d+\s+(\d+)', line)
-            if date_match:
-                date_str = date_match.group(1)
-                # Normalize date format
-                if len(date_str) == 8:  # YYYYMMDD
-                    current_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-                else:
-                    current_date = date_str
-                level = date_match.group(2)
-                param = date_match.group(3)
-                available_params[current_date].add(param)
-                level_counts[param][current_date].add(level)
-        else:
-            # Try daily format first: date file length missing offset param
-            date_match = re.match(r'^(\d{4}-\d{2}-\d{2}|\d{8})\s+\d+\s+\d+\s+\.\s+\d+\s+(\d+)', line)
-            if date_match:
-                date_str = date_match.group(1)
-                # Normalize date format
-                if len(date_str) == 8:  # YYYYMMDD
-                    current_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-                else:
-                    current_date = date_str
-                param = date_match.group(2)
-                available_params[current_date].add(param)
-            else:
-                # Try monthly format: file length missing month offset param
-                monthly_match = re.match(r'^\d+\s+\d+\s+\.\s+(\d{4}-\d{2})\s+\d+\s+(\d+)', line)
-                if monthly_match:
-                    month_str = monthly_match.group(1)
-                    # Convert YYYY-MM to YYYY-MM-01 for consistency
-                    current_date = f"{month_str}-01"
-                    param = monthly_match.group(2)
-                    available_params[current_date].add(param)
-    
-    return available_params, level_counts
+    """Parse MARS output and extract available parameters by date and level information.
+    The columns are read from the header of the listing, so levtype is not needed any more."""
+    return parse_listing(mars_output.splitlines())
+
+def store_listing(inventory, result, year, month, available_by_date, level_counts, expected_params):
+    """Save the listing of a month in the inventory, and if the month was complete."""
+    dates = month_dates(year, month, result['stream'])
+    complete = (result['total_dates'] == len(dates) and not result['missing_params']
+                and not result['params_missing_dates'] and not result['level_issues'])
+    inventory.store_month(result['database'], result['template_name'], f"{year}{month:02d}", dates,
+                          available_by_date, level_counts, result['levtype'], expected_params,
+                          result['expected_levels'], complete)
 
-def check_missing_variables(template_path, year=None, month=None, database=None, verbose=True):
-    """Check for missing variables in a specific template."""
+def check_missing_variables(template_path, year=None, month=None, database=None, verbose=True, timeout=MARS_TIMEOUT,
+                            inventory=None, max_age_days=None):
+    """Check for missing variables in a specific template.
+    With an inventory (see mars_inventory.py) the months already checked are
+    taken from it, and the new listings are saved in it."""
     if verbose:
         print(f"\nChecking template: {os.path.basename(template_path)}")
         if year is not None and month is not None:
@@ -211,15 +195,31 @@ def check_missing_variables(template_path, year=None, month=None, database=None,
             print(f"Expected levels ({len(expected_levels)}): {expected_levels}")
         print(f"Expected parameters ({len(expected_params)}): {sorted(expected_params)}")
     
-    # Run MARS listing
-    mars_output = run_mars_listing(template_path, year, month, database)
-    if not mars_output:
+    # Take the month from the inventory if it was already checked
+    store = inventory is not None and year is not None and month is not None
+    if store and inventory.is_fresh(database or 'default', template_name, f"{year}{month:02d}", max_age_days):
         if verbose:
-            print("Failed to get MARS output")
-        return None
+            print(f"Using the inventory for {year}-{month:02d}")
+        available_by_date, level_counts = inventory.load_month(database or 'default', template_name, f"{year}{month:02d}")
+        store = False
+    else:
+        # Run MARS listing, parsing the output while mars runs
+        listing = run_mars_listing(template_path, year, month, database, timeout)
+        if listing is None:
+            if verbose:
+                print("Failed to get MARS output")
+            return None
+        available_by_date, level_counts = listing
     
-    # Parse MARS output
-    available_by_date, level_counts = parse_mars_output(mars_output, levtype)
+    # Availability of the expected (date, param, level) as boolean arrays (see coverage_cube.py)
+    with_levels = levtype in LEVEL_TYPES and expected_levels and level_counts
+    cube = CoverageCube.from_listing(available_by_date, level_counts, sorted(expected_params),
+                                     expected_levels if levtype in LEVEL_TYPES else None)
+    
+    # dates of the month with nothing listed (all the params missing), for generate_fetch_scripts.py
+    unlisted_dates = []
+    if year is not None and month is not None:
+        unlisted_dates = sorted(set(month_dates(year, month, stream)) - set(available_by_date))
     
     if not available_by_date:
         if verbose:
@@ -235,33 +235,36 @@ def check_missing_variables(template_path, year=None, month=None, database=None,
             else:
                 print("\nNo expected parameters were defined in the template.")
 
-        return {
+        result = {
             'template_name': template_name,
             'levtype': levtype,
             'type': type_val,
             'stream': stream,
             'expected_levels': expected_levels,
+            'expected_params': sorted(expected_params),
             'date_range': "No data",
             'total_dates': 0,
             'missing_params': sorted(missing_params),
             'extra_params': [],
             'params_missing_dates': {},
             'level_issues': {},
-            'database': database or 'default'
+            'database': database or 'default',
+            'unlisted_dates': unlisted_dates,
+            'cube': cube
         }
+        if store:
+            store_listing(inventory, result, year, month, available_by_date, level_counts, expected_params)
+        return result
     
     # Check for missing parameters
-    all_dates = sorted(available_by_date.keys())
+    all_dates = cube.dates.tolist()
     if verbose:
         print(f"\nDate range in archive: {all_dates[0]} to {all_dates[-1]}")
         print(f"Total dates checked: {len(all_dates)}")
     
     # Find parameters that are missing across all dates
-    all_available_params = set()
-    for date_params in available_by_date.values():
-        all_available_params.update(date_params)
-    
-    missing_params = expected_params - all_available_params
+    all_available_params = set().union(*available_by_date.values())
+    missing_params = set(cube.missing_params())
     extra_params = all_available_params - expected_params
     
     if verbose:
@@ -282,12 +285,7 @@ def check_missing_variables(template_path, year=None, month=None, database=None,
     # Check for parameters missing on specific dates
     if verbose:
         print(f"\nChecking parameter availability by date...")
-    params_missing_dates = defaultdict(list)
-    
-    for date, date_params in available_by_date.items():
-        missing_on_date = expected_params - date_params
-        for param in missing_on_date:
-            params_missing_dates[param].append(date)
+    params_missing_dates = cube.missing_dates()
     
     if verbose and params_missing_dates:
         print(f"\nPARAMETERS WITH MISSING DATES:")
@@ -300,58 +298,149 @@ def check_missing_variables(template_path, year=None, month=None, database=None,
                 print(f"    Last 5 dates: {', '.join(missing_dates[-5:])}")
     
     # Check level counts for ml/pl/hl types
-    level_issues = defaultdict(list)  # param -> list of (date, actual_count, expected_count)
+    level_issues = cube.level_issues() if with_levels else {}  # param -> list of {date, actual_count, expected_count, missing_levels}
     
-    if levtype in ['ml', 'pl', 'hl'] and expected_levels and level_counts:
+    if with_levels:
         if verbose:
             print(f"\nChecking level counts for {levtype} type...")
-        expected_level_count = len(expected_levels)
-        
-        for param in sorted(all_available_params):
-            if param in level_counts:
-                param_level_issues = []
-                for date, levels in level_counts[param].items():
-                    actual_count = len(levels)
-                    if actual_count != expected_level_count:
-                        param_level_issues.append((date, actual_count, expected_level_count))
-                        level_issues[param].append({
-                            'date': date,
-                            'actual_count': actual_count,
-                            'expected_count': expected_level_count,
-                            'missing_levels': list(set(expected_levels) - levels)
-                        })
-                
-                if verbose:
-                    if param_level_issues:
-                        print(f"  Parameter {param}: level count issues on {len(param_level_issues)} dates")
-                        if len(param_level_issues) <= 5:
-                            for date, actual, expected in param_level_issues:
-                                print(f"    {date}: {actual}/{expected}")
-                        else:
-                            for date, actual, expected in param_level_issues[:3]:
-                                print(f"    {date}: {actual}/{expected}")
-                            print(f"    ... and {len(param_level_issues) - 3} more dates")
-                    else:
-                        print(f"  ✓ Parameter {param}: correct level count on all dates")
-    elif levtype in ['ml', 'pl', 'hl'] and not expected_levels:
+            for param in sorted(all_available_params & expected_params):
+                param_level_issues = level_issues.get(param, [])
+                if param_level_issues:
+                    print(f"  Parameter {param}: level count issues on {len(param_level_issues)} dates")
+                    for issue in param_level_issues[:5 if len(param_level_issues) <= 5 else 3]:
+                        print(f"    {issue['date']}: {issue['actual_count']}/{issue['expected_count']}")
+                    if len(param_level_issues) > 5:
+                        print(f"    ... and {len(param_level_issues) - 3} more dates")
+                else:
+                    print(f"  ✓ Parameter {param}: correct level count on all dates")
+    elif levtype in LEVEL_TYPES and not expected_levels:
         if verbose:
             print(f"\nWarning: {levtype} level type but no levelist found in template")
     
     # Return structured data for summary
-    return {
+    result = {
         'template_name': template_name,
         'levtype': levtype,
         'type': type_val,
         'stream': stream,
         'expected_levels': expected_levels,
+        'expected_params': sorted(expected_params),
         'date_range': f"{all_dates[0]} to {all_dates[-1]}" if all_dates else "No data",
         'total_dates': len(all_dates),
         'missing_params': sorted(missing_params),
         'extra_params': sorted(extra_params),
-        'params_missing_dates': dict(params_missing_dates),
-        'level_issues': dict(level_issues),
-        'database': database or 'default'
+        'params_missing_dates': params_missing_dates,
+        'level_issues': level_issues,
+        'database': database or 'default',
+        'unlisted_dates': unlisted_dates,
+        'cube': cube
     }
+    if store:
+        store_listing(inventory, result, year, month, available_by_date, level_counts, expected_params)
+    return result
+
+def json_results(results):
+    """The results without their coverage cubes, for the JSON output"""
+    return [{key: value for key, value in result.items() if key != 'cube'} for result in results]
+
+def sweep_months(start, end):
+    """List of (year, month) from start to end (both YYYYMM), ValueError if they are not valid"""
+    if len(start) != 6 or len(end) != 6:
+        raise ValueError(f"{start} {end} are not YYYYMM")
+    first, last = datetime.strptime(start, "%Y%m"), datetime.strptime(end, "%Y%m")
+    if first > last:
+        raise ValueError(f"start {start} is after end {end}")
+    year, month = first.year, first.month
+    months = []
+    while (year, month) <= (last.year, last.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def month_dates(year, month, stream):
+    """Dates (YYYY-MM-DD) expected in the listing of one month"""
+    if stream == 'moda':
+        return [f"{year}-{month:02d}-01"]
+    ndays = calendar.monthrange(year, month)[1]
+    return [f"{year}-{month:02d}-{day:02d}" for day in range(1, ndays + 1)]
+
+def run_sweep(template_paths, months, database=None, workers=SWEEP_WORKERS, timeout=MARS_TIMEOUT,
+              inventory=None, max_age_days=None):
+    """
+    Check all the templates for all the months, with at most workers mars
+    listings at the same time. Return the results (one per template and month,
+    with its period added) and the list of (template, period) that failed.
+    """
+    jobs = [(template_path, year, month) for template_path in template_paths for year, month in months]
+    print(f"Sweeping {len(template_paths)} templates x {len(months)} months ({len(jobs)} listings, {workers} at a time)")
+    results = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(check_missing_variables, path, year, month, database, False, timeout,
+                               inventory, max_age_days)
+                   for path, year, month in jobs]
+        for n, ((path, year, month), future) in enumerate(zip(jobs, futures), start=1):
+            template_name = os.path.basename(path)
+            period = f"{year}{month:02d}"
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error checking {template_name} for {period}: {e}")
+                result = None
+            if result is None:
+                failed.append((template_name, period))
+                print(f"[{n}/{len(jobs)}] {template_name} {period}: listing FAILED")
+                continue
+            result['period'] = period
+            results.append(result)
+            print(f"[{n}/{len(jobs)}] {template_name} {period}: {len(result['missing_params'])} missing, "
+                  f"{len(result['params_missing_dates'])} with missing dates, {len(result['level_issues'])} with level issues")
+    return results, failed
+
+def merge_sweep_results(results):
+    """
+    Merge the monthly results of each template into one result with the same
+    keys, for the summary. The coverage cubes of the months are joined, so a
+    parameter is in missing_params only if it is missing in all the months,
+    and the dates of the months where it is missing are in params_missing_dates.
+    """
+    by_template = defaultdict(list)
+    for result in results:
+        by_template[result['template_name']].append(result)
+    
+    merged = []
+    for template_name, template_results in sorted(by_template.items()):
+        template_results.sort(key=lambda r: r['period'])
+        first, last = template_results[0], template_results[-1]
+        extra_params = set()
+        level_issues = defaultdict(list)
+        cubes = []
+        for result in template_results:
+            extra_params.update(result['extra_params'])
+            if result['total_dates'] == 0:
+                # nothing listed for this month, so all its dates are missing
+                dates = month_dates(int(result['period'][:4]), int(result['period'][4:]), result['stream'])
+                cubes.append(result['cube'].empty_like(dates))
+            else:
+                cubes.append(result['cube'])
+            for param, issues in result['level_issues'].items():
+                level_issues[param].extend(issues)
+        cube = CoverageCube.concat(cubes)
+        
+        start = month_dates(int(first['period'][:4]), int(first['period'][4:]), first['stream'])[0]
+        end = month_dates(int(last['period'][:4]), int(last['period'][4:]), last['stream'])[-1]
+        merged.append(dict(first,
+                           date_range=f"{start} to {end}",
+                           total_dates=len(cube.dates),
+                           missing_params=cube.missing_params(),
+                           extra_params=sorted(extra_params),
+                           params_missing_dates=cube.missing_dates(),
+                           level_issues=dict(level_issues),
+                           unlisted_dates=sorted(d for r in template_results for d in r.get('unlisted_dates', [])),
+                           cube=cube,
+                           period=f"{first['period']}-{last['period']}",
+                           months_checked=len(template_results)))
+    return merged
 
 def generate_summary(results):
     """Generate a comprehensive summary of all missing variables."""
@@ -425,11 +514,17 @@ def generate_summary(results):
     partial_missing = defaultdict(list)
     
     for result in valid_results:
-        for param, dates in result['params_missing_dates'].items():
-            if param not in result['missing_params']:  # Not completely missing
+        cube = result.get('cube')
+        if cube is not None:
+            # number of missing dates of each param, from the coverage cube
+            nmissing = dict(zip(cube.params, (~cube.listed).sum(axis=0).tolist()))
+        else:
+            nmissing = {param: len(dates) for param, dates in result['params_missing_dates'].items()}
+        for param, count in nmissing.items():
+            if count and param not in result['missing_params']:  # Not completely missing
                 partial_missing[param].append({
                     'template': result['template_name'],
-                    'missing_dates': len(dates),
+                    'missing_dates': count,
                     'total_dates': result['total_dates'],
                     'date_range': result['date_range'],
                     'levtype': result['levtype'],
@@ -516,6 +611,12 @@ Examples:
   
   # Export results to JSON file
   python3 check_missing_variables.py -y 1985 -m 10 -j missing_vars.json
+  
+  # Sweep all templates for a whole period, 8 mars listings at a time
+  python3 check_missing_variables.py --sweep 198409 202412 --workers 8 -j missing_sweep.json
+  
+  # Same, only listing the months that are not complete in the local inventory
+  python3 check_missing_variables.py --sweep 198409 202412 --workers 8 -i mars_inventory.sqlite
         ''',
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
@@ -533,6 +634,16 @@ Examples:
                        help='Generate comprehensive summary of all missing variables')
     parser.add_argument('--json-output', '-j', metavar='FILE',
                        help='Export results to JSON file')
+    parser.add_argument('--sweep', nargs=2, metavar=('START', 'END'),
+                       help='Check all the months from START to END (YYYYMM) concurrently, with a merged summary')
+    parser.add_argument('--workers', '-w', type=int, default=SWEEP_WORKERS,
+                       help=f'Mars listings at the same time in a sweep (default: {SWEEP_WORKERS})')
+    parser.add_argument('--mars-timeout', type=int, default=MARS_TIMEOUT,
+                       help=f'Timeout in seconds for each mars listing (default: {MARS_TIMEOUT})')
+    parser.add_argument('--inventory', '-i', metavar='FILE',
+                       help='SQLite inventory: only list the months not checked yet or stale (see mars_inventory.py)')
+    parser.add_argument('--max-age-days', type=float,
+                       help='List again the months of the inventory checked more than this number of days ago')
     
     args = parser.parse_args()
     
@@ -545,6 +656,43 @@ Examples:
         print("Error: Both --year and --month must be provided together, or neither")
         return
     
+    inventory = Inventory(args.inventory) if args.inventory else None
+    
+    if args.sweep:
+        if args.year is not None:
+            print("Error: --sweep cannot be used with --year/--month")
+            return
+        if args.template:
+            template_path = os.path.join(args.template_dir, args.template)
+            if not os.path.exists(template_path):
+                template_path = args.template  # Try as full path
+            template_paths = [template_path]
+        else:
+            template_paths = [os.path.join(args.template_dir, f) for f in sorted(os.listdir(args.template_dir))
+                              if f.startswith('mars_request_')]
+        try:
+            months = sweep_months(*args.sweep)
+        except ValueError as e:
+            parser.error(f"--sweep START END must be YYYYMM with START <= END ({e})")
+        
+        results, failed = run_sweep(template_paths, months, args.database, args.workers, args.mars_timeout,
+                                    inventory, args.max_age_days)
+        generate_summary(merge_sweep_results(results))
+        if failed:
+            print(f"\nMARS listing failed for {len(failed)} template/month combinations (run them again with -t -y -m):")
+            for template_name, period in failed:
+                print(f"  - {template_name} {period}")
+        
+        # one result per template and month, as generate_fetch_scripts.py expects
+        if args.json_output:
+            with open(args.json_output, 'w') as f:
+                json.dump(json_results(results), f, indent=2)
+            print(f"\nResults exported to {args.json_output}")
+        if failed:
+            # the sweep is not complete, so scripts (repair_gaps.py) do not take it as clean
+            sys.exit(1)
+        return
+    
     results = []
     
     if args.template:
@@ -554,7 +702,8 @@ Examples:
             template_path = args.template  # Try as full path
         
         if os.path.exists(template_path):
-            result = check_missing_variables(template_path, args.year, args.month, args.database, not args.summary)
+            result = check_missing_variables(template_path, args.year, args.month, args.database, not args.summary,
+                                             args.mars_timeout, inventory, args.max_age_days)
             if result:
                 results.append(result)
         else:
@@ -578,7 +727,8 @@ Examples:
         for template_file in sorted(template_files):
             template_path = os.path.join(args.template_dir, template_file)
             try:
-                result = check_missing_variables(template_path, args.year, args.month, args.database, not args.summary)
+                result = check_missing_variables(template_path, args.year, args.month, args.database, not args.summary,
+                                                 args.mars_timeout, inventory, args.max_age_days)
                 if result:
                     results.append(result)
             except Exception as e:
@@ -596,7 +746,7 @@ Examples:
     # Export to JSON if requested
     if args.json_output:
         with open(args.json_output, 'w') as f:
-            json.dump(results, f, indent=2)
+            json.dump(json_results(results), f, indent=2)
         print(f"\nResults exported to {args.json_output}")
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Coverage of one MARS template as boolean NumPy arrays.
+
+For the dates of a listing and the expected params (and levels) of a
+template:
+  listed  (date x param)          param listed on that date
+  levels  (date x param x level)  level listed for the param on that date
+                                  (only for templates with levels)
+The missing params, missing dates, level issues and coverage used by
+check_missing_variables.py are reductions over these arrays, and the cubes
+of several months of the same template are joined along the date axis, so
+the checks of decades of dates do not loop over every (date, param, level).
+"""
+import numpy as np
+
+
+class CoverageCube:
+    """Availability of the expected (date, param, level) of one template"""
+
+    def __init__(self, dates, params, levels=None, listed=None, found=None):
+        self.dates = np.asarray(dates, dtype=str)
+        self.params = list(params)
+        self.level_names = list(levels) if levels else None
+        shape = (len(self.dates), len(self.params))
+        self.listed = listed if listed is not None else np.zeros(shape, dtype=bool)
+        if self.level_names is None:
+            self.levels = None
+        else:
+            self.levels = found if found is not None else np.zeros(shape + (len(self.level_names),), dtype=bool)
+
+    @classmethod
+    def from_listing(cls, available_by_date, level_counts, params, levels=None, dates=None):
+        """
+        Cube from the output of parse_listing. dates are the dates of the
+        listing by default. Params and levels not expected are ignored
+        """
+        dates = sorted(available_by_date) if dates is None else dates
+        cube = cls(dates, params, levels)
+        param_index = {param: i for i, param in enumerate(cube.params)}
+        level_index = {level: i for i, level in enumerate(cube.level_names or [])}
+        for d, date in enumerate(cube.dates):
+            for param in available_by_date.get(date, ()):
+                p = param_index.get(param)
+                if p is None:
+                    continue
+                cube.listed[d, p] = True
+                if cube.levels is not None:
+                    for level in level_counts.get(param, {}).get(date, ()):
+                        if level in level_index:
+                            cube.levels[d, p, level_index[level]] = True
+        return cube
+
+    @classmethod
+    def concat(cls, cubes):
+        """Join cubes of the same template (same params and levels) along the dates"""
+        first = cubes[0]
+        listed = np.concatenate([cube.listed for cube in cubes])
+        found = None if first.levels is None else np.concatenate([cube.levels for cube in cubes])
+        return cls(np.concatenate([cube.dates for cube in cubes]), first.params, first.level_names, listed, found)
+
+    def empty_like(self, dates):
+        """Cube with the same params and levels and nothing listed on dates"""
+        return CoverageCube(dates, self.params, self.level_names)
+
+    def missing_params(self):
+        """Params not listed on any date"""
+        return [self.params[p] for p in np.flatnonzero(~self.listed.any(axis=0))]
+
+    def missing_dates(self):
+        """{param: [dates]} of the params not listed on some dates"""
+        missing = ~self.listed
+        return {self.params[p]: self.dates[missing[:, p]].tolist() for p in np.flatnonzero(missing.any(axis=0))}
+
+    def coverage(self):
+        """{param: fraction of the dates where it is listed}"""
+        if len(self.dates) == 0:
+            return {param: 0.0 for param in self.params}
+        return dict(zip(self.params, self.listed.mean(axis=0).tolist()))
+
+    def level_issues(self):
+        """
+        {param: [{date, actual_count, expected_count, missing_levels}]} for the
+        dates where a param is listed without all the expected levels
+        """
+        if self.levels is None:
+            return {}
+        nexpected = len(self.level_names)
+        counts = self.levels.sum(axis=2)
+        wrong = self.listed & (counts != nexpected)
+        issues = {}
+        for p in np.flatnonzero(wrong.any(axis=0)):
+            issues[self.params[p]] = [{
+                'date': str(self.dates[d]),
+                'actual_count': int(counts[d, p]),
+                'expected_count': nexpected,
+                'missing_levels': [self.level_names[l] for l in np.flatnonzero(~self.levels[d, p])]
+            } for d in np.flatnonzero(wrong[:, p])]
+        return issues
@@ -3,13 +3,16 @@
 Script to generate MARS fetching scripts from missing data JSON files.
 Unlike the templates that use 'list', this generates 'retrieve' commands 
 with stream=oper and target= specifications.
+With --plan the holes of all the results are covered with the fewest
+requests: consecutive dates are joined in /to/ ranges and the params with
+the same missing dates and levels go in the same retrieve.
 """
 
 import json
 import argparse
 import os
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 def parse_template_for_base_info(template_path,database='marser'):
@@ -30,6 +33,9 @@ def parse_template_for_base_info(template_path,database='marser'):
                     # Don't override database if it was explicitly passed
                     if key in ['class', 'expver', 'origin']:
                         base_params[key] = value
+                    elif key in ['time', 'step']:
+                        # only in the templates of data with times and steps
+                        base_params[key] = value
                     elif key == 'database' and database == 'marser':
                         # Keep the passed database parameter, don't override from template
                         continue
@@ -262,6 +268,197 @@ def generate_fetch_script_for_level_issues(result, template_dir="mars_templates"
     return scripts
 
 
+def sort_key(value):
+    """Numeric order for params and levels (None for templates without levels)"""
+    if value is None:
+        return (0, 0, '')
+    return (1, int(value), value) if value.isdigit() else (2, 0, value)
+
+
+def result_levels(result):
+    """Levels of the template of a result, or [None] if it has no levels"""
+    if result['levtype'] != 'sfc' and result['expected_levels']:
+        return result['expected_levels']
+    return [None]
+
+
+def result_holes(result):
+    """
+    All the (date, param) to fetch for one result of check_missing_variables.py,
+    with the set of levels missing for each (None for templates without levels)
+    """
+    levels = result_levels(result)
+    holes = defaultdict(set)
+    
+    # params missing on some of the dates listed (the completely missing ones too)
+    for param, dates in result['params_missing_dates'].items():
+        for date in dates:
+            holes[(date, param)].update(levels)
+    
+    # dates with nothing listed, all the params of the template are missing on them.
+    # Older JSON files do not have them, use the date range
+    unlisted_dates = result.get('unlisted_dates')
+    if unlisted_dates is None and result['missing_params'] and not result['params_missing_dates']:
+        if ' to ' in result['date_range']:
+            start, end = result['date_range'].split(' to ')
+            unlisted_dates = expand_run(start, end, result['stream'])
+        else:
+            print(f"WARNING: no dates for the missing params of {result['template_name']} ({result['date_range']})")
+    # older JSON files do not have the expected params either, use the ones seen missing
+    expected_params = result.get('expected_params') or sorted(set(result['missing_params'])
+                                                                | set(result['params_missing_dates']))
+    for date in unlisted_dates or []:
+        for param in expected_params:
+            holes[(date, param)].update(levels)
+    
+    for param, issues in result['level_issues'].items():
+        for issue in issues:
+            holes[(issue['date'], param)].update(issue['missing_levels'])
+    return holes
+
+
+def next_date(date, stream):
+    """Next day (YYYY-MM-DD), or the first day of the next month for monthly streams"""
+    day = datetime.strptime(date, '%Y-%m-%d')
+    if stream == 'moda':
+        return (day.replace(day=28) + timedelta(days=4)).replace(day=1).strftime('%Y-%m-%d')
+    return (day + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def expand_run(start, end, stream):
+    """All the dates from start to end"""
+    dates = [start]
+    while dates[-1] < end:
+        dates.append(next_date(dates[-1], stream))
+    return dates
+
+
+def date_spec(start, end, stream):
+    """mars date of a run: START/to/END for days, the list of months for moda"""
+    if start == end:
+        return start
+    if stream == 'moda':
+        return '/'.join(expand_run(start, end, stream))
+    return f"{start}/to/{end}"
+
+
+def date_runs(dates, stream):
+    """Split the sorted dates in runs of consecutive dates, as (first, last)"""
+    runs = []
+    for date in dates:
+        if runs and next_date(runs[-1][1], stream) == date:
+            runs[-1][1] = date
+        else:
+            runs.append([date, date])
+    return [tuple(run) for run in runs]
+
+
+def plan_fetches(results):
+    """
+    Plan the fewest retrieves covering every missing (date, param, level) of
+    the results exactly once. The holes of all the results of the same
+    template and database are joined; the dates of each param with the same
+    missing levels are split in runs of consecutive dates, and the params with
+    the same run and levels share one request.
+    Return a list of requests (dicts with the template result, database,
+    params, levels and the first and last date)
+    """
+    holes_by_template = defaultdict(lambda: defaultdict(set))
+    first_result = {}
+    for result in results:
+        if result is None:
+            continue
+        key = (result['template_name'], result['database'])
+        first_result.setdefault(key, result)
+        for hole, levels in result_holes(result).items():
+            holes_by_template[key][hole].update(levels)
+    
+    plan = []
+    for key, holes in sorted(holes_by_template.items()):
+        result = first_result[key]
+        # dates of each param with the same missing levels
+        dates_by_param = defaultdict(list)
+        for (date, param), levels in holes.items():
+            dates_by_param[(param, frozenset(levels))].append(date)
+        # params with the same run of dates and levels go together
+        params_by_run = defaultdict(list)
+        for (param, levels), dates in dates_by_param.items():
+            for run in date_runs(sorted(dates), result['stream']):
+                params_by_run[(run, levels)].append(param)
+        for (run, levels), params in sorted(params_by_run.items(), key=lambda item: (item[0][0], sorted(item[0][1], key=sort_key))):
+            plan.append({
+                'result': result,
+                'database': key[1],
+                'params': sorted(params, key=sort_key),
+                'levels': sorted(levels, key=sort_key),
+                'start': run[0],
+                'end': run[1],
+            })
+    return plan, holes_by_template
+
+
+def check_plan(plan, holes_by_template):
+    """Verify that the plan covers every hole exactly once. Return the number of holes"""
+    covered = defaultdict(int)
+    for request in plan:
+        key = (request['result']['template_name'], request['database'])
+        for date in expand_run(request['start'], request['end'], request['result']['stream']):
+            for param in request['params']:
+                for level in request['levels']:
+                    covered[(key, date, param, level)] += 1
+    expected = {(key, date, param, level) for key, holes in holes_by_template.items()
+                for (date, param), levels in holes.items() for level in levels}
+    if set(covered) != expected or any(count != 1 for count in covered.values()):
+        raise ValueError("The fetch plan does not cover the missing data exactly once")
+    return len(expected)
+
+
+def generate_fetch_scripts_from_plan(plan, template_dir="mars_templates"):
+    """One fetch script per request of the plan"""
+    scripts = []
+    counters = defaultdict(int)
+    for request in plan:
+        result = request['result']
+        template_name = result['template_name']
+        counters[template_name] += 1
+        n = counters[template_name]
+        base_params = parse_template_for_base_info(os.path.join(template_dir, template_name), 'marser')
+        
+        base_name = template_name.replace('mars_request_', '')
+        target_file = f"{base_name}_{request['start'].replace('-', '')}_{request['end'].replace('-', '')}_{n:03d}.grib"
+        
+        script_content = ["retrieve,"]
+        script_content.append(f"class={base_params['class']},")
+        script_content.append(f"database={base_params['database']},")
+        script_content.append(f"date={date_spec(request['start'], request['end'], result['stream'])},")
+        script_content.append(f"expver={base_params['expver']},")
+        
+        if request['levels'] != [None]:
+            script_content.append(f"levelist={'/'.join(request['levels'])},")
+        
+        script_content.append(f"levtype={result['levtype']},")
+        script_content.append(f"origin={base_params['origin']},")
+        script_content.append(f"param={'/'.join(request['params'])},")
+        # the stream of the template (dame/moda), like the listing of the holes
+        script_content.append(f"stream={result['stream']},")
+        
+        # time and step as in the template. The daily and monthly means have
+        # none, so they are left out for them (as in repair_gaps.py)
+        for key in ('step', 'time'):
+            if key in base_params:
+                script_content.append(f"{key}={base_params[key]},")
+        
+        script_content.append(f"type={result['type']},")
+        script_content.append(f'target="{target_file}"')
+        
+        scripts.append({
+            'filename': f"fetch_plan_{template_name}_{n:03d}.mars",
+            'content': '\n'.join(script_content) + '\n',
+            'target_file': target_file
+        })
+    return scripts
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Generate MARS fetch scripts from missing data JSON files',
@@ -278,6 +475,9 @@ Examples:
   
   # Generate scripts with custom template directory
   python3 generate_fetch_scripts.py -j missing_1986_01.json -t /path/to/templates
+  
+  # Fewest requests covering all the holes (ie, for the JSON of a --sweep)
+  python3 generate_fetch_scripts.py -j missing_sweep.json --plan
         ''',
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
@@ -296,6 +496,8 @@ Examples:
                        help='Generate scripts only for level issues')
     parser.add_argument('--summary', '-s', action='store_true',
                        help='Show summary of what would be generated without creating files')
+    parser.add_argument('--plan', '-p', action='store_true',
+                       help='Cover all the holes with the fewest requests (ignores --missing-only, --partial-only and --levels-only)')
     
     args = parser.parse_args()
     
@@ -320,13 +522,24 @@ Examples:
         'missing_params': 0,
         'partial_missing': 0,
         'level_issues': 0,
+        'plan_requests': 0,
+        'plan_holes': 0,
         'total_scripts': 0
     }
     
     print(f"Processing {len(results)} template results...")
     
+    if args.plan:
+        plan, holes_by_template = plan_fetches(results)
+        nholes = check_plan(plan, holes_by_template)
+        all_scripts = generate_fetch_scripts_from_plan(plan, args.template_dir)
+        for script in all_scripts:
+            print(f"    - {script['filename']} -> {script['target_file']}")
+        summary_stats['plan_requests'] = len(all_scripts)
+        summary_stats['plan_holes'] = nholes
+    
     for result in results:
-        if result is None:
+        if result is None or args.plan:
             continue
             
         template_scripts = []
@@ -368,6 +581,9 @@ Examples:
     print(f"Scripts for missing parameters:     {summary_stats['missing_params']}")
     print(f"Scripts for partial missing data:   {summary_stats['partial_missing']}")
     print(f"Scripts for level issues:           {summary_stats['level_issues']}")
+    if args.plan:
+        print(f"Planned requests:                   {summary_stats['plan_requests']} "
+              f"(covering {summary_stats['plan_holes']} missing date/param/level)")
     print(f"Total fetch scripts:                {summary_stats['total_scripts']}")
     
     if args.summary:
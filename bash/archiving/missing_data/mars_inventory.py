@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Local SQLite inventory of the MARS listings done by check_missing_variables.py.
+
+Every (database, template, date, param, level) found in a listing is stored,
+together with the month it belongs to, when it was checked and if it was
+complete. The next checks only list MARS again for the months that are not
+in the inventory or are stale (incomplete months checked more than
+INCOMPLETE_MAX_AGE hours ago, or any month older than --max-age-days).
+
+For the gap queries a coverage table has one row for every expected
+(date, param) of the months checked, with the number of levels found and
+expected, and a partial index on the rows with gaps, so the holes of the
+whole reanalysis record are found without listing MARS or scanning all
+the fields.
+
+Examples:
+  # only list the months not checked yet, keeping the results in the inventory
+  python3 check_missing_variables.py --sweep 198409 202412 --inventory mars_inventory.sqlite
+
+  # months checked and their status
+  python3 mars_inventory.py -i mars_inventory.sqlite status
+
+  # gaps of the whole record, or one template and period
+  python3 mars_inventory.py -i mars_inventory.sqlite gaps
+  python3 mars_inventory.py -i mars_inventory.sqlite gaps -t mars_request_ml_levels_an_dame --start 19900101 --end 19901231
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from collections import defaultdict
+
+INCOMPLETE_MAX_AGE = 24  # hours before an incomplete month is listed again
+LEVEL_TYPES = ['ml', 'pl', 'hl']  # levtypes with levels in the listing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fields (
+    database TEXT, template TEXT, date TEXT, param TEXT, level TEXT,
+    PRIMARY KEY (database, template, date, param, level)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    database TEXT, template TEXT, date TEXT, param TEXT, nlevels INTEGER, nexpected INTEGER,
+    PRIMARY KEY (database, template, date, param)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS coverage_gaps ON coverage (database, template, date) WHERE nlevels < nexpected;
+CREATE TABLE IF NOT EXISTS months (
+    database TEXT, template TEXT, period TEXT, checked_at REAL, complete INTEGER, ndates INTEGER,
+    PRIMARY KEY (database, template, period)
+) WITHOUT ROWID;
+"""
+
+
+class Inventory:
+    """
+    SQLite inventory of MARS listings. Can be shared by the threads of a
+    sweep: all the access goes through one connection and a lock.
+    """
+
+    def __init__(self, path, incomplete_max_age=INCOMPLETE_MAX_AGE):
+        self.path = path
+        self.incomplete_max_age = incomplete_max_age
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def month_status(self, database, template, period):
+        """(checked_at, complete) of a month, or None if it was never checked"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT checked_at, complete FROM months WHERE database=? AND template=? AND period=?",
+                (database, template, period)).fetchone()
+
+    def is_fresh(self, database, template, period, max_age_days=None, incomplete_max_age=None):
+        """True if the month does not need to be listed again"""
+        if incomplete_max_age is None:
+            incomplete_max_age = self.incomplete_max_age
+        status = self.month_status(database, template, period)
+        if status is None:
+            return False
+        checked_at, complete = status
+        age = time.time() - checked_at
+        if max_age_days is not None and age > max_age_days * 86400:
+            return False
+        return bool(complete) or age < incomplete_max_age * 3600
+
+    def store_month(self, database, template, period, dates, available_by_date, level_counts,
+                    levtype, expected_params, expected_levels, complete):
+        """
+        Replace the fields and coverage of one month with the result of a
+        listing (as returned by parse_mars_output). dates are all the dates
+        expected in the month
+        """
+        with_levels = levtype in LEVEL_TYPES and expected_levels
+        fields = []
+        for date, params in available_by_date.items():
+            for param in params:
+                if with_levels and param in level_counts:
+                    fields += [(database, template, date, param, level) for level in level_counts[param][date]]
+                else:
+                    fields.append((database, template, date, param, ''))
+        nexpected = len(expected_levels) if with_levels else 1
+        coverage = []
+        for date in dates:
+            for param in expected_params:
+                if with_levels:
+                    nlevels = len(level_counts.get(param, {}).get(date, ()))
+                else:
+                    nlevels = 1 if param in available_by_date.get(date, ()) else 0
+                coverage.append((database, template, date, param, nlevels, nexpected))
+        first, last = month_range(period)
+        with self.lock, self.conn:
+            for table in ['fields', 'coverage']:
+                self.conn.execute(f"DELETE FROM {table} WHERE database=? AND template=? AND date BETWEEN ? AND ?",
+                                  (database, template, first, last))
+            self.conn.executemany("INSERT OR IGNORE INTO fields VALUES (?, ?, ?, ?, ?)", fields)
+            self.conn.executemany("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?, ?)", coverage)
+            self.conn.execute("INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?, ?, ?)",
+                              (database, template, period, time.time(), int(complete), len(available_by_date)))
+
+    def load_month(self, database, template, period):
+        """available_by_date and level_counts of a month, as returned by parse_mars_output"""
+        available_by_date = defaultdict(set)
+        level_counts = defaultdict(lambda: defaultdict(set))
+        first, last = month_range(period)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT date, param, level FROM fields WHERE database=? AND template=? AND date BETWEEN ? AND ?",
+                (database, template, first, last)).fetchall()
+        for date, param, level in rows:
+            available_by_date[date].add(param)
+            if level:
+                level_counts[param][date].add(level)
+        return available_by_date, level_counts
+
+    def months(self, database=None, template=None):
+        """All the months checked, as (database, template, period, checked_at, complete, ndates)"""
+        query, args = where(database=database, template=template)
+        with self.lock:
+            return self.conn.execute(f"SELECT * FROM months {query} ORDER BY database, template, period", args).fetchall()
+
+    def gaps(self, database=None, template=None, start=None, end=None):
+        """
+        The expected (date, param) with missing levels or not available at all,
+        as (database, template, date, param, nlevels, nexpected)
+        """
+        query, args = where(database=database, template=template, start=start, end=end)
+        query = (query + " AND" if query else "WHERE") + " nlevels < nexpected"
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT database, template, date, param, nlevels, nexpected FROM coverage {query} "
+                "ORDER BY database, template, param, date", args).fetchall()
+
+
+def month_range(period):
+    """First and last possible date (YYYY-MM-DD) of a period YYYYMM, for the queries"""
+    return f"{period[:4]}-{period[4:6]}-01", f"{period[:4]}-{period[4:6]}-31"
+
+
+def iso_date(date):
+    """YYYYMMDD or YYYY-MM-DD as YYYY-MM-DD"""
+    return date if '-' in date else f"{date[:4]}-{date[4:6]}-{date[6:8]}"
+
+
+def where(database=None, template=None, start=None, end=None):
+    """WHERE clause and arguments for the optional filters"""
+    conditions = []
+    args = []
+    for column, value in [('database', database), ('template', template)]:
+        if value is not None:
+            conditions.append(f"{column}=?")
+            args.append(value)
+    if start is not None:
+        conditions.append("date >= ?")
+        args.append(iso_date(start))
+    if end is not None:
+        conditions.append("date <= ?")
+        args.append(iso_date(end))
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), args
+
+
+def print_status(inventory, database=None, template=None):
+    """Number of months checked, complete and incomplete per template"""
+    counts = defaultdict(lambda: [0, 0, None, None])
+    for db, tmpl, period, checked_at, complete, ndates in inventory.months(database, template):
+        count = counts[(db, tmpl)]
+        count[0 if complete else 1] += 1
+        count[2] = min(count[2] or period, period)
+        count[3] = max(count[3] or period, period)
+    if not counts:
+        print("No months in the inventory")
+    for (db, tmpl), (ncomplete, nincomplete, first, last) in sorted(counts.items()):
+        print(f"{tmpl} (db={db}): {first} to {last}, {ncomplete} complete, {nincomplete} incomplete months")
+
+
+def print_gaps(inventory, database=None, template=None, start=None, end=None):
+    """Gaps grouped by template and param, with the number of dates and the first and last one"""
+    grouped = defaultdict(list)
+    for db, tmpl, date, param, nlevels, nexpected in inventory.gaps(database, template, start, end):
+        grouped[(db, tmpl, param)].append((date, nlevels, nexpected))
+    if not grouped:
+        print("No gaps found in the inventory")
+        return 0
+    for (db, tmpl, param), dates in sorted(grouped.items()):
+        empty = sum(1 for _, nlevels, _ in dates if nlevels == 0)
+        print(f"{tmpl} (db={db}) param {param}: {len(dates)} dates with gaps "
+              f"({empty} missing, {len(dates) - empty} with missing levels) from {dates[0][0]} to {dates[-1][0]}")
+    return len(grouped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the local inventory of MARS listings')
+    parser.add_argument('action', choices=['status', 'gaps'])
+    parser.add_argument('--inventory', '-i', required=True, help='SQLite inventory file')
+    parser.add_argument('--template', '-t', help='Only this template')
+    parser.add_argument('--database', '-db', help='Only this database (marssc, marser or default)')
+    parser.add_argument('--start', help='First date for gaps (YYYYMMDD)')
+    parser.add_argument('--end', help='Last date for gaps (YYYYMMDD)')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.inventory):
+        print(f"Inventory not found: {args.inventory}")
+        sys.exit(1)
+    inventory = Inventory(args.inventory)
+    if args.action == 'status':
+        print_status(inventory, args.database, args.template)
+    else:
+        print_gaps(inventory, args.database, args.template, args.start, args.end)
+    inventory.close()
+
+
+if __name__ == "__main__":
+    main()
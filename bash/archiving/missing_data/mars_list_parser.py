@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Streaming parser for the output of MARS list requests.
+
+MARS prints the keys with the same value for all the fields as "key = value"
+lines, then a header line with the names of the other columns, ie
+
+  levtype   = ml
+  month     = 198501
+  date       file   length   levelist missing offset     param
+  1985-01-01 0      5012345  1        .       0          130
+
+The header is read once to map the columns, and each row is split on white
+space, so date, param and levelist are found wherever MARS puts them (also
+when they are one of the constant keys). The lines are read one at a time,
+so the output of mars can be parsed from the pipe while it is listing, and
+batch output with several list requests (as analysed by mars_batch_analyzer.sh)
+is split in sections, one per table, with the keys of the request that
+produced it (the "list," lines echoed by mars).
+
+Examples:
+  # per section summary of a batch output
+  python3 mars_list_parser.py mars_calls_out.txt
+
+  from mars_list_parser import parse_listing
+  available_by_date, level_counts = parse_listing(process.stdout)
+"""
+import sys
+import argparse
+from collections import defaultdict
+
+VERBS = ('list', 'retrieve', 'archive', 'read', 'stage')  # start of a request echoed by mars
+DATE_COLUMNS = ('date', 'month')
+
+
+class Section:
+    """One table of the output, with the request keys and the constant keys"""
+
+    def __init__(self, number, request, constants, columns):
+        self.number = number
+        self.request = dict(request)
+        self.constants = dict(constants)
+        self.columns = columns
+        self.nrows = 0
+
+    @property
+    def database(self):
+        return self.request.get('database', self.constants.get('database', 'default'))
+
+    @property
+    def period(self):
+        """YYYY-MM of the first date in the request or the constant keys, or None"""
+        value = self.constants.get('date') or self.constants.get('month') or self.request.get('date')
+        if not value:
+            return None
+        date = normalise_date(value.split('/')[0])
+        return date[:7] if date else None
+
+
+def normalise_date(value, cache={}):
+    """YYYY-MM-DD from YYYY-MM-DD, YYYYMMDD, YYYY-MM or YYYYMM (months as day 01)"""
+    date = cache.get(value)
+    if date is None:
+        digits = value.replace('-', '')
+        if len(digits) == 8 and digits.isdigit():
+            date = f"{digits[:4]}-{digits[4:6]}-{digits[6:8]}"
+        elif len(digits) == 6 and digits.isdigit():
+            date = f"{digits[:4]}-{digits[4:6]}-01"
+        else:
+            return None
+        cache[value] = date
+    return date
+
+
+def is_header(fields):
+    """True for the line with the column names of a table"""
+    return 'length' in fields and 'offset' in fields and all(f.isidentifier() for f in fields)
+
+
+def iter_fields(lines):
+    """
+    Generator of (section, date, param, level) for every row of the tables
+    in lines (any iterable of str, ie an open file or a pipe). level is None
+    if the listing has no levelist
+    """
+    request = {}
+    constants = {}
+    section = None
+    table_done = False
+    nsections = 0
+    for line in lines:
+        if section is not None:
+            fields = line.split()
+            if len(fields) == ncols:
+                date = normalise_date(fields[date_col]) if date_col is not None else fixed_date
+                param = fields[param_col] if param_col is not None else fixed_param
+                level = fields[level_col] if level_col is not None else fixed_level
+                section.nrows += 1
+                yield section, date, param, level
+                continue
+            # anything else ends the table (blank line, Grand Total...)
+            section = None
+            table_done = True
+
+        stripped = line.strip()
+        if not stripped or stripped.startswith('mars -'):
+            continue
+        if stripped.rstrip(',').lower() in VERBS:
+            # a new request echoed by mars
+            request = {}
+            constants = {}
+            table_done = False
+            continue
+        raw_key, sep, value = stripped.partition('=')
+        key = raw_key.strip().lower()
+        if sep and key.isidentifier():
+            value = value.strip().rstrip(',').strip('"')
+            if raw_key != raw_key.rstrip():
+                # "key = value": constant key of the next table
+                if table_done:
+                    constants = {}
+                    table_done = False
+                constants[key] = value
+            else:
+                # "key=value,": request echoed by mars
+                request[key] = value
+            continue
+
+        fields = stripped.split()
+        if is_header(fields):
+            nsections += 1
+            section = Section(nsections, request, constants, fields)
+            ncols = len(fields)
+            columns = {name: i for i, name in enumerate(fields)}
+            date_col = next((columns[c] for c in DATE_COLUMNS if c in columns), None)
+            param_col = columns.get('param')
+            level_col = columns.get('levelist')
+            fixed_date = next((normalise_date(constants[c]) for c in DATE_COLUMNS if c in constants), None)
+            fixed_param = constants.get('param')
+            fixed_level = constants.get('levelist')
+
+
+def parse_listing(lines):
+    """
+    Parse the output of a mars list from lines (file, pipe or list of str).
+    Return available_by_date (date -> set of params) and level_counts
+    (param -> date -> set of levels, only for listings with levels)
+    """
+    available_by_date = defaultdict(set)
+    level_counts = defaultdict(lambda: defaultdict(set))
+    for _, date, param, level in iter_fields(lines):
+        if date is None:
+            continue
+        available_by_date[date].add(param)
+        if level is not None:
+            level_counts[param][date].add(level)
+    return available_by_date, level_counts
+
+
+def parse_sections(lines):
+    """
+    Parse batch output with several list requests. Return a list of
+    (section, available_by_date, level_counts), one per table
+    """
+    sections = {}
+    for section, date, param, level in iter_fields(lines):
+        if section.number not in sections:
+            sections[section.number] = (section, defaultdict(set), defaultdict(lambda: defaultdict(set)))
+        _, available_by_date, level_counts = sections[section.number]
+        if date is None:
+            continue
+        available_by_date[date].add(param)
+        if level is not None:
+            level_counts[param][date].add(level)
+    return [sections[n] for n in sorted(sections)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summary of each table in the output of mars list requests')
+    parser.add_argument('files', nargs='*', help='mars output files (default: stdin)')
+    args = parser.parse_args()
+
+    for path in args.files or ['-']:
+        with (open(path, 'r') if path != '-' else sys.stdin) as f:
+            sections = parse_sections(f)
+        print(f"{path}: {len(sections)} tables")
+        for section, available_by_date, level_counts in sections:
+            params = set().union(*available_by_date.values()) if available_by_date else set()
+            dates = sorted(available_by_date)
+            date_range = f"{dates[0]} to {dates[-1]}" if dates else "no dates"
+            print(f"  {section.number}: period {section.period}, database {section.database}, {section.nrows} fields, "
+                  f"{len(dates)} dates ({date_range}), {len(params)} params"
+                  + (f", levels of {len(level_counts)} params" if level_counts else ""))
+
+
+if __name__ == "__main__":
+    main()
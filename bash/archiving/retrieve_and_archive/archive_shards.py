@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Split the archive scripts of a period in a SLURM job array
+#
+# archive_to_mars.py writes one mars archive script per file and a single
+# SLURM script running all of them one after the other, which does not fit
+# in the 8 hours of the queue for a whole month. Here the scripts are split
+# in shards with about the same number of bytes to archive (the biggest
+# files first, each one to the shard with less bytes so far), and each shard
+# is one task of a job array. Every task writes a status file with the exit
+# code of each mars call, and an aggregation job (run after the whole array)
+# lists the scripts that failed or did not run, to submit them again.
+#
+# Files created in the shards directory (ie $DUMP_PATH/$PERIOD/archive_shards):
+#   shard_N.txt       archive scripts of task N
+#   status/shard_N    "OK script" / "FAILED code script" lines, DONE at the end
+#   failed_scripts.txt scripts to run again (aggregate)
+#
+# Examples:
+#   archive_shards.py create -d archive_shards -n 8 -o archive_202301_array.sh archival_scripts/*.mars
+#   archive_shards.py aggregate -d archive_shards
+#   archive_shards.py create -d archive_shards_retry -n 2 -o archive_202301_retry.sh $(cat archive_shards/failed_scripts.txt)
+
+import os
+import re
+import sys
+import argparse
+
+SHARD_TIME = "8:00:00"  # time limit of each task of the array
+MAX_SHARDS = 16  # default number of tasks of the array
+SHARD_BYTES = 200 * 1024**3  # default bytes per shard, when the number of shards is not given
+
+
+def script_source(script_path):
+    """The file archived by a mars script (the source key)"""
+    with open(script_path, "r") as f:
+        match = re.search(r'source\s*=\s*"?([^",\n]+)"?', f.read())
+    return match.group(1) if match else None
+
+
+def script_sizes(scripts):
+    """Bytes archived by each script. 0 if the source file is not found"""
+    sizes = {}
+    for script in scripts:
+        source = script_source(script)
+        try:
+            sizes[script] = os.path.getsize(source)
+        except (OSError, TypeError):
+            print(f"WARNING: source file of {script} not found ({source})")
+            sizes[script] = 0
+    return sizes
+
+
+def number_of_shards(sizes, shard_bytes=SHARD_BYTES, max_shards=MAX_SHARDS):
+    """Enough shards for about shard_bytes each, at most max_shards and one per script"""
+    total = sum(sizes.values())
+    return max(1, min(max_shards, len(sizes), -(-total // shard_bytes)))
+
+
+def balance_shards(sizes, nshards):
+    """
+    Split the scripts in nshards lists with about the same bytes: the biggest
+    scripts first, each one to the shard with the smallest total so far.
+    Return the list of shards as (total bytes, scripts)
+    """
+    shards = [[0, []] for _ in range(nshards)]
+    for script in sorted(sizes, key=lambda s: (-sizes[s], s)):
+        shard = min(shards, key=lambda shard: shard[0])
+        shard[0] += sizes[script]
+        shard[1].append(script)
+    return [(total, scripts) for total, scripts in shards if scripts]
+
+
+def write_shards(shards, shards_dir):
+    """Write shard_N.txt files (N from 1) and return the number of shards"""
+    os.makedirs(os.path.join(shards_dir, "status"), exist_ok=True)
+    # remove the lists and status of a previous split
+    for name in os.listdir(shards_dir):
+        if name.startswith("shard_"):
+            os.remove(os.path.join(shards_dir, name))
+    for name in os.listdir(os.path.join(shards_dir, "status")):
+        os.remove(os.path.join(shards_dir, "status", name))
+    for n, (total, scripts) in enumerate(shards, start=1):
+        with open(os.path.join(shards_dir, f"shard_{n}.txt"), "w") as f:
+            f.write("\n".join(scripts) + "\n")
+        print(f"Shard {n}: {len(scripts)} scripts, {total / 1024**3:.1f} GB")
+    return len(shards)
+
+
+def create_array_script(shards_dir, nshards, output_slurm_file, time_limit=SHARD_TIME):
+    """SLURM job array script running the scripts of shard $SLURM_ARRAY_TASK_ID"""
+    shards_dir = os.path.abspath(shards_dir)
+    aggregate = os.path.abspath(__file__)
+    script_content = f"""#!/usr/bin/env bash
+#SBATCH --error=log_means_archive.%A_%a.err
+#SBATCH --output=log_means_archive.%A_%a.out
+#SBATCH --job-name=means_archive
+#SBATCH --qos=nf
+#SBATCH --time={time_limit}
+#SBATCH --account="c3srrp"
+#SBATCH --array=1-{nshards}
+
+#Archive the scripts of one shard (see archive_shards.py).
+#Submit with: $0 --submit
+#which also submits the aggregation of the status files after the array finishes
+if [[ $1 == --submit ]]; then
+  JOBID=$(sbatch --parsable $0)
+  sbatch --dependency=afterany:$JOBID --qos=nf --account="c3srrp" --job-name=means_archive_check \\
+         --output=log_means_archive_check.%j.out --wrap="python3 {aggregate} aggregate -d {shards_dir}"
+  exit 0
+fi
+
+SHARD={shards_dir}/shard_${{SLURM_ARRAY_TASK_ID}}.txt
+STATUS={shards_dir}/status/shard_${{SLURM_ARRAY_TASK_ID}}
+: > $STATUS
+for script in $(cat $SHARD); do
+  mars $script
+  rc=$?
+  if [[ $rc == 0 ]]; then
+    echo "OK $script" >> $STATUS
+  else
+    echo "FAILED $rc $script" >> $STATUS
+  fi
+done
+echo DONE >> $STATUS
+"""
+    with open(output_slurm_file, "w") as f:
+        f.write(script_content)
+    os.chmod(output_slurm_file, 0o755)
+    print(f"Created SLURM job array script: {output_slurm_file} ({nshards} tasks)")
+
+
+def create_shards(scripts, shards_dir, output_slurm_file, nshards=None, time_limit=SHARD_TIME):
+    """Balance the scripts in shards and write the shard lists and the job array script"""
+    sizes = script_sizes(scripts)
+    if nshards is None:
+        nshards = number_of_shards(sizes)
+    nshards = write_shards(balance_shards(sizes, nshards), shards_dir)
+    create_array_script(shards_dir, nshards, output_slurm_file, time_limit)
+    return nshards
+
+
+def read_status(status_file):
+    """Return ({script: exit code} and True if the shard finished) from a status file"""
+    codes = {}
+    done = False
+    if not os.path.isfile(status_file):
+        return codes, done
+    with open(status_file, "r") as f:
+        for line in f:
+            fields = line.split()
+            if fields == ["DONE"]:
+                done = True
+            elif len(fields) == 2 and fields[0] == "OK":
+                codes[fields[1]] = 0
+            elif len(fields) == 3 and fields[0] == "FAILED":
+                codes[fields[2]] = int(fields[1])
+    return codes, done
+
+
+def aggregate(shards_dir, failed_file=None):
+    """
+    Check the status of all the shards. The scripts that failed or did not
+    run (ie, the task hit the time limit) are written to failed_file
+    (default shards_dir/failed_scripts.txt). Return the list of those scripts
+    """
+    failed_file = failed_file or os.path.join(shards_dir, "failed_scripts.txt")
+    retry = []
+    nscripts = 0
+    n = 1
+    while os.path.isfile(os.path.join(shards_dir, f"shard_{n}.txt")):
+        with open(os.path.join(shards_dir, f"shard_{n}.txt"), "r") as f:
+            scripts = [line.strip() for line in f if line.strip()]
+        codes, done = read_status(os.path.join(shards_dir, "status", f"shard_{n}"))
+        failed = [s for s in scripts if codes.get(s, 0) != 0]
+        missing = [s for s in scripts if s not in codes]
+        state = "finished" if done else "NOT finished"
+        print(f"Shard {n}: {state}, {len(scripts) - len(failed) - len(missing)} OK, {len(failed)} failed, {len(missing)} not run")
+        for script in failed:
+            print(f"  FAILED (exit code {codes[script]}): {script}")
+        retry += failed + missing
+        nscripts += len(scripts)
+        n += 1
+    print(f"\n{nscripts - len(retry)} of {nscripts} archive scripts finished OK")
+    if retry:
+        with open(failed_file, "w") as f:
+            f.write("\n".join(retry) + "\n")
+        print(f"List of scripts to run again written to {failed_file}")
+    elif os.path.isfile(failed_file):
+        os.remove(failed_file)
+    return retry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split the mars archive scripts in a SLURM job array")
+    parser.add_argument("action", choices=["create", "aggregate"])
+    parser.add_argument("scripts", nargs="*", help="mars archive scripts (create)")
+    parser.add_argument("--shards-dir", "-d", required=True, help="Directory for the shard lists and status files")
+    parser.add_argument("--nshards", "-n", type=int, help=f"Number of shards (default: about {SHARD_BYTES // 1024**3} GB each, at most {MAX_SHARDS})")
+    parser.add_argument("--output", "-o", help="Job array script to write (create)")
+    parser.add_argument("--time", default=SHARD_TIME, help="Time limit of each task")
+    parser.add_argument("--failed", "-f", help="File with the scripts to run again (aggregate)")
+    args = parser.parse_intermixed_args()
+
+    if args.action == "create":
+        if not args.scripts or not args.output:
+            parser.error("create needs the scripts and --output")
+        create_shards(args.scripts, args.shards_dir, args.output, args.nshards, args.time)
+    elif aggregate(args.shards_dir, args.failed):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,13 @@ import yaml
 from datetime import datetime, timedelta
 from pathlib import Path
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-import subprocess
-import shlex
-from pathlib import Path
+# the GRIB index is shared with the tools under ecf_submitters/bin
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ecf_submitters", "bin"))
+from grib_index import get_index, sorted_levels, IDX_SUFFIX
+from grib_manifest import read_manifest, MANIFEST_SUFFIX
+from archive_shards import create_shards
 
 def get_dates(period:str) -> None:
     from datetime import datetime
@@ -24,49 +27,39 @@ def get_dates(period:str) -> None:
     end_date = f"{year}-{month:02d}-{last_day}"
     return start_date, end_date
 
+def scan_grib_file(file_path):
+    """
+    Sorted unique levels (joined with / as expected by mars) and number
+    of messages in the file. Taken from the manifest written by the producer
+    if there is a valid one (see grib_manifest.py), otherwise from one read
+    of its index (see grib_index.py).
+    Returns None for both if the file cannot be read
+    """
+    manifest = read_manifest(file_path)
+    if manifest is not None:
+        return '/'.join(str(level) for level in manifest["levels"]), str(manifest["count"])
+    try:
+        entries = get_index(file_path)
+    except Exception as e:
+        print(f"Unexpected error reading {file_path}: {e}")
+        return None, None
+    levels = '/'.join(str(level) for level in sorted_levels(entries))
+    return levels, str(len(entries))
+
+def scan_grib_files(file_paths, nproc=None):
+    """scan_grib_file for all the files on a process pool. Returns {file: (levels, count)}"""
+    if not file_paths:
+        return {}
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        return dict(zip(file_paths, pool.map(scan_grib_file, file_paths)))
+
 def get_sorted_levels(file_path):
-    # First command: grib_ls -p level $FILE | sort -u | grep -v messages | grep -v grib2 | grep -v lev | sort -n
-    cmd1 = f"grib_ls -p level {file_path}"
-    cmd2 = "sort -u"
-    cmd3 = "grep -v messages"
-    cmd4 = "grep -v grib2"
-    cmd5 = "grep -v lev"
-    cmd6 = "sort -n"
-  
-    # Execute the first command
-    p1 = subprocess.Popen(shlex.split(cmd1), stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(shlex.split(cmd2), stdin=p1.stdout, stdout=subprocess.PIPE)
-    p3 = subprocess.Popen(shlex.split(cmd3), stdin=p2.stdout, stdout=subprocess.PIPE)
-    p4 = subprocess.Popen(shlex.split(cmd4), stdin=p3.stdout, stdout=subprocess.PIPE)
-    p5 = subprocess.Popen(shlex.split(cmd5), stdin=p4.stdout, stdout=subprocess.PIPE)
-    p6 = subprocess.Popen(shlex.split(cmd6), stdin=p5.stdout, stdout=subprocess.PIPE)
-  
-    # Get the output
-    out = p6.communicate()[0].decode('utf-8').strip()
-    #levels = out.replace(' ', '/')
-    levels = '/'.join(x.strip() for x in out.split('\n'))
-  
-    return levels
+    """Sorted unique levels in the file, joined with / as expected by mars"""
+    return scan_grib_file(file_path)[0]
 
 def get_grib_count(file_path):
-    try:
-        # Run grib_count command
-        cmd = f"grib_count {file_path}"
-        process = subprocess.run(shlex.split(cmd), 
-                               capture_output=True, 
-                               text=True, 
-                               check=True)
-        
-        # Get the output (should be a number)
-        count = process.stdout.strip()
-        return count
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error running grib_count: {e}")
-        return None
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        return None
+    """Number of messages in the file, read from its index"""
+    return scan_grib_file(file_path)[1]
 
 def load_configs(config_file="mars_config_archive.yaml"):
     """Load configurations from YAML file."""
@@ -120,7 +113,8 @@ def get_files_in_directory(directory_path):
   path = Path(directory_path)
   
   # Get only files (not directories) from the specified path
-  files = [f.name for f in path.iterdir() if f.is_file()]
+  # (skipping the index and manifest sidecar files written next to the GRIB files)
+  files = [f.name for f in path.iterdir() if f.is_file() and not f.name.endswith((IDX_SUFFIX, MANIFEST_SUFFIX))]
   
   # Sort the files (optional, but usually helpful)
   files.sort()
@@ -131,7 +125,7 @@ def get_files_in_directory(directory_path):
 
 
 
-def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="mars_config_archive.yaml"):
+def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="mars_config_archive.yaml", nproc=None):
     """Process MARS statements for given date range.
     The files are to be found in the path
     starting with tmp_path_fetch and under these directories
@@ -158,17 +152,26 @@ def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="m
         print("No configurations loaded. Exiting.")
         return []
 
-    created_files = []
+    # list the files of all the configs first, to scan them all together
+    config_files = []
     for config in archival_configs:
         # the path for the data
         output_dir = os.path.join(tmp_path_fetch, config["data_path"])
         #get the files to archive
-        if not output_dir:
+        if not os.path.isdir(output_dir):
             print(f"Not processing {output_dir}, since not available")
             continue
         else:
             files_to_archive = get_files_in_directory(output_dir)
-        
+        config_files.append((config, output_dir, files_to_archive))
+
+    # levels and number of messages of all the files, in parallel
+    all_files = [str(Path(output_dir) / f) for _, output_dir, files in config_files for f in files]
+    print(f"Scanning {len(all_files)} files")
+    scans = scan_grib_files(all_files, nproc)
+
+    created_files = []
+    for config, output_dir, files_to_archive in config_files:
         print(f"Processing files in {output_dir}")
         # Create a separate archive script for each file:
         for output_filename in files_to_archive:
@@ -195,8 +198,12 @@ def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="m
             # extract param from filename 
             param =  output_filename.split("_")[-1].replace(".grib2","")
             param_config["param"] =  param
-            param_config["levelist"] =  get_sorted_levels(full_output_path)
-            param_config["expect"] =  get_grib_count(full_output_path)
+            levels, count = scans[full_output_path]
+            if count is None or count == "0":
+                print(f"ERROR: no GRIB messages read from {full_output_path}. Not archiving it")
+                continue
+            param_config["levelist"] =  levels
+            param_config["expect"] =  count
 
             # Create MARS statement
             mars_statement = create_mars_statement(param_config)
@@ -278,7 +285,9 @@ def main():
     #for test
     #created_files = process_mars_statements(start_date, end_date, tmp_path_fetch,"mars_config_test.yaml")
 
-    created_files = process_mars_statements(start_date, end_date, tmp_path_fetch,selected_config)
+    # processes for scanning the files. All the cores by default
+    nproc = int(os.environ["SCAN_WORKERS"]) if "SCAN_WORKERS" in os.environ else None
+    created_files = process_mars_statements(start_date, end_date, tmp_path_fetch,selected_config,nproc)
 
     # Print created files
     print("\nCreated files:")
@@ -287,6 +296,12 @@ def main():
     slurm_scr = f"archive_{period}_from_fac2.sh"
     create_slurm_script(created_files,slurm_scr)
 
+    # with ARCHIVE_SHARDS the scripts are also split in a job array balanced
+    # by the bytes to archive (see archive_shards.py). A number of shards or auto
+    if os.environ.get("ARCHIVE_SHARDS") and created_files:
+        nshards = None if os.environ["ARCHIVE_SHARDS"] == "auto" else int(os.environ["ARCHIVE_SHARDS"])
+        create_shards(created_files, os.path.join(tmp_path_fetch, "archive_shards"), f"archive_{period}_array_from_fac2.sh", nshards)
+
 if __name__ == "__main__":
     main()
 
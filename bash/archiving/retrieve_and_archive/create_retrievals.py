@@ -1,6 +1,8 @@
 import os
 import yaml
 from datetime import datetime, timedelta
+from mars_planner import coalesce_requests
+from mars_executor import run_mars_requests, summarise
 
 
 def load_configs(config_file="mars_config.yaml"):
@@ -57,6 +59,11 @@ def process_mars_statements(start_date, end_date, config_file="mars_config.yaml"
         # Set date range
         config["date"] = f"{start_date}/to/{end_date}"
 
+    # Configs that only differ in the parameters go in one retrieve (see mars_planner.py),
+    # since they would write to the same output file anyway
+    for merged in coalesce_requests(retrieval_configs):
+        config = merged["request"]
+
         # Generate output filename
         output_filename = generate_filename(
             config["type"], start_date, config["levtype"], config["stream"]
@@ -69,17 +76,17 @@ def process_mars_statements(start_date, end_date, config_file="mars_config.yaml"
         mars_statement = create_mars_statement(config)
 
         # Create script filename
-        script_filename = f"mars_script_{config['type']}_{config['levtype']}.mars"
+        script_filename = f"mars_script_{config['type']}_{config['stream']}_{config['levtype']}.mars"
 
         # Write statement to file
         with open(script_filename, "w") as f:
             f.write(mars_statement)
 
-        # Execute mars command
-        os.system(f"mars {script_filename}")
-
         created_files.append(script_filename)
 
+    # Execute the mars commands
+    summarise(run_mars_requests(created_files))
+
     return created_files
 
 
@@ -23,10 +23,23 @@ else
 fi
 began=$(date  '+%Y%m%d_%H%M%S')
 DUMP_PATH="/ec/res4/scratch/nhd/mars-pull/carra2/fetch_to_archive"
-#fetch data from mars scratch
-python3 fetch_from_marsscr.py $PERIOD $DUMP_PATH $CONFIG1
+#fetch data from mars scratch. The requests run in parallel (see mars_executor.py)
+#export MARS_WORKERS=4 #mars clients at the same time
+#Set FETCH_OPTS=--coalesce to merge the requests of all the parameters of each
+#type/stream/levtype and split the files afterwards (see mars_planner.py).
+#MARS_MAX_PARAMS limits the parameters per merged request (and the size of the merged file)
+FETCH_OPTS=""
+#export MARS_MAX_PARAMS=6
+if ! python3 fetch_from_marsscr.py $PERIOD $DUMP_PATH $CONFIG1 $FETCH_OPTS; then
+  echo "Some mars requests failed. See $DUMP_PATH/$PERIOD/scr/failed_requests.txt"
+  exit 1
+fi
 
 #create archival scripts to be used by fac2
+#With ARCHIVE_SHARDS (number of tasks or auto) a job array archive_${PERIOD}_array_from_fac2.sh
+#is also created, to be submitted by fac2 with: ./archive_${PERIOD}_array_from_fac2.sh --submit
+#(see archive_shards.py)
+#export ARCHIVE_SHARDS=auto
 python3 archive_to_mars.py $PERIOD $DUMP_PATH $CONFIG2
 chmod -R 755 $DUMP_PATH/$PERIOD
 
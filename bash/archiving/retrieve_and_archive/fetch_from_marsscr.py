@@ -3,6 +3,8 @@ import yaml
 from datetime import datetime, timedelta
 from pathlib import Path
 import sys
+from mars_executor import run_mars_requests, summarise, MARS_WORKERS, MARS_RETRIES, MARS_BACKOFF
+from mars_planner import coalesce_requests, split_by_param
 
 def get_dates(period:str) -> None:
     from datetime import datetime
@@ -81,8 +83,42 @@ def create_directory_extra(type_val,stream, levtype, extra, tmp_path_fetch):
     Path(dir_name).mkdir(parents=True, exist_ok=True)
     return dir_name
 
-def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="mars_config.yaml"):
-    """Process MARS statements for given date range."""
+def write_mars_script(request, script_path):
+    """Write the MARS statement for request to script_path"""
+    with open(script_path, "w") as f:
+        f.write(create_mars_statement(request))
+
+
+def plan_coalesced(requests, tmp_path_fetch, max_params=None):
+    """
+    Merge the per-parameter requests with mars_planner and write one script
+    per merged request. The merged requests download to tmp_path_fetch/coalesced.
+    Return the scripts, {script: combined file} and {script: per-parameter targets}
+    """
+    combined_dir = os.path.join(tmp_path_fetch, "coalesced")
+    Path(combined_dir).mkdir(parents=True, exist_ok=True)
+    scripts = []
+    combined = {}
+    splits = {}
+    for i, merged in enumerate(coalesce_requests(requests, max_params)):
+        request = merged["request"]
+        name = f"{request['type']}_{request['stream']}_{request['levtype']}_{i}"
+        combined_file = os.path.join(combined_dir, f"{name}.grib2")
+        script_path = os.path.join(tmp_path_fetch, "scr", f"fetch_script_{name}_merged.mars")
+        write_mars_script(dict(request, target=f'"{combined_file}"'), script_path)
+        print(f"{script_path}: {len(merged['params'])} params")
+        scripts.append(script_path)
+        combined[script_path] = combined_file
+        splits[script_path] = merged["targets"]
+    return scripts, combined, splits
+
+
+def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="mars_config.yaml", coalesce=False, max_params=None):
+    """
+    Process MARS statements for given date range.
+    With coalesce the requests that only differ in the parameter are merged
+    and the downloaded files split into the usual per-parameter files.
+    """
     mm_params = ['201','202','228029']
     fc_params = ['260648'] # the only one instantaneous and in fc fields. FOG
     # Load configurations from YAML file
@@ -90,9 +126,11 @@ def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="m
 
     if not retrieval_configs:
         print("No configurations loaded. Exiting.")
-        return []
+        return [], []
 
     created_files = []
+    targets = {}
+    requests = []
 
     for config in retrieval_configs:
 
@@ -143,23 +181,40 @@ def process_mars_statements(start_date, end_date, tmp_path_fetch, config_file="m
             # Add full path to output filename
             full_output_path = str(Path(output_dir) / output_filename)
             param_config["target"] = f'"{full_output_path}"'
-
-            # Create MARS statement
-            mars_statement = create_mars_statement(param_config)
-            # Create script filename
-            script_filename = f"fetch_script_{config['type']}_{config['levtype']}_{param}.mars"
+            requests.append(param_config)
+
+    if coalesce:
+        created_files, targets, splits = plan_coalesced(requests, tmp_path_fetch, max_params)
+    else:
+        for param_config in requests:
+            # Create script filename. The stream is needed since the requests run at the same time
+            script_filename = f"fetch_script_{param_config['type']}_{param_config['stream']}_{param_config['levtype']}_{param_config['param']}.mars"
             script_path = os.path.join(tmp_path_fetch,"scr",script_filename)
 
             # Write statement to file
-            with open(script_path, "w") as f:
-                f.write(mars_statement)
-
-            # Execute mars command
-            os.system(f"mars {script_path}")
+            write_mars_script(param_config, script_path)
 
             created_files.append(script_path)
+            targets[script_path] = param_config["target"].strip('"')
+
+    # Execute the mars commands, several at the same time
+    workers = int(os.environ.get("MARS_WORKERS", MARS_WORKERS))
+    retries = int(os.environ.get("MARS_RETRIES", MARS_RETRIES))
+    backoff = float(os.environ.get("MARS_BACKOFF", MARS_BACKOFF))
+    results = run_mars_requests(created_files, workers, retries, backoff, targets)
+    failed = summarise(results, os.path.join(tmp_path_fetch, "scr", "failed_requests.txt"))
+
+    if coalesce:
+        # split the merged downloads in the per-parameter files
+        for result in results:
+            if result["returncode"] != 0:
+                continue
+            combined_file = targets[result["script"]]
+            counts = split_by_param(combined_file, splits[result["script"]])
+            print(f"Split {combined_file}: {sum(counts.values())} messages in {len(counts)} files")
+            os.remove(combined_file)
 
-    return created_files
+    return created_files, failed
 
 
 def main():
@@ -167,6 +222,9 @@ def main():
     period = sys.argv[1]
     tmp_path_fetch = sys.argv[2]
     selected_config = sys.argv[3]
+    # --coalesce to merge the requests of all the parameters (see mars_planner.py)
+    coalesce = "--coalesce" in sys.argv[4:]
+    max_params = int(os.environ["MARS_MAX_PARAMS"]) if "MARS_MAX_PARAMS" in os.environ else None
     
     start_date, end_date = get_dates(period)
     print(f"Doing {period}")
@@ -177,7 +235,7 @@ def main():
         os.makedirs(os.path.join(tmp_path_fetch,"scr"))
 
     print("Processing MARS statements...")
-    created_files = process_mars_statements(start_date, end_date, tmp_path_fetch,selected_config)
+    created_files, failed = process_mars_statements(start_date, end_date, tmp_path_fetch,selected_config, coalesce, max_params)
 
     #print("\nCreated files and directories:")
     # Print created directories
@@ -191,6 +249,8 @@ def main():
     print("\nCreated files:")
     for file in created_files:
         print(f"- {file}")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
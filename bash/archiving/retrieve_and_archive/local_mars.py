@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Local stand-in for mars, keeping the fields in files
+#
+# Runs the list, retrieve and archive requests of a mars request file
+# against a directory instead of MARS, so the fetch and archive scripts
+# (mars_executor.py, check_missing_variables.py, repair_gaps.py) can be
+# tried without MARS by setting MARS_COMMAND, ie
+#   export MARS_COMMAND="python3 local_mars.py --root /scratch/local_mars"
+#
+# Each field is one GRIB file
+#   ROOT/DATABASE/CLASS_EXPVER_ORIGIN_TYPE_STREAM_LEVTYPE/YYYYMMDD_PARAM_LEVEL.grib
+# archive copies the messages of the source file there (the date, param
+# and level are read from the messages), retrieve writes the requested
+# fields to the target and list prints them with the columns of a mars
+# listing (see mars_list_parser.py). Only the keys used by the scripts of
+# this directory are supported: time and step are not part of the field.
+#
+# Examples:
+#   python3 local_mars.py --root /tmp/local_mars archive_an_dame_ml_130.mars
+#   MARS_COMMAND="python3 local_mars.py --root /tmp/local_mars" python3 repair_gaps.py 198501 198503
+
+import os
+import sys
+import argparse
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ecf_submitters", "bin"))
+from grib_index import get_index
+from grib_reader import GribReader
+
+LEVEL_TYPES = ["ml", "pl", "hl"]  # levtypes listed with a levelist column
+FIELD_KEYS = ["class", "expver", "origin", "type", "stream", "levtype"]
+DEFAULTS = {"class": "rr", "expver": "prod", "origin": "no-ar-pa", "type": "an", "stream": "oper",
+            "levtype": "sfc", "database": "marser"}
+
+
+def parse_requests(text):
+    """List of (verb, {key: value}) of the requests in a mars request file"""
+    requests = []
+    for line in text.splitlines():
+        line = line.split("#")[0].strip()
+        for token in line.split(","):
+            token = token.strip()
+            if not token:
+                continue
+            key, sep, value = token.partition("=")
+            if not sep:
+                requests.append((token.lower(), {}))
+            elif requests:
+                requests[-1][1][key.strip().lower()] = value.strip().strip('"')
+    return requests
+
+
+def yyyymmdd(value):
+    """Date as YYYYMMDD from YYYY-MM-DD or YYYYMMDD"""
+    return value.replace("-", "")
+
+
+def expand_dates(value):
+    """Dates (YYYYMMDD) of a mars date value: a list and/or START/to/END ranges"""
+    parts = value.split("/")
+    dates = []
+    i = 0
+    while i < len(parts):
+        if i + 2 < len(parts) and parts[i + 1].lower() == "to":
+            start, end = [yyyymmdd(d) for d in (parts[i], parts[i + 2])]
+            day = date(int(start[:4]), int(start[4:6]), int(start[6:]))
+            while day.strftime("%Y%m%d") <= end:
+                dates.append(day.strftime("%Y%m%d"))
+                day += timedelta(days=1)
+            i += 3
+        else:
+            dates.append(yyyymmdd(parts[i]))
+            i += 1
+    return dates
+
+
+class LocalMars:
+    """Fields of the local stand-in, one file each under root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def field_dir(self, request):
+        keys = dict(DEFAULTS, **request)
+        return os.path.join(self.root, keys["database"], "_".join(keys[key] for key in FIELD_KEYS))
+
+    def stored_fields(self, request):
+        """(date, param, level, path) of the fields stored for the keys of request"""
+        directory = self.field_dir(request)
+        if not os.path.isdir(directory):
+            return []
+        fields = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".grib"):
+                field_date, param, level = name[:-len(".grib")].split("_")
+                fields.append((field_date, param, level, os.path.join(directory, name)))
+        return fields
+
+    def select(self, request):
+        """Stored fields matching the date, param and levelist of request"""
+        dates = set(expand_dates(request["date"])) if "date" in request else None
+        params = set(request["param"].split("/")) if "param" in request else None
+        levels = set(request["levelist"].split("/")) if "levelist" in request else None
+        if request.get("levtype", DEFAULTS["levtype"]) not in LEVEL_TYPES:
+            levels = None
+        return [field for field in self.stored_fields(request)
+                if (dates is None or field[0] in dates) and (params is None or field[1] in params)
+                and (levels is None or field[2] in levels)]
+
+    def archive(self, request):
+        source = request.get("source")
+        if not source or not os.path.isfile(source):
+            print(f"ERROR: source file not found: {source}")
+            return 1
+        entries = get_index(source, save=False)
+        if "expect" in request and int(request["expect"]) != len(entries):
+            print(f"ERROR: expected {request['expect']} fields in {source}, found {len(entries)}")
+            return 1
+        dates = set(expand_dates(request["date"])) if "date" in request else None
+        params = set(request["param"].split("/")) if "param" in request else None
+        directory = self.field_dir(request)
+        os.makedirs(directory, exist_ok=True)
+        with_levels = request.get("levtype", DEFAULTS["levtype"]) in LEVEL_TYPES
+        with GribReader(source) as reader:
+            for entry in entries:
+                field_date, param = str(entry["date"]), str(entry["param"])
+                if (dates is not None and field_date not in dates) or (params is not None and param not in params):
+                    print(f"ERROR: field date={field_date} param={param} in {source} does not match the request")
+                    return 1
+                level = str(entry["level"]) if with_levels else "0"
+                path = os.path.join(directory, f"{field_date}_{param}_{level}.grib")
+                with open(path + ".tmp", "wb") as f:
+                    f.write(reader.message_at(entry).data)
+                os.replace(path + ".tmp", path)
+        print(f"Archived {len(entries)} fields from {source}")
+        return 0
+
+    def retrieve(self, request):
+        fields = self.select(request)
+        expected = len(expand_dates(request["date"])) * len(request["param"].split("/"))
+        if request.get("levtype", DEFAULTS["levtype"]) in LEVEL_TYPES and "levelist" in request:
+            expected *= len(request["levelist"].split("/"))
+        target = request.get("target", "data.grib")
+        with open(target, "wb") as out:
+            for field in fields:
+                with open(field[3], "rb") as f:
+                    out.write(f.read())
+        print(f"Retrieved {len(fields)} fields to {target}")
+        if len(fields) != expected:
+            print(f"ERROR: expected {expected} fields, got {len(fields)}")
+            return 1
+        return 0
+
+    def list(self, request):
+        fields = self.select(request)
+        with_levels = request.get("levtype", DEFAULTS["levtype"]) in LEVEL_TYPES
+        keys = dict(DEFAULTS, **request)
+        for key in FIELD_KEYS:
+            print(f"{key:<9} = {keys[key]}")
+        print("date       file   length       " + ("levelist " if with_levels else "") + "missing offset       param")
+        offset = 0
+        for field_date, param, level, path in fields:
+            length = os.path.getsize(path)
+            day = f"{field_date[:4]}-{field_date[4:6]}-{field_date[6:]}"
+            print(f"{day} 0      {length:<12} " + (f"{level:<8} " if with_levels else "") + f".       {offset:<12} {param}")
+            offset += length
+        print(f"\nGrand Total:\n============\n\nEntries       : {len(fields):,}\n")
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run mars requests against a local directory")
+    parser.add_argument("--root", default=os.environ.get("LOCAL_MARS_ROOT", "local_mars"),
+                        help="Directory with the fields (default: $LOCAL_MARS_ROOT or ./local_mars)")
+    parser.add_argument("request_file", help="mars request file")
+    args = parser.parse_args()
+
+    with open(args.request_file, "r") as f:
+        requests = parse_requests(f.read())
+    mars = LocalMars(args.root)
+    for verb, request in requests:
+        if verb not in ("list", "retrieve", "archive"):
+            print(f"ERROR: {verb} not supported by the local mars")
+            sys.exit(1)
+        returncode = getattr(mars, verb)(request)
+        if returncode != 0:
+            sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Run several MARS request files at the same time
+#
+# Retrieving a whole period is mostly waiting for MARS, so a few clients
+# are run in parallel (threads, each one waiting on a mars subprocess).
+# Each request is retried with an increasing wait if mars fails, the exit
+# status of every request is kept and the failed ones are summarised at the end
+# (and optionally written to a file, to run them again later).
+#
+# The mars command can be changed with the environment variable MARS_COMMAND
+# (ie, to add options or to use a local replacement for testing).
+#
+# Examples:
+#   mars_executor.py scr/*.mars -j 6 -r 3
+#   MARS_COMMAND="mars -t" mars_executor.py fetch_script_an_dame_ml_130.mars
+
+import os
+import sys
+import time
+import shlex
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+MARS_WORKERS = 4  # mars clients at the same time
+MARS_RETRIES = 2  # extra attempts after the first one fails
+MARS_BACKOFF = 60  # seconds to wait before the first retry. Doubled after each attempt
+
+
+def mars_command():
+    """The mars command, as a list for subprocess"""
+    return shlex.split(os.environ.get("MARS_COMMAND", "mars"))
+
+
+def run_mars_request(script_path, retries=MARS_RETRIES, backoff=MARS_BACKOFF, target=None):
+    """
+    Run mars on script_path, retrying up to retries times if it fails.
+    The output of mars goes to script_path.log. A partial target file is
+    removed before trying again.
+    Return a dictionary with the script, exit status, attempts and time spent
+    """
+    log_path = script_path + ".log"
+    start = time.time()
+    returncode = None
+    for attempt in range(1, retries + 2):
+        with open(log_path, "a") as log:
+            log.write(f"# attempt {attempt}\n")
+            log.flush()
+            try:
+                returncode = subprocess.run(mars_command() + [script_path], stdout=log, stderr=subprocess.STDOUT).returncode
+            except OSError as e:
+                log.write(f"Could not run mars: {e}\n")
+                returncode = 127
+        if returncode == 0:
+            break
+        if target is not None and os.path.isfile(target):
+            os.remove(target)
+        if attempt <= retries:
+            wait = backoff * 2**(attempt - 1)
+            print(f"mars failed for {script_path} (exit code {returncode}). Trying again in {wait} s")
+            time.sleep(wait)
+    return {
+        "script": script_path,
+        "returncode": returncode,
+        "attempts": attempt,
+        "elapsed": time.time() - start,
+        "log": log_path,
+    }
+
+
+def run_mars_requests(scripts, max_workers=MARS_WORKERS, retries=MARS_RETRIES, backoff=MARS_BACKOFF, targets=None):
+    """
+    Run all the scripts with at most max_workers mars clients at the same time.
+    targets is an optional dictionary {script: target file}.
+    Return the list of results (see run_mars_request), in the order of scripts
+    """
+    targets = targets or {}
+    print(f"Running {len(scripts)} mars requests, {max_workers} at a time")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_mars_request, script, retries, backoff, targets.get(script)) for script in scripts]
+        results = []
+        for future in futures:
+            result = future.result()
+            status = "OK" if result["returncode"] == 0 else f"FAILED (exit code {result['returncode']})"
+            print(f"{result['script']}: {status} after {result['attempts']} attempts, {result['elapsed']:.0f} s")
+            results.append(result)
+    return results
+
+
+def summarise(results, failed_file=None):
+    """Print a summary of the results and return the failed ones"""
+    failed = [result for result in results if result["returncode"] != 0]
+    print(f"\n{len(results) - len(failed)} of {len(results)} mars requests finished OK")
+    if failed:
+        print("Failed requests:")
+        for result in failed:
+            print(f"- {result['script']} (exit code {result['returncode']}, see {result['log']})")
+        if failed_file is not None:
+            with open(failed_file, "w") as f:
+                f.write("\n".join(result["script"] for result in failed) + "\n")
+            print(f"List of failed requests written to {failed_file}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several MARS request files at the same time")
+    parser.add_argument("scripts", nargs="+", help="MARS request files")
+    parser.add_argument("--workers", "-j", type=int, default=MARS_WORKERS, help="mars clients at the same time")
+    parser.add_argument("--retries", "-r", type=int, default=MARS_RETRIES, help="Retries for each failed request")
+    parser.add_argument("--backoff", "-b", type=float, default=MARS_BACKOFF, help="Seconds before the first retry")
+    parser.add_argument("--failed", "-f", help="Write the failed requests to this file")
+    args = parser.parse_args()
+
+    results = run_mars_requests(args.scripts, args.workers, args.retries, args.backoff)
+    if summarise(results, args.failed):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Merge MARS retrievals that only differ in the parameter
+#
+# The fetch scripts create one retrieve per parameter, so a month of
+# an dame sfc needs more than 30 separate passes over the same tapes.
+# Here the per-parameter requests with the same class, stream, type,
+# levtype, levels, dates... are merged into one multi-parameter retrieve.
+# The downloaded file is then split locally into the usual per-parameter
+# target files, copying the raw bytes of each message (see grib_index.py
+# and grib_reader.py), so the directory layout does not change. A manifest
+# is written for each target file (see grib_manifest.py).
+#
+#   plan = coalesce_requests(requests)
+#   for merged in plan:
+#       ...retrieve merged["request"] with target=combined file...
+#       split_by_param(combined, merged["targets"])
+
+import os
+import sys
+from contextlib import ExitStack
+
+# the GRIB index and reader are shared with the tools under ecf_submitters/bin
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ecf_submitters", "bin"))
+from grib_index import get_index
+from grib_reader import GribReader
+from grib_manifest import ManifestFile
+
+# keys that can be different within a merged request
+MERGE_KEYS = ["param", "target"]
+
+
+def split_params(value):
+    """List of parameters in a MARS param value like 130/133"""
+    return [p for p in str(value).replace("\n", "").replace(" ", "").split("/") if p]
+
+
+def request_key(request):
+    """All the keys of the request except MERGE_KEYS, used to find compatible requests"""
+    key = []
+    for name, value in sorted(request.items()):
+        if name in MERGE_KEYS:
+            continue
+        if isinstance(value, str):
+            value = value.replace("\n", "").replace(" ", "").lower()
+        key.append((name, str(value)))
+    return tuple(key)
+
+
+def coalesce_requests(requests, max_params=None):
+    """
+    Merge the requests (dictionaries with MARS keys, an optional target per
+    request) that only differ in param and target. Each merged request has at
+    most max_params parameters (all if None).
+    Return a list of dictionaries, in order of appearance, with
+      request: the merged MARS keys, without target
+      params:  the parameters in the request
+      targets: {param: target file} of the original requests
+    """
+    groups = {}
+    for request in requests:
+        key = request_key(request)
+        group = groups.setdefault(key, {"request": {k: v for k, v in request.items() if k != "target"}, "params": [], "targets": {}})
+        for param in split_params(request["param"]):
+            if param in group["targets"]:
+                continue
+            group["params"].append(param)
+            group["targets"][param] = str(request.get("target", "")).strip('"')
+
+    plan = []
+    for group in groups.values():
+        params = group["params"]
+        size = max_params or len(params)
+        for i in range(0, len(params), size):
+            chunk = params[i:i + size]
+            request = dict(group["request"], param="/".join(chunk))
+            plan.append({"request": request, "params": chunk, "targets": {p: group["targets"][p] for p in chunk}})
+    return plan
+
+
+def split_by_param(combined_file, targets):
+    """
+    Copy the messages of combined_file to the target file of their parameter.
+    targets is {param: target file}. Return {param: number of messages written}.
+    Messages of other parameters are skipped with a warning
+    """
+    counts = {param: 0 for param in targets}
+    outputs = {}
+    # the manifest of each file is written at the same time (see grib_manifest.py)
+    with GribReader(combined_file) as reader, ExitStack() as stack:
+        for entry in get_index(combined_file, save=False):
+            param = str(entry["param"])
+            if param not in targets:
+                print(f"WARNING: param {param} in {combined_file} was not requested. Skipping")
+                continue
+            if param not in outputs:
+                outputs[param] = stack.enter_context(ManifestFile(targets[param], producer="mars_planner.py"))
+            outputs[param].write(reader.message_at(entry).data, entry)
+            counts[param] += 1
+    for param, count in counts.items():
+        if count == 0:
+            print(f"WARNING: no messages for param {param} in {combined_file}")
+    return counts
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# Repair the holes of a period in MARS: check, fetch and archive again
+#
+# One command for what was done by hand with check_missing_variables.py -j,
+# generate_fetch_scripts.py, mars and the archive scripts. The holes of the
+# target database (marser by default) are fetched from the source database
+# (marssc) and archived again, in stages:
+#   check    list all the templates for every month of the period
+#            (check_missing_variables.py --sweep, with the local inventory)
+#   plan     fewest retrieves from the source database covering every hole
+#            (generate_fetch_scripts.py --plan)
+#   fetch    run the retrieves concurrently (mars_executor.py) and split each
+#            download in one file per param (mars_planner.split_by_param)
+#   archive  one archive request per file, as archive_to_mars.py, and the
+#            SLURM script running them (a job array with ARCHIVE_SHARDS)
+#   submit   sbatch the archive script (--submit) or run the archive
+#            requests here (--run-archive, ie from fac2)
+#   verify   list again the months that had holes and stop with an error
+#            if any is left (after --submit, in the next run, when the
+#            archive job has finished)
+# The state of each stage is saved in WORK_DIR/repair_state.json after every
+# step (and every mars request of fetch and submit), so running the same
+# command again continues where it stopped: stages done are skipped and only
+# the requests that failed or did not run are tried again.
+# --redo STAGE forgets that stage and the ones after it.
+#
+# The mars command can be changed with MARS_COMMAND, ie to use local_mars.py
+# instead of MARS.
+#
+# Examples:
+#   repair_gaps.py 198501 198512 --run-archive
+#   repair_gaps.py 198501 198512 -t mars_request_ml_levels_an_dame --redo plan
+#   MARS_COMMAND="python3 local_mars.py --root /tmp/local_mars" repair_gaps.py 198501 198503 --run-archive
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "missing_data"))
+from check_missing_variables import run_sweep, sweep_months, month_dates, json_results, SWEEP_WORKERS, MARS_TIMEOUT
+from generate_fetch_scripts import plan_fetches, check_plan, date_spec, parse_template_for_base_info, result_holes
+from mars_inventory import Inventory
+from mars_executor import run_mars_request, MARS_WORKERS, MARS_RETRIES, MARS_BACKOFF
+from mars_planner import split_by_param
+from fetch_from_marsscr import write_mars_script
+from archive_to_mars import load_configs, scan_grib_file, create_mars_statement, create_slurm_script
+from archive_shards import create_shards
+
+STAGES = ["check", "plan", "fetch", "archive", "submit", "verify"]
+STATE_FILE = "repair_state.json"
+MM_PARAMS = ["201", "202", "228029"]  # fc params of the minmax directories (see fetch_from_marsscr.py)
+FC_PARAMS = ["260648"]  # instantaneous fc params
+
+
+def load_state(work_dir):
+    state_path = os.path.join(work_dir, STATE_FILE)
+    if not os.path.isfile(state_path):
+        return {"stages": {}}
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def save_state(work_dir, state):
+    """Write the state to a temporary file first, so an interrupted run never leaves it half written"""
+    state_path = os.path.join(work_dir, STATE_FILE)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def data_path(type_val, stream, levtype, param):
+    """Directory of a param, as the data_path of mars_config_archive.yaml"""
+    if type_val == "fc":
+        extra = "minmax" if param in MM_PARAMS else "ins" if param in FC_PARAMS else "sums"
+        return f"{type_val}_{stream}_{levtype}_{extra}"
+    return f"{type_val}_{stream}_{levtype}"
+
+
+def run_checkpointed(scripts, done, work_dir, state, workers, targets=None):
+    """
+    Run the mars scripts not in done, at most workers at the same time.
+    done ({script: result}) is updated and the state saved as each one finishes.
+    Return the scripts that failed
+    """
+    targets = targets or {}
+    todo = [script for script in scripts if script not in done]
+    if len(todo) < len(scripts):
+        print(f"{len(scripts) - len(todo)} of {len(scripts)} requests already done")
+    retries = int(os.environ.get("MARS_RETRIES", MARS_RETRIES))
+    backoff = float(os.environ.get("MARS_BACKOFF", MARS_BACKOFF))
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_mars_request, script, retries, backoff, targets.get(script)): script for script in todo}
+        for future in as_completed(futures):
+            result = future.result()
+            if result["returncode"] != 0:
+                print(f"{result['script']}: FAILED (exit code {result['returncode']}, see {result['log']})")
+                failed.append(result["script"])
+                continue
+            done[result["script"]] = {"attempts": result["attempts"], "elapsed": round(result["elapsed"], 1)}
+            save_state(work_dir, state)
+            print(f"{result['script']}: OK after {result['attempts']} attempts, {result['elapsed']:.0f} s")
+    return failed
+
+
+def stage_check(args, state):
+    """Sweep the templates and save the results in check.json"""
+    if args.templates:
+        template_paths = [os.path.join(args.template_dir, name) for name in args.templates]
+    else:
+        template_paths = sorted(str(p) for p in Path(args.template_dir).iterdir() if p.is_file())
+    # the incomplete months are the ones being repaired, so they are always listed again
+    inventory = Inventory(args.inventory, incomplete_max_age=0)
+    try:
+        results, failed = run_sweep(template_paths, sweep_months(args.start, args.end), args.database,
+                                    args.check_workers, MARS_TIMEOUT, inventory)
+    finally:
+        inventory.close()
+    if failed:
+        print(f"{len(failed)} listings failed: " + ", ".join(f"{template} {period}" for template, period in failed))
+        return None
+    check_file = os.path.join(args.work_dir, "check.json")
+    with open(check_file, "w") as f:
+        json.dump(json_results(results), f, indent=2)
+    return {"results": check_file, "listings": len(results)}
+
+
+def stage_plan(args, state):
+    """Plan the retrieves of the holes from the source database and write their scripts"""
+    with open(state["stages"]["check"]["results"], "r") as f:
+        results = json.load(f)
+    plan, holes_by_template = plan_fetches(results)
+    nholes = check_plan(plan, holes_by_template)
+    scripts_dir = os.path.join(args.work_dir, "fetch_scripts")
+    download_dir = os.path.join(args.work_dir, "downloads")
+    os.makedirs(scripts_dir, exist_ok=True)
+    os.makedirs(download_dir, exist_ok=True)
+    requests = []
+    for n, request in enumerate(plan, start=1):
+        result = request["result"]
+        base_params = parse_template_for_base_info(os.path.join(args.template_dir, result["template_name"]), args.source_database)
+        name = f"{result['type']}_{result['stream']}_{result['levtype']}_{n:03d}"
+        target = os.path.join(download_dir, f"{name}.grib2")
+        retrieve = {
+            "class": base_params["class"],
+            "database": args.source_database,
+            "date": date_spec(request["start"], request["end"], result["stream"]),
+            "expver": base_params["expver"],
+        }
+        if request["levels"] != [None]:
+            retrieve["levelist"] = "/".join(request["levels"])
+        retrieve.update({
+            "levtype": result["levtype"],
+            "origin": base_params["origin"],
+            "param": "/".join(request["params"]),
+            "stream": result["stream"],
+            "type": result["type"],
+            "target": f'"{target}"',
+        })
+        script = os.path.join(scripts_dir, f"fetch_{name}.mars")
+        write_mars_script(retrieve, script)
+        requests.append({"script": script, "target": target, "type": result["type"], "stream": result["stream"],
+                         "levtype": result["levtype"], "params": request["params"], "date": retrieve["date"]})
+    print(f"{len(requests)} retrieves cover {nholes} missing (date, param, level)")
+    return {"requests": requests, "holes": nholes}
+
+
+def stage_fetch(args, state):
+    """Run the retrieves and split each download in one file per param"""
+    requests = state["stages"]["plan"]["requests"]
+    fetch = state["stages"].setdefault("fetch_progress", {})
+    scripts = [request["script"] for request in requests]
+    targets = {request["script"]: request["target"] for request in requests}
+    failed = run_checkpointed(scripts, fetch, args.work_dir, state, args.workers, targets)
+    if failed:
+        print(f"{len(failed)} retrieves failed. Run again to retry them")
+        return None
+    split_dir = os.path.join(args.work_dir, "split")
+    for request in requests:
+        done = fetch[request["script"]]
+        if "files" in done:
+            continue
+        download = request["target"]
+        name = Path(download).stem
+        files = {}
+        for param in request["params"]:
+            output_dir = os.path.join(split_dir, data_path(request["type"], request["stream"], request["levtype"], param))
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            files[param] = os.path.join(output_dir, f"{name}_{param}.grib2")
+        counts = split_by_param(download, files)
+        done["files"] = [files[param] for param in request["params"] if counts[param] > 0]
+        os.remove(download)
+        save_state(args.work_dir, state)
+        print(f"Split {download}: {sum(counts.values())} messages in {len(done['files'])} files")
+    return {"files": sum(len(fetch[script]["files"]) for script in scripts)}
+
+
+def stage_archive(args, state):
+    """One archive request per fetched file, and the SLURM script to run them"""
+    configs = {config["data_path"]: config for config in load_configs(args.archive_config)}
+    scripts_dir = os.path.join(args.work_dir, "archival_scripts")
+    os.makedirs(scripts_dir, exist_ok=True)
+    fetch = state["stages"]["fetch_progress"]
+    scripts = []
+    for request in state["stages"]["plan"]["requests"]:
+        for grib_file in fetch[request["script"]]["files"]:
+            config = configs.get(Path(grib_file).parent.name)
+            if config is None:
+                print(f"WARNING: no archive configuration for {grib_file}. Not archiving it")
+                continue
+            param_config = config.copy()
+            del param_config["data_path"]
+            param_config["database"] = args.database
+            param_config["date"] = request["date"]
+            param_config["source"] = f'"{grib_file}"'
+            param = Path(grib_file).stem.split("_")[-1]
+            param_config["param"] = param
+            levels, count = scan_grib_file(grib_file)
+            if count is None or count == "0":
+                print(f"ERROR: no GRIB messages read from {grib_file}. Not archiving it")
+                continue
+            param_config["levelist"] = levels
+            param_config["expect"] = count
+            script = os.path.join(scripts_dir, f"archive_{Path(grib_file).stem}.mars")
+            with open(script, "w") as f:
+                f.write(create_mars_statement(param_config))
+            scripts.append(script)
+    slurm_script = os.path.join(args.work_dir, f"archive_repair_{args.start}_{args.end}.sh")
+    create_slurm_script(scripts, slurm_script)
+    # with ARCHIVE_SHARDS also a job array balanced by the bytes to archive, as archive_to_mars.py
+    array_script = None
+    if os.environ.get("ARCHIVE_SHARDS") and scripts:
+        nshards = None if os.environ["ARCHIVE_SHARDS"] == "auto" else int(os.environ["ARCHIVE_SHARDS"])
+        array_script = os.path.join(args.work_dir, f"archive_repair_{args.start}_{args.end}_array.sh")
+        create_shards(scripts, os.path.join(args.work_dir, "archive_shards"), array_script, nshards)
+    return {"scripts": scripts, "slurm_script": slurm_script, "array_script": array_script}
+
+
+def stage_submit(args, state):
+    """Run the archive requests here, or submit the SLURM script"""
+    archive = state["stages"]["archive"]
+    if args.run_archive:
+        progress = state["stages"].setdefault("submit_progress", {})
+        failed = run_checkpointed(archive["scripts"], progress, args.work_dir, state, args.workers)
+        if failed:
+            print(f"{len(failed)} archive requests failed. Run again to retry them")
+            return None
+        return {"archived": len(archive["scripts"])}
+    if args.submit:
+        if archive["array_script"]:
+            command = [archive["array_script"], "--submit"]
+        else:
+            command = ["sbatch", archive["slurm_script"]]
+        output = subprocess.run(command, capture_output=True, text=True)
+        print(output.stdout + output.stderr)
+        if output.returncode != 0:
+            print(f"Submission failed: {' '.join(command)}")
+            return None
+        return {"submitted": " ".join(command), "output": output.stdout.strip()}
+    print(f"Archive requests ready. Submit them from fac2 with: sbatch {archive['slurm_script']}")
+    print("or run this again with --submit or --run-archive")
+    return None
+
+
+def fields_left(result):
+    """
+    Expected (date, param, level) of the month of a listing that are not in
+    it, counted from its coverage cube (not with the holes of the plan, so a
+    hole the plan did not see is found too)
+    """
+    cube = result["cube"]
+    ndates = len(month_dates(int(result["period"][:4]), int(result["period"][4:]), result["stream"]))
+    if cube.levels is None:
+        return ndates * len(cube.params) - int(cube.listed.sum())
+    return ndates * len(cube.params) * len(cube.level_names) - int(cube.levels[cube.listed].sum())
+
+
+def stage_verify(args, state):
+    """List again the months that had holes, and fail if any hole is left"""
+    with open(state["stages"]["check"]["results"], "r") as f:
+        results = json.load(f)
+    months_by_template = {}
+    for result in results:
+        if result_holes(result):
+            period = result["period"]
+            months_by_template.setdefault(result["template_name"], []).append((int(period[:4]), int(period[4:])))
+    # always listed again (max_age_days=0), also the months the inventory has as complete
+    inventory = Inventory(args.inventory)
+    listed = []
+    try:
+        for template_name, months in sorted(months_by_template.items()):
+            template_results, failed = run_sweep([os.path.join(args.template_dir, template_name)], months,
+                                                 args.database, args.check_workers, MARS_TIMEOUT, inventory, 0)
+            if failed:
+                print(f"{len(failed)} listings failed: " + ", ".join(f"{template} {period}" for template, period in failed))
+                return None
+            listed.extend(template_results)
+    finally:
+        inventory.close()
+    verify_file = os.path.join(args.work_dir, "verify.json")
+    with open(verify_file, "w") as f:
+        json.dump(json_results(listed), f, indent=2)
+    left = {(result["template_name"], result["period"]): fields_left(result) for result in listed}
+    left = {key: nfields for key, nfields in left.items() if nfields}
+    if left:
+        for (template_name, period), nfields in sorted(left.items()):
+            print(f"{template_name} {period}: {nfields} fields still missing")
+        print(f"Holes left after the repair (see {verify_file}). Run again with --redo check to repair them")
+        return None
+    print(f"{len(listed)} listings with no holes left")
+    return {"results": verify_file, "listings": len(listed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check, fetch and archive again the holes of a period in MARS")
+    parser.add_argument("start", help="First month (YYYYMM)")
+    parser.add_argument("end", help="Last month (YYYYMM)")
+    parser.add_argument("--work-dir", "-w", help="Directory for the state, scripts and data (default: repair_START_END)")
+    parser.add_argument("--templates", "-t", nargs="+", help="Only these templates (default: all in the template directory)")
+    parser.add_argument("--template-dir", "-d", default=os.path.join(SCRIPT_DIR, "..", "missing_data", "mars_templates"),
+                        help="Directory with the MARS list templates")
+    parser.add_argument("--database", "-db", default="marser", help="Database to check and archive to (default: marser)")
+    parser.add_argument("--source-database", default="marssc", help="Database to fetch the missing data from (default: marssc)")
+    parser.add_argument("--archive-config", default=os.path.join(SCRIPT_DIR, "mars_config_archive.yaml"),
+                        help="Archive configuration (default: mars_config_archive.yaml)")
+    parser.add_argument("--inventory", "-i", help="Local inventory of the listings (default: WORK_DIR/mars_inventory.sqlite)")
+    parser.add_argument("--workers", "-j", type=int, default=int(os.environ.get("MARS_WORKERS", MARS_WORKERS)),
+                        help="mars retrieves (or archives with --run-archive) at the same time")
+    parser.add_argument("--check-workers", type=int, default=SWEEP_WORKERS, help="mars listings at the same time")
+    parser.add_argument("--redo", choices=STAGES, help="Run this stage and the ones after it again")
+    parser.add_argument("--submit", action="store_true", help="Submit the archive script with sbatch")
+    parser.add_argument("--run-archive", action="store_true", help="Run the archive requests here (from fac2)")
+    args = parser.parse_args()
+    try:
+        sweep_months(args.start, args.end)
+    except ValueError as e:
+        parser.error(f"START and END must be YYYYMM with START <= END ({e})")
+
+    args.work_dir = os.path.abspath(args.work_dir or f"repair_{args.start}_{args.end}")
+    args.template_dir = os.path.abspath(args.template_dir)
+    args.inventory = args.inventory or os.path.join(args.work_dir, "mars_inventory.sqlite")
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    state = load_state(args.work_dir)
+    period = {"start": args.start, "end": args.end, "database": args.database,
+              "source_database": args.source_database, "templates": args.templates}
+    if state.get("period", period) != period:
+        print(f"ERROR: {args.work_dir} has the repair of {state['period']}. Use another --work-dir")
+        sys.exit(1)
+    state["period"] = period
+    if args.redo:
+        for stage in STAGES[STAGES.index(args.redo):]:
+            state["stages"].pop(stage, None)
+            state["stages"].pop(f"{stage}_progress", None)
+        save_state(args.work_dir, state)
+
+    for stage in STAGES:
+        if stage in state["stages"]:
+            print(f"Stage {stage}: already done")
+            continue
+        print(f"\nStage {stage}")
+        output = globals()[f"stage_{stage}"](args, state)
+        if output is None:
+            save_state(args.work_dir, state)
+            print(f"Stopped at stage {stage}. Run the same command again to continue")
+            sys.exit(1 if stage != "submit" or args.submit or args.run_archive else 0)
+        state["stages"][stage] = output
+        save_state(args.work_dir, state)
+        if stage == "submit" and "submitted" in output:
+            print("Run the same command again when the archive job has finished, to verify the repair")
+            sys.exit(0)
+    print(f"\nRepair of {args.start}-{args.end} done. State in {os.path.join(args.work_dir, STATE_FILE)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,4 +17,7 @@ else
 fi
 
 DATADIR="/ec/res4/scratch/nhd/mars-pull/carra2/fetch_to_archive"
-python3 fetch_from_marsscr.py $PERIOD $DATADIR ./mars_config.yaml
+#export MARS_WORKERS=4 #mars clients at the same time (see mars_executor.py)
+#FETCH_OPTS=--coalesce to merge the requests of all the parameters (see mars_planner.py)
+FETCH_OPTS=""
+python3 fetch_from_marsscr.py $PERIOD $DATADIR ./mars_config.yaml $FETCH_OPTS
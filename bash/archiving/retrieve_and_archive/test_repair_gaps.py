@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# End to end test of repair_gaps.py against local_mars.py
+#
+# marssc is seeded with all the fields of a few templates and marser with
+# the same fields minus some holes (a few days of a param, a day with
+# nothing listed, a whole param for a month, one level of a day and one
+# month of moda). The repair is run
+# with --run-archive, so the missing fields are fetched from marssc and
+# archived to marser, and then run again to check that it only resumes.
+# The verification is checked by removing a repaired day from marser.
+#
+#   python3 -m pytest test_repair_gaps.py
+
+import os
+import sys
+import subprocess
+from datetime import date, timedelta
+
+import pytest
+
+ecc = pytest.importorskip("eccodes")
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+START, END = "198501", "198502"
+TEMPLATES = {
+    "mars_request_sfc_levels_an_dame": "levtype=sfc,\nparam=165/167,\nstream=dame,\ndate=1985-09-01/to/1985-09-30,",
+    "mars_request_ml_levels_an_dame": "levtype=ml,\nlevelist=1/2/3,\nparam=130/133,\nstream=dame,\ndate=1985-09-01/to/1985-09-30,",
+    "mars_request_sfc_levels_an_moda": "levtype=sfc,\nparam=165/167,\nstream=moda,\ndate=19850901,",
+}
+DAYS = [date(1985, 1, 1) + timedelta(days=n) for n in range(59)]
+
+
+def is_hole(database, levtype, stream, field):
+    """Fields not in marser"""
+    if database != "marser":
+        return False
+    day, param, level = field["date"], field["param"], field.get("level")
+    if stream == "moda":
+        return param == 167 and day == 19850201
+    if levtype == "sfc":
+        return (param == 167 and 19850110 <= day <= 19850112) or day == 19850120
+    return (param == 133 and day // 100 == 198502) or (param == 130 and level == 2 and day == 19850105)
+
+
+def write_grib(path, fields):
+    """Small GRIB2 file with one message per field (param, date, level, levtype)"""
+    with open(path, "wb") as f:
+        for field in fields:
+            h = ecc.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+            ecc.codes_set(h, "Ni", 4)
+            ecc.codes_set(h, "Nj", 3)
+            if field["levtype"] == "ml":
+                ecc.codes_set(h, "typeOfFirstFixedSurface", 105)
+                ecc.codes_set(h, "level", field["level"])
+            ecc.codes_set(h, "paramId", field["param"])
+            ecc.codes_set(h, "dataDate", field["date"])
+            ecc.codes_set_values(h, [float(field["param"])] * 12)
+            ecc.codes_write(h, f)
+            ecc.codes_release(h)
+
+
+def seed(tmp_path, env):
+    """Archive the fields of each database to the local mars"""
+    for database in ("marssc", "marser"):
+        for levtype, stream in (("sfc", "dame"), ("ml", "dame"), ("sfc", "moda")):
+            if stream == "moda":
+                fields = [{"param": p, "date": d, "levtype": levtype} for d in (19850101, 19850201) for p in (165, 167)]
+            elif levtype == "ml":
+                fields = [{"param": p, "date": int(d.strftime("%Y%m%d")), "levtype": levtype, "level": l}
+                          for d in DAYS for p in (130, 133) for l in (1, 2, 3)]
+            else:
+                fields = [{"param": p, "date": int(d.strftime("%Y%m%d")), "levtype": levtype} for d in DAYS for p in (165, 167)]
+            fields = [field for field in fields if not is_hole(database, levtype, stream, field)]
+            source = tmp_path / f"seed_{database}_{levtype}_{stream}.grib"
+            write_grib(source, fields)
+            request = tmp_path / f"seed_{database}_{levtype}_{stream}.mars"
+            request.write_text(f"archive,\nclass=rr,\ndatabase={database},\nexpver=prod,\nlevtype={levtype},\n"
+                               f"origin=no-ar-pa,\nstream={stream},\ntype=an,\nsource=\"{source}\"\n")
+            subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, "local_mars.py"), str(request)],
+                           env=env, check=True, capture_output=True)
+
+
+def stored(root, database):
+    """Names of the fields of each directory of database in the local mars"""
+    base = root / database
+    return {directory.name: sorted(p.name for p in directory.iterdir()) for directory in base.iterdir()}
+
+
+@pytest.fixture
+def repair(tmp_path):
+    root = tmp_path / "local_mars"
+    env = dict(os.environ, LOCAL_MARS_ROOT=str(root),
+               MARS_COMMAND=f"{sys.executable} {os.path.join(SCRIPT_DIR, 'local_mars.py')} --root {root}",
+               MARS_RETRIES="1", MARS_BACKOFF="0")
+    seed(tmp_path, env)
+    template_dir = tmp_path / "templates"
+    template_dir.mkdir()
+    for name, keys in TEMPLATES.items():
+        (template_dir / name).write_text(f"list,\nclass=rr,\ndatabase=marssc,\nexpver=prod,\n{keys}\n"
+                                         "origin=no-ar-pa,\ntype=an\n")
+    command = [sys.executable, os.path.join(SCRIPT_DIR, "repair_gaps.py"), START, END,
+               "-w", str(tmp_path / "work"), "-d", str(template_dir), "--run-archive"]
+
+    def run(*options):
+        return subprocess.run(command + list(options), env=env, cwd=tmp_path, capture_output=True, text=True)
+    return root, run
+
+
+def test_repair_fills_the_holes_and_resumes(repair):
+    root, run = repair
+    assert stored(root, "marser") != stored(root, "marssc")
+
+    first = run()
+    assert first.returncode == 0, first.stdout + first.stderr
+    assert stored(root, "marser") == stored(root, "marssc")
+
+    second = run()
+    assert second.returncode == 0, second.stdout + second.stderr
+    for stage in ("check", "plan", "fetch", "archive", "submit", "verify"):
+        assert f"Stage {stage}: already done" in second.stdout
+    assert "OK after" not in second.stdout
+
+
+def test_verify_fails_with_holes_left(repair):
+    root, run = repair
+    first = run()
+    assert first.returncode == 0, first.stdout + first.stderr
+
+    # the whole day lost after the repair, ie an archive that did not land
+    lost = list((root / "marser").glob("*_dame_sfc/19850120_*"))
+    assert len(lost) == 2
+    for path in lost:
+        path.unlink()
+    verify = run("--redo", "verify")
+    assert verify.returncode == 1, verify.stdout + verify.stderr
+    assert "mars_request_sfc_levels_an_dame 198501: 2 fields still missing" in verify.stdout
+
+    again = run("--redo", "check")
+    assert again.returncode == 0, again.stdout + again.stderr
+    assert stored(root, "marser") == stored(root, "marssc")